@@ -0,0 +1,360 @@
+import argparse
+import collections
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+SAMPLE_INTERVAL = 1  # Delay between samples of the live status (seconds)
+REPORT_INTERVAL = 10  # Delay between printed summaries (seconds)
+WINDOWS = (10, 60, 900)  # Rolling windows (seconds)
+WINDOW_BUCKETS = 10  # Time buckets per window, a window slides by span / WINDOW_BUCKETS
+PERCENTILES = (10, 50, 90)
+TRIGGER_COOLDOWN = 600  # Min time between two firings of one trigger (seconds)
+# Histogram bins of each metric for the percentiles: (lowest, highest, bin width), values outside go to the edge bins.
+# "missing" is 1 for a sample without a measurable RSRP (unknown, capped out or no service), 0 otherwise
+METRICS = {
+    "rsrp": (-140, -44, 1),  # dBm
+    "sinr": (-20, 30, 0.5),  # dB
+    "rsrq": (-20, 45, 0.5),  # dB
+    "rssi": (-120, -25, 1),  # dBm, LTE only
+    "missing": (0, 1, 1),
+}
+# Degradation triggers, replaced by the list of a JSON file (--triggers). A trigger fires when stat of metric
+# over window (seconds) goes below or above its threshold with at least min_count samples in the window,
+# or on an "event" such as "cell_change". It fires again only once the condition has cleared and
+# cooldown (TRIGGER_COOLDOWN, none for event triggers) has passed. action is "log", "relock", "restart"
+# or "exec", which runs "command" with the event as JSON in ANALYTICS_EVENT (see Actions)
+TRIGGERS = [
+    {"name": "weak_signal", "metric": "rsrp", "window": 60, "stat": "mean", "below": -115, "min_count": 30,
+     "action": "log"},
+    {"name": "poor_quality", "metric": "sinr", "window": 60, "stat": "p50", "below": 0, "min_count": 30,
+     "action": "log"},
+    {"name": "no_signal", "metric": "missing", "window": 60, "stat": "mean", "above": 0.5, "min_count": 30,
+     "action": "log"},
+    {"name": "cell_change", "event": "cell_change", "action": "log"},
+]
+
+
+def load_triggers(path=None):
+    """
+    TRIGGERS, or the list of a JSON file
+    """
+    if not path:
+        return json.loads(json.dumps(TRIGGERS))
+    with open(path) as f:
+        triggers = json.load(f)
+    for trigger in triggers:
+        if "event" not in trigger and ("metric" not in trigger or not ("below" in trigger or "above" in trigger)):
+            raise ValueError(f"trigger {trigger.get('name')} needs an event, or a metric and below or above")
+        if trigger.get("metric") not in (None, *METRICS):
+            raise ValueError(f"trigger {trigger.get('name')}: unknown metric {trigger['metric']}")
+    return triggers
+
+
+class RollingWindow:
+    """
+    Count, mean, min, max, percentiles and EWMA of one metric over the last span seconds, without the samples:
+    they are summed into WINDOW_BUCKETS time buckets and one histogram. Adding a sample is O(1), and a bucket
+    leaving the window is subtracted once. Percentiles are exact to the bin width of the metric
+    """
+    def __init__(self, span, bins, buckets=WINDOW_BUCKETS):
+        self.span = span
+        self.width = span / buckets
+        self.nbuckets = buckets
+        self.low, high, self.step = bins
+        self.counts = [0] * (int(round((high - self.low) / self.step)) + 1)
+        self.buckets = collections.deque()  # [bucket index, count, total, minimum, maximum, {bin: count}]
+        self.count = 0
+        self.total = 0.0
+        self.ewma = None  # Time constant span, so irregular samples weigh by their gap
+        self.last = None
+
+    def bin(self, value):
+        return min(len(self.counts) - 1, max(0, int(round((value - self.low) / self.step))))
+
+    def add(self, t, value):
+        index = int(t // self.width)
+        if not self.buckets or self.buckets[-1][0] != index:
+            self.expire(t)  # Only a new bucket can push an old one out
+            self.buckets.append([index, 0, 0.0, math.inf, -math.inf, {}])
+        bucket = self.buckets[-1]
+        bucket[1] += 1
+        bucket[2] += value
+        bucket[3] = min(bucket[3], value)
+        bucket[4] = max(bucket[4], value)
+        k = self.bin(value)
+        bucket[5][k] = bucket[5].get(k, 0) + 1
+        self.counts[k] += 1
+        self.count += 1
+        self.total += value
+        if self.ewma is None:
+            self.ewma = value
+        elif t > self.last:
+            self.ewma += (1 - math.exp(-(t - self.last) / self.span)) * (value - self.ewma)
+        self.last = t
+
+    def expire(self, t):
+        oldest = int(t // self.width) - self.nbuckets + 1
+        while self.buckets and self.buckets[0][0] < oldest:
+            _, count, total, _, _, histogram = self.buckets.popleft()
+            self.count -= count
+            self.total -= total
+            for k, n in histogram.items():
+                self.counts[k] -= n
+        if not self.buckets:
+            self.total = 0.0  # No float drift carried over an empty window
+
+    def percentile(self, share):
+        rank = share * self.count
+        seen = 0
+        for k, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self.low + k * self.step
+        return None
+
+    def stats(self, t):
+        """
+        {"count", "mean", "min", "max", "p10", "p50", "p90", "ewma"}, values None while the window is empty
+        """
+        self.expire(t)
+        if not self.count:
+            return dict({"count": 0, "mean": None, "min": None, "max": None, "ewma": self.ewma},
+                        **{f"p{p}": None for p in PERCENTILES})
+        low, high = min(b[3] for b in self.buckets), max(b[4] for b in self.buckets)
+        stats = {"count": self.count, "mean": round(self.total / self.count, 2), "min": low, "max": high}
+        for p in PERCENTILES:
+            stats[f"p{p}"] = min(high, max(low, self.percentile(p / 100)))  # No further out than a sample
+        stats["ewma"] = round(self.ewma, 2)
+        return stats
+
+
+class SignalAnalytics:
+    """
+    Rolling statistics of decoded AT^HCSQ? samples over several windows, serving cell changes
+    of AT^HFREQINFO? and degradation triggers. Memory does not grow with the number of samples.
+    on_event is called with each event dict: {"event": "degraded", "trigger", ...} or {"event": "cell_change", ...}
+    """
+    def __init__(self, windows=WINDOWS, triggers=(), on_event=None):
+        self.windows = windows
+        self.metrics = {name: {span: RollingWindow(span, bins) for span in windows} for name, bins in METRICS.items()}
+        self.triggers = [dict(trigger) for trigger in triggers]
+        for trigger in self.triggers:
+            if trigger.get("window") is not None and trigger["window"] not in windows:
+                raise ValueError(f"trigger {trigger.get('name')}: window {trigger['window']} is not one of {windows}")
+            trigger.setdefault("name", trigger.get("event") or f"{trigger['metric']}_{trigger.get('stat', 'mean')}")
+            trigger["armed"] = True
+            trigger["fired"] = -math.inf
+        self.on_event = on_event
+        self.cell = None  # Serving carriers of the last AT^HFREQINFO?
+        self.samples = 0
+
+    def add_signal(self, signal, t=None):
+        """
+        Add one decoded AT^HCSQ? result (at.py query or livestatus snapshot dict, or atparse Signal.to_dict())
+        Non-numeric values (unknown, no service, an error) are left out and counted as "missing"
+        Returns the events fired
+        """
+        t = time.time() if t is None else t
+        self.samples += 1
+        for name, windows in self.metrics.items():
+            if name == "missing":
+                value = 0 if isinstance(signal.get("rsrp"), (int, float)) else 1
+            else:
+                value = signal.get(name)
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+            for window in windows.values():
+                window.add(t, value)
+        return self.check(t)
+
+    def add_ccinfo(self, ccinfo, t=None):
+        """
+        Add one decoded AT^HFREQINFO? result, fires "cell_change" when the serving carriers differ from the last ones
+        """
+        t = time.time() if t is None else t
+        if "error" in ccinfo:
+            return []
+        cell = [f"{carrier.get('sysmode')} band {carrier.get('band_class')} arfcn {carrier.get('dl_fcn')}"
+                for carrier in ccinfo.get("carriers", [])]
+        previous, self.cell = self.cell, cell
+        if previous is None or previous == cell:
+            return []
+        return self.fire({"event": "cell_change", "time": t, "from": previous, "to": cell})
+
+    def value(self, trigger, t):
+        window = self.metrics[trigger["metric"]][trigger.get("window", self.windows[0])]
+        stats = window.stats(t)
+        if stats["count"] < trigger.get("min_count", 1):
+            return None
+        return stats[trigger.get("stat", "mean")]
+
+    def check(self, t):
+        events = []
+        for trigger in self.triggers:
+            if "event" in trigger:
+                continue
+            value = self.value(trigger, t)
+            holds = value is not None and (("below" in trigger and value < trigger["below"]) or
+                                           ("above" in trigger and value > trigger["above"]))
+            if not holds:
+                trigger["armed"] = True
+            elif trigger["armed"] and t - trigger["fired"] >= trigger.get("cooldown", TRIGGER_COOLDOWN):
+                trigger["armed"], trigger["fired"] = False, t
+                events.append(self.emit(trigger, {
+                    "event": "degraded", "trigger": trigger["name"], "time": t, "metric": trigger["metric"],
+                    "window": trigger.get("window", self.windows[0]), "stat": trigger.get("stat", "mean"),
+                    "value": value, "threshold": trigger.get("below", trigger.get("above"))}))
+        return events
+
+    def fire(self, event):
+        """
+        Fire every trigger of the kind of event that is out of its cooldown, or pass the event on as is
+        """
+        events = []
+        for trigger in self.triggers:
+            if trigger.get("event") == event["event"] and \
+                    event["time"] - trigger["fired"] >= trigger.get("cooldown", 0):
+                trigger["fired"] = event["time"]
+                events.append(self.emit(trigger, dict(event, trigger=trigger["name"])))
+        return events or [self.emit(None, event)]
+
+    def emit(self, trigger, event):
+        """
+        Pass event to on_event with the trigger it fired, None for none
+        """
+        if self.on_event is not None:
+            self.on_event(event, trigger)
+        return event
+
+    def summary(self, t=None):
+        """
+        {metric: {"<span>s": RollingWindow.stats()}} of every metric and window
+        """
+        t = time.time() if t is None else t
+        return {name: {f"{span}s": window.stats(t) for span, window in windows.items()}
+                for name, windows in self.metrics.items()}
+
+
+class Actions:
+    """
+    What a firing trigger does in the analytics daemon, by its "action": log, exec, relock or restart
+    """
+    def __init__(self, manager, dry_run=False, log=print):
+        self.manager = manager
+        self.dry_run = dry_run
+        self.log = log
+
+    def __call__(self, event, trigger):
+        if trigger is None:
+            self.log(f"{event['event']}: " + ", ".join(f"{key}={value}" for key, value in event.items() if key != "event"))
+            return
+        action = trigger.get("action", "log")
+        self.log(f"Trigger {trigger['name']}: " + ", ".join(f"{key}={value}" for key, value in event.items()
+                                                          if key not in ("event", "trigger")))
+        if action == "log" or self.dry_run:
+            return
+        handler = getattr(self, f"do_{action}", None)
+        if handler is None:
+            self.log(f"Trigger {trigger['name']}: unknown action {action}")
+            return
+        handler(event, trigger)
+
+    def do_exec(self, event, trigger):
+        subprocess.Popen(trigger["command"], shell=True, env=dict(os.environ, ANALYTICS_EVENT=json.dumps(event)))
+
+    def do_relock(self, event, trigger):
+        """
+        Lock the cells locked now again (the default cell when none), restart and wait for service
+        """
+        from workflow import Workflow, restart_steps
+        lock = self.manager.lockstatus()
+        cells = [cell for cell in lock.get("cells", []) if len(cell) == 4]
+        command = self.manager.lock_command(cells) if cells else self.manager.at_commands["lock_cell_default"]
+        report = Workflow(self.manager, restart_steps(self.manager, command), log=self.log).run()
+        self.log(f"Relock {report['state']} in {report['elapsed']}s" + (f": {report['error']}" if report["error"] else ""))
+
+    def do_restart(self, event, trigger):
+        from workflow import Workflow, restart_steps
+        report = Workflow(self.manager, restart_steps(self.manager), log=self.log).run()
+        self.log(f"Restart {report['state']} in {report['elapsed']}s" + (f": {report['error']}" if report["error"] else ""))
+
+
+def show(summary, fmt, t):
+    if fmt == "ndjson":
+        print(json.dumps({"time": t, "summary": summary}), flush=True)
+        return
+    stamp = time.strftime("%H:%M:%S", time.localtime(t))
+    for span in next(iter(summary.values())):
+        parts = []
+        for name in ("rsrp", "sinr", "rsrq"):
+            stats = summary[name][span]
+            if stats["count"]:
+                parts.append(f"{name} {stats['mean']} [{stats['min']}, {stats['max']}] p50 {stats['p50']} "
+                             f"ewma {stats['ewma']}")
+        missing = summary["missing"][span]
+        share = f", missing {round(100 * missing['mean'])}%" if missing["count"] else ""
+        print(f"{stamp} {span:>5} n={summary['rsrp'][span]['count']}{share}: " + (" | ".join(parts) or "no signal"),
+              flush=True)
+
+
+def main():
+    from at import CellularManager, SOCKET_FILE
+    from livestatus import STATUS_FILE
+    parser = argparse.ArgumentParser(description="Rolling signal statistics and degradation triggers for MT5700M")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL, help="seconds between samples")
+    parser.add_argument("--report", type=float, default=REPORT_INTERVAL, help="seconds between summaries")
+    parser.add_argument("--windows", default=",".join(map(str, WINDOWS)),
+                        help="comma-separated rolling windows in seconds (default: %(default)s)")
+    parser.add_argument("--triggers", help="JSON file replacing the default TRIGGERS")
+    parser.add_argument("--dry-run", action="store_true", help="log firing triggers without running their action")
+    parser.add_argument("--format", choices=["text", "ndjson"], default="text")
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path of ats.py")
+    parser.add_argument("--status", default=STATUS_FILE, help="live status file of ats.py (default: %(default)s)")
+    parser.add_argument("--modem", help="modem id of a fleet broker")
+    args = parser.parse_args()
+
+    try:
+        windows = tuple(sorted(int(span) for span in args.windows.split(",")))
+        triggers = load_triggers(args.triggers)
+        manager = CellularManager(args.socket, "telemetry", args.modem)
+        if args.format == "ndjson":
+            def log(message):
+                print(json.dumps({"time": time.time(), "log": message}), flush=True)
+        else:
+            log = print
+        actions = Actions(manager, args.dry_run, log)
+
+        def on_event(event, trigger):
+            if args.format == "ndjson":
+                print(json.dumps(event), flush=True)
+            if trigger is not None or args.format == "text":
+                actions(event, trigger)
+        analytics = SignalAnalytics(windows, triggers, on_event)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    last_signal = None
+    next_report = time.monotonic() + args.report
+    try:
+        while True:
+            results = manager.snapshot(["signal", "ccinfo"], status_file=args.status)
+            now = time.time()
+            signal = results["signal"]
+            if signal.get("time") is None or signal["time"] != last_signal:  # Only new readings of the live status
+                last_signal = signal.get("time")
+                analytics.add_signal(signal, now)
+            analytics.add_ccinfo(results["ccinfo"], now)
+            if time.monotonic() >= next_report:
+                next_report += args.report
+                show(analytics.summary(now), args.format, now)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
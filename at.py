@@ -1,12 +1,314 @@
+import argparse
 import time
+import itertools
+import json
+import os
 import socket
+import sqlite3
+import sys
+import threading
 from tabulate import tabulate
+import atparse
+from livestatus import STATUS_FILE, STATUS_STALE, StatusReader
+from cellscan import CELL_FIELDS, CellScanTable, lte_arfcn, nr_arfcn
+from cellselect import CellSelector
+from scanstore import SCAN_DB, ScanStore
+from workflow import SERVICE_TIMEOUT, Workflow, restart_steps
 
 # Unix Domain Socket 文件路径
 SOCKET_FILE = "/tmp/at_socket.sock"
+SESSION_TIMEOUT = 120  # Max time to wait for a broker reply (seconds)
+SCAN_DEADLINE = 180  # Max time for a cell scan (seconds)
+SCAN_ATTEMPTS = 5  # Max AT^CELLSCAN=3 attempts per scan
+SCAN_RETRY_DELAY = 2  # Delay between failed scan commands (seconds)
+STATUS_MAX_AGE = 10  # snapshot() queries the broker for live status values older than this (seconds)
+# Remote ats.py (--listen): a "tcp://HOST[:PORT]" broker address instead of the socket file, token from AT_TOKEN
+REMOTE_PORT = 20251  # Port of a tcp:// address without one
+REMOTE_POOL_SIZE = 4  # Idle authenticated connections kept per remote broker and token
+REMOTE_POOL_IDLE = 60  # Pooled connections idle longer are closed rather than reused, below the ats.py idle timeout (seconds)
+TOKEN_ENV = "AT_TOKEN"  # Environment variable of the token of a remote broker
+
+# Read-only queries of the library API / CLI, each decoded by the atparse parser of its response name
+QUERIES = {
+    "signal": "AT^HCSQ?",
+    "ccinfo": "AT^HFREQINFO?",
+    "lockstatus": "AT^NRFREQLOCK?",
+    "temp": "AT^CHIPTEMP?",
+}
+
+class BrokerSession:
+    """
+    Persistent connection to ats.py speaking the framed protocol
+    Requests and replies are newline-delimited JSON tagged with a request id
+    """
+    def __init__(self, socket_file=SOCKET_FILE, timeout=SESSION_TIMEOUT, modem=None):
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self.modem = modem  # Modem id, "*" or a list of ids the requests are routed to, None for the first modem
+        self.sock = None
+        self.reader = None
+        self.ids = itertools.count(1)
+
+    def connect(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_file)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+            self.reader = sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+    def interrupt(self):
+        """
+        End a blocking events() or scan() stream from another thread
+        """
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def request(self, requests):
+        """
+        Send a batch of requests in one write and yield (index, reply) as the tagged replies come back
+        Each request is a dict such as {"cmd": "AT^HCSQ?"}, the id is filled in here
+        """
+        self.connect()
+        pending = {}
+        lines = []
+        for index, request in enumerate(requests):
+            request = dict(request, id=next(self.ids))
+            if self.modem is not None:
+                request.setdefault("modem", self.modem)
+            pending[request["id"]] = index
+            lines.append(json.dumps(request) + "\n")
+        try:
+            self.sock.sendall("".join(lines).encode())
+            while pending:
+                line = self.reader.readline()
+                if not line:
+                    raise ConnectionError("Broker closed the connection")
+                reply = json.loads(line)
+                index = pending.pop(reply.get("id"), None)
+                if index is not None:  # Replies to an abandoned batch are skipped
+                    yield index, reply
+        except Exception:
+            self.close()
+            raise
+
+    def events(self, names=None):
+        """
+        Subscribe to URCs (all of them when names is empty) and yield each event as a dict
+        Blocks until the broker closes the connection, use a session of its own
+        """
+        self.connect()
+        self.sock.settimeout(None)
+        request_id = next(self.ids)
+        request = {"id": request_id, "op": "subscribe", "events": list(names or ()), "modem": self.modem}
+        try:
+            self.sock.sendall((json.dumps(request) + "\n").encode())
+            while True:
+                line = self.reader.readline()
+                if not line:
+                    raise ConnectionError("Broker closed the connection")
+                message = json.loads(line)
+                if message.get("id") == request_id and "event" in message:
+                    yield message
+        finally:
+            self.close()
+
+    def scan(self, deadline=SCAN_DEADLINE, attempts=SCAN_ATTEMPTS):
+        """
+        Run a cell scan job in ats.py and yield its messages: the job status,
+        one {"cell": line} per ^CELLSCAN: line as it arrives, then the final status with all cells.
+        Routed to several modems, the statuses are {"units": {modem id: status}} and cells carry their "modem"
+        """
+        self.connect()
+        self.sock.settimeout(None)  # The broker ends the job at its deadline
+        request_id = next(self.ids)
+        request = {"id": request_id, "op": "scan", "stream": True, "deadline": deadline, "attempts": attempts,
+                   "modem": self.modem}
+        try:
+            self.sock.sendall((json.dumps(request) + "\n").encode())
+            while True:
+                line = self.reader.readline()
+                if not line:
+                    raise ConnectionError("Broker closed the connection")
+                message = json.loads(line)
+                if message.get("id") != request_id:
+                    continue
+                yield message
+                statuses = message["units"].values() if "units" in message else [message]
+                if "error" in message or all(status.get("state") in ("done", "failed") or "error" in status
+                                             for status in statuses):
+                    return
+        finally:
+            self.close()
+
+    def execute(self, commands, timeout=None, priority=None, parse=False):
+        """
+        Run a batch of AT commands, return the replies in command order
+        priority is the scheduler class in ats.py (interactive, control, telemetry, scan), None lets it choose
+        parse asks ats.py for the "parsed" atparse record of each response, decoded once there and shared
+        """
+        requests = [{"cmd": command} for command in commands]
+        for request in requests:
+            if timeout is not None:
+                request["timeout"] = timeout
+            if priority is not None:
+                request["priority"] = priority
+            if parse:
+                request["parse"] = True
+        replies = [None] * len(requests)
+        for index, reply in self.request(requests):
+            replies[index] = reply
+        return replies
+
+def remote_address(socket_file):
+    """
+    (host, port) of a "tcp://HOST[:PORT]" broker address, None for a Unix socket path
+    """
+    if not socket_file.startswith("tcp://"):
+        return None
+    host, sep, port = socket_file[len("tcp://"):].rpartition(":")
+    if not sep or not port.isdigit() or (":" in host and not host.endswith("]")):  # A bare IPv6 address
+        host, port = socket_file[len("tcp://"):], ""
+    return host.strip("[]"), int(port) if port else REMOTE_PORT
+
+class RemotePool:
+    """
+    Authenticated TCP connections to remote ats.py gateways, kept open between batches
+    and shared by every RemoteSession of the process with the same address and token
+    """
+    def __init__(self, size=REMOTE_POOL_SIZE, max_idle=REMOTE_POOL_IDLE):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = {}  # (host, port, token) -> [(sock, reader, released at), ...]
+        self.lock = threading.Lock()
+
+    def acquire(self, key, timeout):
+        """
+        (sock, reader, reused) of the latest idle connection of key, or of a new one
+        """
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                sock, reader, released = connections.pop()
+                if now - released < self.max_idle:
+                    sock.settimeout(timeout)
+                    return sock, reader, True
+                reader.close()
+                sock.close()
+        return self.connect(key, timeout) + (False,)
+
+    def connect(self, key, timeout):
+        """
+        Open and authenticate a connection, PermissionError when the gateway refuses the token
+        """
+        host, port, token = key
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            reader = sock.makefile("rb")
+            sock.sendall((json.dumps({"id": 0, "op": "auth", "token": token}) + "\n").encode())
+            line = reader.readline()
+            try:
+                reply = json.loads(line) if line else {"error": "connection closed"}
+            except ValueError:
+                raise ConnectionError(f"{host}:{port} is not an ats.py gateway")
+            if "error" in reply:
+                raise PermissionError(f"{host}:{port} refused the connection: {reply['error']}")
+        except Exception:
+            sock.close()
+            raise
+        return sock, reader
+
+    def release(self, key, sock, reader):
+        """
+        Keep a connection without pending replies for the next batch, close it when the pool of key is full
+        """
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append((sock, reader, time.monotonic()))
+                return
+        reader.close()
+        sock.close()
+
+REMOTE_POOL = RemotePool()
+
+class RemoteSession(BrokerSession):
+    """
+    BrokerSession to the TCP gateway of a remote ats.py, socket_file "tcp://HOST[:PORT]"
+    Its connection goes back to REMOTE_POOL after each batch, events() and scan() keep theirs until they end
+    """
+    def __init__(self, socket_file, timeout=SESSION_TIMEOUT, modem=None, token=None, pool=REMOTE_POOL):
+        super().__init__(socket_file, timeout, modem)
+        token = token or os.environ.get(TOKEN_ENV)
+        if not token:
+            raise ValueError(f"{socket_file} needs a token, set {TOKEN_ENV}")
+        self.key = remote_address(socket_file) + (token,)
+        self.pool = pool
+        self.reused = False
+
+    def connect(self):
+        if self.sock is None:
+            self.reused = False  # A failed connection attempt is not retried
+            self.sock, self.reader, self.reused = self.pool.acquire(self.key, self.timeout)
+
+    def request(self, requests):
+        """
+        BrokerSession.request(), sent once more on a new connection when a pooled one turns out closed
+        (the gateway reaps idle connections) before any reply
+        """
+        requests = list(requests)
+        while True:
+            replied = False
+            try:
+                for item in super().request(requests):
+                    replied = True
+                    yield item
+                break
+            except ValueError as e:
+                raise ConnectionError(f"Bad reply from {self.socket_file}: {e}")
+            except OSError:
+                if replied or not self.reused:
+                    raise
+        self.pool.release(self.key, self.sock, self.reader)
+        self.sock = None
+        self.reader = None
+
+def open_session(socket_file=SOCKET_FILE, timeout=SESSION_TIMEOUT, modem=None, token=None):
+    """
+    BrokerSession to ats.py at socket_file: its Unix socket path, or "tcp://HOST[:PORT]" of its remote gateway
+    """
+    if remote_address(socket_file) is not None:
+        return RemoteSession(socket_file, timeout, modem, token)
+    return BrokerSession(socket_file, timeout, modem)
 
 class CellularManager:
-    def __init__(self):
+    def __init__(self, socket_file=SOCKET_FILE, priority=None, modem=None, scan_db=None, token=None):
+        self.socket_file = socket_file
+        self.scan_db = scan_db  # SQLite scan history every scan is appended to (scanstore.py), None for none
+        self.modem = modem  # Modem id in a fleet broker, None for its first modem
+        self.token = token  # Token of a remote "tcp://" broker, None takes it from AT_TOKEN
+        self.remote = remote_address(socket_file) is not None
+        self.session = open_session(socket_file, modem=modem, token=token)
+        self.framed = True  # Cleared when ats.py only speaks the raw-string protocol
+        self.priority = priority  # Scheduler class of every command sent, None lets ats.py choose
+        self.status = None  # livestatus.StatusReader of the broker, opened by the first snapshot()
         # Dictionary of AT commands for various operations
         self.at_commands = {
             "view_5g_nr_cc_status": "AT^HFREQINFO?",
@@ -66,21 +368,52 @@ class CellularManager:
         """
         Send AT command and receive response
         """
+        return self.send_commands([command])[0]
+
+    def send_commands(self, commands):
+        """
+        Send a batch of AT commands over the persistent broker session
+        Returns the responses in command order, None for a command that failed
+        """
+        return [reply.get("response") for reply in self.send_replies(commands)]
+
+    def send_replies(self, commands, parse=False):
+        """
+        send_commands() returning the broker reply of each command, {"response": ...} over the raw protocol
+        """
+        if self.framed:
+            try:
+                replies = self.session.execute(commands, priority=self.priority, parse=parse)
+                for reply in replies:
+                    if "error" in reply:
+                        print(f"Error: {reply['error']}")
+                return replies
+            except ValueError:  # Never from a RemoteSession, the gateway has no raw protocol
+                print("Broker does not support the framed protocol, sending raw commands")
+                self.framed = False
+            except Exception as e:
+                print(f"Error: {e}")
+                return [{"error": str(e)} for _ in commands]
+        return [{"response": self.send_raw_command(command)} for command in commands]
+
+    def send_raw_command(self, command):
+        """
+        Send AT command on a new connection with the raw-string protocol and receive response
+        """
         try:
             with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect(SOCKET_FILE)
+                client_socket.connect(self.socket_file)
                 # 发送命令
                 client_socket.sendall(command.encode())
                 # 接收响应
-                response = bytearray()
+                # Both brokers close the connection after the reply, a long one arrives as it is read from the modem
+                chunks = []
                 while True:
-                    data = client_socket.recv(4096)
+                    data = client_socket.recv(65536)
                     if not data:
                         break
-                    response.extend(data)
-                    if b"No response received from server" in response:
-                        break
-                decoded_response = response.decode()
+                    chunks.append(data)
+                decoded_response = b"".join(chunks).decode(errors='ignore')
                 if decoded_response:
                     return decoded_response
         except Exception as e:
@@ -93,44 +426,10 @@ class CellularManager:
         Sends AT^HFREQINFO? command to get information about 5G NR and LTE carrier components
         """
         response = self.send_command(self.at_commands.get("view_5g_nr_cc_status", ""))
-        if response and "^HFREQINFO:" in response:
-            response = response.split("^HFREQINFO:")[1].split("\r\nOK\r\n")[0]  # 去除响应中的 \r\n\r\nOK
-            records = response.split(",")
-
-            proa, sysmode = map(int, records[:2])  # 取出前两个字段作为 proa 和 sysmode
-            records = records[2:]
-
-            nr_records = [
-                {
-                    "proa": proa,
-                    "sysmode": "NR",
-                    "band_class": band_class,
-                    "dl_fcn": dl_fcn,
-                    "dl_freq": dl_freq,
-                    "dl_bw": dl_bw,
-                    "ul_fcn": ul_fcn,
-                    "ul_freq": ul_freq,
-                    "ul_bw": ul_bw,
-                }
-                for band_class, dl_fcn, dl_freq, dl_bw, ul_fcn, ul_freq, ul_bw in [records[i:i+7] for i in range(0, len(records), 7)]
-                if sysmode == 7
-            ]
-
-            lte_records = [
-                {
-                    "proa": proa,
-                    "sysmode": "LTE",
-                    "band_class": band_class,
-                    "dl_fcn": dl_fcn,
-                    "dl_freq": dl_freq,
-                    "dl_bw": dl_bw,
-                    "ul_fcn": ul_fcn,
-                    "ul_freq": ul_freq,
-                    "ul_bw": ul_bw,
-                }
-                for band_class, dl_fcn, dl_freq, dl_bw, ul_fcn, ul_freq, ul_bw in [records[i:i+7] for i in range(0, len(records), 7)]
-                if sysmode == 6
-            ]
+        ccinfo = self.parse_ccinfo(response) if response else None
+        if ccinfo:
+            nr_records = [record for record in ccinfo["carriers"] if record["sysmode"] == "NR"]
+            lte_records = [record for record in ccinfo["carriers"] if record["sysmode"] == "LTE"]
 
             if nr_records:
                 print(self.colorize("📈 5G NR CC Status:📈",color='black',background='white'))
@@ -142,7 +441,7 @@ class CellularManager:
                 print("\n📈 LTE CC Status:📈")
                 for record in lte_records:
                     print(self.colorize(f"{record}"))
-                print(self.colorize(f"{len(lte_records)} NR CC{'s' if len(lte_records) != 1 else ''} detected"))
+                print(self.colorize(f"{len(lte_records)} LTE CC{'s' if len(lte_records) != 1 else ''} detected"))
 
             if not nr_records and not lte_records:
                 print("No NR or LTE CC records found")
@@ -150,61 +449,121 @@ class CellularManager:
         else:
             print("Invalid response format")
 
+    def parse_ccinfo(self, response):
+        """
+        Decode an AT^HFREQINFO? response
+        Returns {"proa": .., "sysmode": "NR"/"LTE"/.., "carriers": [record, ...]}, or None if the format is invalid
+        """
+        return self.decode("ccinfo", response)
+
+    def decode(self, name, response):
+        """
+        Decode the response of QUERIES[name] with the atparse registry, return the record as a dict or None
+        """
+        record = atparse.parse(QUERIES[name][2:].rstrip("?"), response)
+        return record.to_dict() if record is not None else None
+
     def view_signal(self):
         """
         View signal strength and quality
         Sends AT^HCSQ? command to get information about signal strength and quality
         """
         response = self.send_command(self.at_commands.get("view_signal", ""))
-        if response and "^HCSQ:" in response:
-            response = response.split("^HCSQ:")[1].split("\r\nOK\r\n")[0]  # 去除响应中的 \r\n\r\nOK
-            fields = response.strip('"').split('","')
-            if len(fields) == 1:
-                fields = fields[0].split(",")
-            if len(fields) >= 4:
-                sysmode, rsrp, sinr, rsrq = fields
-                sysmode = sysmode.strip('"')  # 去除 sysmode 中的引号
-
-                # 转换 rsrp 值
-                if rsrp == "255":
-                    rsrp_value = "未知或不可测"
-                else:
-                    rsrp_value = -140 + int(rsrp)
+        signal = self.parse_signal(response) if response else None
+        if signal and signal["rsrp"] is None and signal["sysmode"] == "NOSERVICE":
+            print(self.colorize(f"System Mode: {signal['sysmode']}"))
+        elif signal:
+            rsrp_value, sinr_value, rsrq_value = self.decode_signal(*signal["raw"][1:4])
 
-                # 转换 sinr 值
-                if sinr == "255":
-                    sinr_value = "未知或不可测"
-                elif sinr == "251":
-                    sinr_value = "≥ 30.0 dB"
-                else:
-                    sinr_value = "{:.1f} dB".format(-20 + int(sinr) * 0.2)
+            print(self.colorize("📶Cell Signal Status: 📶",color='black',background='white'))
+            print(self.colorize(f"System Mode: {signal['sysmode']}"))
+            print(self.colorize(f"5g_rsrp: {rsrp_value} dBm"))
+            print(self.colorize(f"5g_rsrq: {rsrq_value} dB"))
+            print(self.colorize(f"5g_sinr: {sinr_value}"))
+        else:
+            print("Invalid response format")
 
-                # 转换 rsrq 值
-                if rsrq == "255":
-                    rsrq_value = "未知或不可测"
-                elif rsrq == "34":
-                    rsrq_value = "≥ -3 dB"
-                else:
-                    rsrq_value = -19.5 + int(rsrq) * 0.5
+    def parse_signal(self, response):
+        """
+        Decode an AT^HCSQ? response
+        Returns {"sysmode", "rsrp" (dBm), "sinr" (dB), "rsrq" (dB), "rssi" (dBm, LTE only), "raw"},
+        or None if the format is invalid
+        Unknown values are None, capped ones (sinr 251, rsrq 34) are reported at their cap
+        """
+        return self.decode("signal", response)
 
-                print(self.colorize("📶Cell Signal Status: 📶",color='black',background='white'))
-                print(self.colorize(f"System Mode: {sysmode}"))
-                print(self.colorize(f"5g_rsrp: {rsrp_value} dBm"))
-                print(self.colorize(f"5g_rsrq: {rsrq_value} dB"))
-                print(self.colorize(f"5g_sinr: {sinr_value}"))
-            else:
-                print("Invalid response format")
+    def decode_signal(self, rsrp, sinr, rsrq):
+        """
+        Convert raw AT^HCSQ rsrp, sinr and rsrq fields to dBm / dB values
+        Returns (rsrp_value, sinr_value, rsrq_value)
+        """
+        rsrp, sinr, rsrq = (str(value).strip().strip('"') for value in (rsrp, sinr, rsrq))
+
+        # 转换 rsrp 值
+        if rsrp == "255":
+            rsrp_value = "未知或不可测"
         else:
-            print("Invalid response format")
+            rsrp_value = -140 + int(rsrp)
 
-    def restart_cellular(self):
+        # 转换 sinr 值
+        if sinr == "255":
+            sinr_value = "未知或不可测"
+        elif sinr == "251":
+            sinr_value = "≥ 30.0 dB"
+        else:
+            sinr_value = "{:.1f} dB".format(-20 + int(sinr) * 0.2)
+
+        # 转换 rsrq 值
+        if rsrq == "255":
+            rsrq_value = "未知或不可测"
+        elif rsrq == "34":
+            rsrq_value = "≥ -3 dB"
+        else:
+            rsrq_value = -19.5 + int(rsrq) * 0.5
+
+        return rsrp_value, sinr_value, rsrq_value
+
+    def watch_signal(self):
+        """
+        Watch signal changes reported by the modem
+        Subscribes to ^HCSQ and ^MODE URCs through ats.py instead of polling AT^HCSQ?, Ctrl+C to stop
+        """
+        print(self.colorize("📶Watching Cell Signal, Ctrl+C to stop 📶", color='black', background='white'))
+        session = self.event_session()
+        try:
+            for event in session.events(["^HCSQ", "^MODE"]):
+                stamp = time.strftime("%H:%M:%S", time.localtime(event["time"]))
+                # Brokers with the atparse registry send the decoded record, with the LTE RSSI field skipped
+                parsed = event.get("parsed") or {}
+                fields = parsed.get("raw") or event["fields"]
+                if event["event"] == "^HCSQ" and len(fields) >= 4:
+                    rsrp_value, sinr_value, rsrq_value = self.decode_signal(*fields[1:4])
+                    print(self.colorize(f"{stamp} {fields[0]} rsrp: {rsrp_value} dBm, rsrq: {rsrq_value} dB, sinr: {sinr_value}"))
+                else:
+                    print(self.colorize(f"{stamp} {event['line']}"))
+        except KeyboardInterrupt:
+            print("Stop watching signal.")
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def event_session(self):
+        """
+        A BrokerSession of its own for events(), which keeps its connection busy until interrupted
+        """
+        return open_session(self.socket_file, modem=self.modem, token=self.token)
+
+    def restart_cellular(self, command=None):
         """
         Restart cellular module
-        Sends AT+CFUN=1,1 command to restart the cellular module
+        Sends command first if given (a lock or unlock), then AT+CFUN=1,1, and waits until the module serves again
         """
-        response = self.send_command(self.at_commands["restart_cellular"])
-        if response:
-            print(f"Cell Restart Response: {response}")
+        report = Workflow(self, restart_steps(self, command)).run()
+        if report["service_s"] is not None:
+            print(self.colorize(f"✅ Service restored after {report['service_s']}s "
+                                f"({report['elapsed']}s in total)."))
+        else:
+            print(self.colorize(f"❌ {report['error']}"))
+        return report
 
     def check_lock_status(self):
         """
@@ -212,16 +571,27 @@ class CellularManager:
         Sends AT^NRFREQLOCK? command to check if a cell is currently locked
         """
         response = self.send_command(self.at_commands["check_lock_status"])
-        if response and "^NRFREQLOCK:" in response:
-            lock_status_lines = response.split("^NRFREQLOCK:")[1].split("\r\n\r\nOK")[0].split("\n")
-            if len(lock_status_lines) > 3:
-                locked_cell_info = lock_status_lines[2].rstrip('\r')
-                print(self.colorize(f"🔒 Lock Results: {locked_cell_info}"))
-            else:
-                print(self.colorize(f"🔒 Lock Results: None"))
+        lockstatus = self.parse_lockstatus(response) if response else None
+        if lockstatus:
+            print(self.colorize(f"🔒 Lock Results: {lockstatus['cell']}"))
         else:
             print("Invalid response format")
 
+    def parse_lockstatus(self, response):
+        """
+        Decode an AT^NRFREQLOCK? response
+        Returns {"locked": bool, "cell": first locked cell line or None, "fields": [...] of that line,
+        "cells": [[band, arfcn, scs, pci], ...] of every locked cell}, or None if the format is invalid
+        """
+        return self.decode("lockstatus", response)
+
+    def parse_temp(self, response):
+        """
+        Decode an AT^CHIPTEMP? response
+        Returns {"temp_c": chip temperature in °C, "raw": [...]}, or None if the format is invalid
+        """
+        return self.decode("temp", response)
+
     def lock_cell(self):
         """
         Lock to a specific cell
@@ -240,27 +610,19 @@ class CellularManager:
         if cell_choice == "1":
             confirm = input("Are you sure you want to lock cell 16 (ARFCN 627264)? (Y/N): ")
             if confirm.upper() == "Y":
-                response = self.send_command(self.at_commands["lock_cell_16"])
-                if response and "OK" in response:
-                    self.restart_cellular()
+                self.restart_cellular(self.at_commands["lock_cell_16"])
         if cell_choice == "2":
             confirm = input("Are you sure you want to lock cell 579 (ARFCN 627264)? (Y/N): ")
             if confirm.upper() == "Y":
-                response = self.send_command(self.at_commands["lock_cell_579_627264"])
-                if response and "OK" in response:
-                    self.restart_cellular()
+                self.restart_cellular(self.at_commands["lock_cell_579_627264"])
         elif cell_choice == "3":
             confirm = input("Are you sure you want to lock cell 334 (ARFCN 627264)? (Y/N): ")
             if confirm.upper() == "Y":
-                response = self.send_command(self.at_commands["lock_cell_334_627264"])
-                if response and "OK" in response:
-                    self.restart_cellular()
+                self.restart_cellular(self.at_commands["lock_cell_334_627264"])
         elif cell_choice == "4":
             confirm = input("Are you sure you want to lock cell 334 (ARFCN 633984)? (Y/N): ")
             if confirm.upper() == "Y":
-                response = self.send_command(self.at_commands["lock_cell_334_633984"])
-                if response and "OK" in response:
-                    self.restart_cellular()
+                self.restart_cellular(self.at_commands["lock_cell_334_633984"])
         elif cell_choice == "5":
             print("Exiting...")
         else:
@@ -282,16 +644,16 @@ class CellularManager:
             print("\n🖥️  Other Command:")
             print("1. 🌡️  Chip Temperature")
             print("2. 💻 Manually Command")
-            print("3. Exit")
+            print("3. 📡 Watch Signal")
+            print("4. Exit")
 
-            choice = input("Enter your choice (1-3): ")
+            choice = input("Enter your choice (1-4): ")
 
             if choice == "1":
                 response = self.send_command("AT^CHIPTEMP?")
-                if response and "^CHIPTEMP:" in response:
-                    temp_values = response.split("^CHIPTEMP:")[1].split(",")
-                    temp_value = int(temp_values[0])
-                    formatted_temp = f"{temp_value / 10}°C"
+                temp = self.parse_temp(response) if response else None
+                if temp:
+                    formatted_temp = f"{temp['temp_c']}°C"
                     print(self.colorize(f"Chip Temperature: {formatted_temp}"))
                 else:
                     print("No response received or invalid response format.")
@@ -303,6 +665,8 @@ class CellularManager:
                 else:
                     print("No response received.")
             elif choice == "3":
+                self.watch_signal()
+            elif choice == "4":
                 print("Exiting Other Command...")
                 break
             else:
@@ -312,104 +676,37 @@ class CellularManager:
     def frequency_to_NR_ARFCN(self, band, freq):
         """
         Convert frequency to NR ARFCN
-        Takes the band and frequency as input and returns the corresponding NR ARFCN
-        """
-        earfcn = ""
-        if freq != "":
-            if band in ["1", "5", "28", "41"]:
-                earfcn = freq // 5
-            elif band in ["78", "79"]:
-                earfcn = (freq - 3000000) // 15 + 600000
-            else:
-                pass
-        if not earfcn:
+        Takes the band and frequency (kHz) as input and returns the corresponding NR ARFCN
+        """
+        earfcn = nr_arfcn(int(band), freq) if freq != "" else None
+        if earfcn is None:
             earfcn = "Unknown earfcn"
         return earfcn
 
     def frequency_to_LTE_ARFCN(self, band, freq):
         """
         Convert frequency to LTE ARFCN
-        Takes the band and frequency as input and returns the corresponding LTE ARFCN
-        """
-        earfcn = ""
-        if freq != "":
-            if band == "1":
-                earfcn = freq - 21100
-            elif band == "3":
-                earfcn = (freq + 1200) - 18050
-            elif band == "5":
-                earfcn = (freq + 2400) - 8690
-            elif band == "8":
-                earfcn = (freq + 3450) - 9250
-            elif band == "34":
-                earfcn = (freq + 36200) - 20100
-            elif band == "38":
-                earfcn = (freq + 37750) - 25700
-            elif band == "39":
-                earfcn = (freq + 38250) - 18800
-            elif band == "40":
-                earfcn = (freq + 38650) - 23000
-            elif band == "41":
-                earfcn = (freq + 39650) - 24960
-            else:
-                pass
-        if not earfcn:
+        Takes the band and frequency (100 kHz) as input and returns the corresponding LTE ARFCN
+        """
+        earfcn = lte_arfcn(int(band), freq) if freq != "" else None
+        if earfcn is None:
             earfcn = "Unknown earfcn"
         return earfcn
-    
+
     def parse_cellscan_response(self, response_results):
         """
         Parse the response from the AT^CELLSCAN=3 command
         Returns a list of records containing information about the scanned cells
         """
-        result = []
-        lines = response_results.split("\n")
-        for line in lines:
-            if line.startswith("^CELLSCAN: "):
-                line = line.split(": ", 1)[1]  # 去掉开头的 "^CELLSCAN: "
-                fields = line.split(",")
-                rat = int(fields[0])
-                if rat == 1:
-                    rat_str = "UMTS (FDD)"
-                elif rat == 2:
-                    rat_str = "LTE"
-                elif rat == 3:
-                    rat_str = "NR"
-                else:
-                    rat_str = "Unknown"
-                plmn = fields[1].strip('"')
-                freq = int(fields[2])
-                pci = int(fields[3]) if fields[3] else None
-                band = int(fields[4], 16)
-                lac = int(fields[5], 16)
-                scs = int(fields[10]) if fields[10] else None
-                scs_value = None
-                if scs == 0:
-                    scs_value = "15"
-                elif scs == 1:
-                    scs_value = "30"
-                elif scs == 2:
-                    scs_value = "60"
-                elif scs == 3:
-                    scs_value = "120"
-                elif scs == 4:
-                    scs_value = "240"
-                rsrp = int(fields[11]) if fields[11] else None
-                rsrq = int(fields[12]) * 0.5 if fields[12] else None
-                sinr = int(fields[13]) * 0.5 if fields[13] else None
-                lte_sinr = int(fields[14], 16) * 0.125 if fields[14] else None
-
-                if rat_str == "NR":
-                    arfcn = self.frequency_to_NR_ARFCN(str(band), freq)
-                elif rat_str == "LTE":
-                    arfcn = self.frequency_to_LTE_ARFCN(str(band), freq)
-                else:
-                    arfcn = "Unknown arfcn"
-
-                record = [rat_str, plmn, freq, pci, band, lac, scs_value, rsrp, rsrq, sinr, lte_sinr, arfcn]
-                result.append(record)
+        return atparse.parse("^CELLSCAN", response_results).records
 
-        return result
+    def parse_cellscan_line(self, line):
+        """
+        Parse one "^CELLSCAN: " line
+        Returns the cell record, or None for any other line
+        """
+        records = atparse.parse("^CELLSCAN", line).records
+        return records[0] if records else None
 
     def initial_configuration(self):
         """
@@ -423,79 +720,550 @@ class CellularManager:
             "AT^NRFREQLOCK=0",
             "AT^SYSCFGEX=\"0803\",3FFFFFFF,1,2,7FFFFFFFFFFFFFFF,,"
         ]
-        for command in commands:
+        # Each command is sent as soon as the previous one is OK, failures are retried with backoff
+        report = Workflow(self, [(command, command, None) for command in commands]).run()
+        if report["error"]:
+            print(f"Initial Configuration failed: {report['error']}")
+        return report
+
+    def scan_cells(self, on_record=None, deadline=SCAN_DEADLINE, attempts=SCAN_ATTEMPTS):
+        """
+        Scan for cells without locking anything afterwards
+        Runs AT+COPS=2, AT^CELLSCAN=3 and AT+COPS=0 as one scan job in ats.py,
+        on_record is called with each parsed cell record as soon as it is reported
+        Returns {"state": "done" or "failed", "records": [...], "lines": [...], "timing": {...}, "error": ...}
+        """
+        store = None
+        if self.scan_db:
+            try:
+                store = ScanStore(self.scan_db)
+                scan_id = store.begin(self.modem)
+                on_record = store.recorder(scan_id, on_record, self.modem)
+            except sqlite3.Error as e:
+                print(f"Scan history {self.scan_db} not recorded: {e}")
+                store = None
+        if self.framed:
+            result = self.scan_cells_framed(on_record, deadline, attempts)
+        else:
+            result = self.scan_cells_polling(on_record, deadline, attempts)
+        if store is not None:
+            store.finish(scan_id, result["state"], result["error"], records=result["records"], modem=self.modem)
+            store.close()
+        return result
+
+    def scan_cells_framed(self, on_record=None, deadline=SCAN_DEADLINE, attempts=SCAN_ATTEMPTS):
+        """
+        scan_cells() as a scan job of ats.py, cells are reported while AT^CELLSCAN=3 runs
+        """
+        records = []
+        lines = []
+        result = {"state": "failed", "records": records, "lines": lines, "timing": {}, "error": None}
+        try:
+            for message in open_session(self.socket_file, modem=self.modem, token=self.token).scan(deadline, attempts):
+                if "cell" in message:
+                    lines.append(message["cell"])
+                    record = self.parse_cellscan_line(message["cell"])
+                    if record is not None:
+                        records.append(record)
+                        if on_record is not None:
+                            on_record(record)
+                elif "error" in message and "state" not in message:
+                    result["error"] = message["error"]
+                elif message.get("state") in ("done", "failed"):
+                    result.update(state=message["state"], timing=message["timing"], error=message.get("error"))
+                    # Cells reported before we joined a scan in progress
+                    if len(message["cells"]) > len(lines):
+                        lines[:] = message["cells"]
+                        records[:] = self.parse_cellscan_response("\n".join(lines))
+        except Exception as e:
+            result["error"] = str(e)
+        return result
+
+    def scan_cells_polling(self, on_record=None, deadline=SCAN_DEADLINE, attempts=SCAN_ATTEMPTS):
+        """
+        scan_cells() for an ats.py without scan jobs, with the same deadline and attempt limits
+        """
+        started = time.time()
+        end = time.monotonic() + deadline
+        result = {"state": "failed", "records": [], "lines": [], "timing": {"started": started}, "error": None}
+        try:
+            if self.send_until_ok("AT+COPS=2", attempts, end) is None:
+                result["error"] = "AT+COPS=2 failed"
+                return result
+            response = self.send_until_ok("AT^CELLSCAN=3", attempts, end)
+            if response is None:
+                result["error"] = "AT^CELLSCAN=3 failed"
+                return result
+            result["lines"] = [line.strip() for line in response.split("\n") if line.startswith("^CELLSCAN: ")]
+            result["records"] = self.parse_cellscan_response(response)
+            if on_record is not None:
+                for record in result["records"]:
+                    on_record(record)
+            result["state"] = "done"
+            result["timing"]["scanned"] = time.time()
+            return result
+        finally:
+            if self.send_until_ok("AT+COPS=0", attempts, time.monotonic() + SCAN_DEADLINE) is None:
+                result["error"] = "AT+COPS=0 failed"
+            result["timing"]["finished"] = time.time()
+            result["timing"]["duration"] = round(result["timing"]["finished"] - started, 3)
+
+    def send_until_ok(self, command, attempts, end):
+        """
+        Send a command until it returns OK, at most attempts times and not past the monotonic time end
+        Returns the response, or None if it never succeeded
+        """
+        for attempt in range(attempts):
             response = self.send_command(command)
-            while "OK" not in response:
-                print(f"Command '{command}' failed. Retrying...")
-                time.sleep(2)
-                response = self.send_command(command)
-            print(f"Command '{command}' executed successfully.")
-            time.sleep(1)
+            if response and "OK" in response:
+                print(f"Command '{command}' executed successfully.")
+                return response
+            if attempt + 1 == attempts or time.monotonic() + SCAN_RETRY_DELAY > end:
+                break
+            print(f"Command '{command}' failed. Retrying...")
+            time.sleep(SCAN_RETRY_DELAY)
+        return None
 
     def scan_cell(self):
         """
         Perform cell scan
-        Unlocks the cell, sends AT+COPS=2 and AT^CELLSCAN=3 commands to scan for cells
-        Parses the response
+        Unlocks the cell, runs the AT+COPS=2 / AT^CELLSCAN=3 / AT+COPS=0 scan job,
+        shows each cell as it is found, then the sorted results, and locks the best cell
         """
         print(self.colorize(f"Action: Performing Cell Scan..."))
         print(self.colorize(f"Will restart 5G chip, need 1~2 mins return results."))
 
+        selector = CellSelector(self)
+        previous = selector.previous_lock()  # Restored if no scanned cell locks well
+
         # Unlock cell
         self.unlock_cell()
+        cells = []
 
-        # 执行 AT+COPS=2
-        response = self.send_command("AT+COPS=2")
-        while "OK" not in response:
-            print("Command 'AT+COPS=2' failed. Retrying...")
-            time.sleep(2)
-            response = self.send_command("AT+COPS=2")
-        print("Command 'AT+COPS=2' executed successfully.")
-
-        # 执行 AT^CELLSCAN=3
-        response = ""
-        cellscan_completed = False
-        while not cellscan_completed:
-            print("Waiting for 'AT^CELLSCAN=3' to complete...")
-            time.sleep(2)
-            new_response = self.send_command("AT^CELLSCAN=3")
-            if new_response is not None:
-                response += new_response
-                if "OK" in new_response:
-                    cellscan_completed = True
-            else:
-                print("No response received. Retrying...")
+        def show_progress(record):
+            print(f"Found {record[0]} cell, pci {record[3]}, band {record[4]}, arfcn {record[11]}, rsrp {record[7]}")
 
-        # Scan Reults Data Format Handle
+        print("Waiting for 'AT^CELLSCAN=3' to complete...")
         try:
-            cellscan_data = self.parse_cellscan_response(response)
-            if cellscan_data:
+            result = self.scan_cells(show_progress)
+            if result["error"]:
+                print(f"Cell scan {result['state']}: {result['error']}")
+            if result["timing"].get("duration") is not None:
+                print(f"Cell scan took {result['timing']['duration']}s")
+
+            # Scan Reults Data Format Handle
+            cellscan_table = CellScanTable.parse("\n".join(result["lines"]))
+            if len(cellscan_table):
                 headers = ["rat", "plmn", "KHz(freq)", "pci", "band", "lac", "NR_SCS_KHz", "NR_RSRP_dBm", "NR_RSRQ_dB", "NR_SINR_dB", "LTE_SINR_dB", "arfcn"]
-                sorted_data = sorted(cellscan_data, key=lambda x: (-int(x[6]) if x[6] else float('-inf'), -x[7] if x[7] is not None else float('-inf'), -x[9] if x[9] is not None else float('-inf'), -x[8] if x[8] is not None else float('-inf')))
+                # Best first: SCS, then RSRP, SINR, RSRQ, cells missing a value last
+                sorted_data = cellscan_table.sort(("scs", "rsrp", "sinr", "rsrq")).records()
                 print(tabulate(sorted_data, headers=headers, tablefmt="grid"))
+                cells = [dict(zip(CELL_FIELDS, record)) for record in sorted_data]
             else:
                 print("No valid data received from 'AT^CELLSCAN=3'")
         except Exception as e:
             print(f"Exception for Data processing: {e}")
         finally:
-            # 执行 AT+COPS=0
-            response = self.send_command("AT+COPS=0")
-            while "OK" not in response:
-                print("Command 'AT+COPS=0' failed. Retrying...")
-                time.sleep(2)
-                response = self.send_command("AT+COPS=0")
-            print("Command 'AT+COPS=0' executed successfully.")
-
-            # lock default cell
-            print(self.colorize(f"🔒 Lock Default Cell, it will restart 5G chip."))
+            # Lock the best scanned cell, back to the previous lock if it does not serve well
+            print(self.colorize(f"🔒 Lock Best Cell, it will restart 5G chip."))
             print(self.colorize(f"🖥️  Will need 1~2 mins return to normal."))
-            response = self.send_command(self.at_commands["lock_cell_default"])
-            if response and "OK" in response:
-                self.restart_cellular()
+            if cells:
+                # Back on the network after AT+COPS=0 before the signal baseline is sampled
+                Workflow(self, [("Registration", None, "service")]).run()
+            report = selector.run(cells, previous=previous) if cells else {"locked": None, "error": "no cells"}
+            if report["locked"] is None and not report.get("rolled_back"):
+                # Nothing locked and nothing restored: fall back to the default cell
+                print(self.colorize(f"🔒 {report['error']}, Lock Default Cell."))
+                self.restart_cellular(self.at_commands["lock_cell_default"])
+
+    # Library API: every call returns a dict, {"error": ...} when it failed
+
+    def query(self, names):
+        """
+        Run several read-only queries (see QUERIES) in one broker batch
+        Returns {name: result dict}
+        """
+        replies = self.send_replies([QUERIES[name] for name in names], parse=True)
+        return {name: self.query_result(name, reply.get("response"), reply.get("error"), reply.get("parsed"))
+                for name, reply in zip(names, replies)}
+
+    def query_result(self, name, response, error=None, parsed=None):
+        """
+        Decode the response of QUERIES[name], parsed is the record ats.py already decoded, if any
+        """
+        result = parsed or (self.decode(name, response) if response else None)
+        if result is None:
+            result = {"error": error or ("invalid response" if response else "no response"), "response": response}
+        return result
+
+    def snapshot(self, names, max_age=STATUS_MAX_AGE, status_file=STATUS_FILE):
+        """
+        query() answered from the live status ats.py publishes in shared memory, without a broker round trip
+        Values older than max_age seconds, and all of them when the broker publishes none, are queried as usual
+        """
+        results = {}
+        try:
+            if self.remote:
+                raise OSError("the live status is local to the host of ats.py")
+            if self.status is None:
+                self.status = StatusReader(status_file)
+            snapshot = self.status.read(self.modem)
+            if snapshot["age"] <= STATUS_STALE:  # Otherwise the broker is gone
+                results = {name: snapshot[name] for name in names if snapshot[name].get("age", max_age + 1) <= max_age}
+        except (OSError, ValueError, KeyError, TypeError, TimeoutError):
+            pass  # A remote broker, no status file, an older broker, or a fleet of modems
+        missing = [name for name in names if name not in results]
+        if missing:
+            results.update(self.query(missing))
+        return {name: results[name] for name in names}
+
+    def signal(self):
+        return self.query(["signal"])["signal"]
+
+    def ccinfo(self):
+        return self.query(["ccinfo"])["ccinfo"]
+
+    def lockstatus(self):
+        return self.query(["lockstatus"])["lockstatus"]
+
+    def temp(self):
+        return self.query(["temp"])["temp"]
+
+    def raw(self, command):
+        """
+        Send any AT command, return {"command", "ok", "result", "response"}
+        """
+        return self.raw_batch([command])[0]
+
+    def raw_batch(self, commands):
+        """
+        Send several AT commands in one broker batch, return a raw() result for each
+        """
+        return [self.raw_result(command, reply.get("response"), reply.get("error"))
+                for command, reply in zip(commands, self.send_replies(commands))]
+
+    def raw_result(self, command, response, error=None):
+        if response is None:
+            return {"command": command, "error": error or "no response"}
+        lines = [line.strip() for line in response.splitlines() if line.strip()]
+        result = lines[-1] if lines else ""
+        return {"command": command, "ok": result == "OK", "result": result, "response": response}
+
+    def lock_command(self, cells):
+        """
+        Build the AT^NRFREQLOCK command locking cells, a list of (band, arfcn, scs, pci) tuples
+        """
+        params = ",".join(f'"{band}","{arfcn}","{scs}","{pci}"' for band, arfcn, scs, pci in cells)
+        return f"AT^NRFREQLOCK=2,0,{len(cells)},{params}"
+
+    def lock(self, pci, arfcn, band="78", scs="1", restart=True, timeout=SERVICE_TIMEOUT):
+        """
+        Lock to one NR cell and, unless restart is False, restart the cellular module to apply it
+        and wait at most timeout seconds for service, "service_s" is the time it took
+        """
+        command = self.lock_command([(band, arfcn, scs, pci)])
+        result = self.raw(command)
+        result["restarted"] = False
+        if result.get("ok") and restart:
+            report = Workflow(self, restart_steps(self), service_timeout=timeout, log=lambda message: None).run()
+            result["restarted"] = "waited" in report["steps"][0]  # Only set once AT+CFUN=1,1 was sent
+            result["service_s"] = report["service_s"]
+            if report["error"]:
+                result["error"] = report["error"]
+        return result
+
+    def unlock(self):
+        return self.raw(self.at_commands["unlock_cell"])
+
+    def autolock(self, cells=None, policy=None, ccs=2, attempts=1, dry_run=False):
+        """
+        Lock the best cell or 2CC pair of cells (scan() cell dicts, a new scan when None), verify
+        the signal and restore the previous lock if it is worse, see cellselect.CellSelector.run
+        """
+        if cells is None:
+            scan = self.scan()
+            if not scan.get("cells"):
+                return {"error": scan.get("error") or "no cells found", "locked": None}
+            cells = scan["cells"]
+        return CellSelector(self, policy, log=lambda message: None).run(cells, ccs, attempts, dry_run)
+
+    def scan(self, on_cell=None):
+        """
+        Scan for cells, return {"state", "cells": [dict, ...], "timing", "error"}
+        on_cell is called with each cell dict as soon as it is found
+        """
+        on_record = (lambda record: on_cell(dict(zip(CELL_FIELDS, record)))) if on_cell else None
+        result = self.scan_cells(on_record)
+        result.pop("lines")
+        cells = [dict(zip(CELL_FIELDS, record)) for record in result.pop("records")]
+        return dict(result, cells=cells)
+
+    def fleet(self, commands, modems="*", parse=False):
+        """
+        Run commands on several modems of a fleet broker at once
+        Returns [{modem id: {"response" or "error"}}, ...] in command order, or raises on a broker error
+        """
+        requests = [{"cmd": command, "modem": modems} for command in commands]
+        for request in requests:
+            if self.priority is not None:
+                request["priority"] = self.priority
+            if parse:
+                request["parse"] = True
+        replies = [None] * len(requests)
+        for index, reply in self.session.request(requests):
+            if "error" in reply:
+                raise ValueError(reply["error"])
+            replies[index] = reply["units"]
+        return replies
+
+    def fleet_query(self, names, modems="*"):
+        """
+        query() on several modems at once, returns {modem id: {name: result dict}}
+        """
+        results = {}
+        for name, units in zip(names, self.fleet([QUERIES[name] for name in names], modems, parse=True)):
+            for modem_id, unit in units.items():
+                results.setdefault(modem_id, {})[name] = self.query_result(name, unit.get("response"), unit.get("error"),
+                                                                           unit.get("parsed"))
+        return results
+
+    def fleet_raw(self, commands, modems="*"):
+        """
+        raw_batch() on several modems at once, returns {modem id: [raw() result, ...]}
+        """
+        results = {}
+        for command, units in zip(commands, self.fleet(commands, modems)):
+            for modem_id, unit in units.items():
+                results.setdefault(modem_id, []).append(
+                    self.raw_result(command, unit.get("response"), unit.get("error")))
+        return results
+
+    def fleet_scan(self, modems="*", on_cell=None):
+        """
+        scan() on several modems at once, returns {modem id: scan() result}
+        on_cell is called with the modem id and each cell dict as soon as it is found
+        """
+        results = {}
+        store = ScanStore(self.scan_db) if self.scan_db else None
+        scan_ids = {}  # Scan history record per modem id, begun at its first cell
+        try:
+            for message in open_session(self.socket_file, modem=modems, token=self.token).scan():
+                if "error" in message and "units" not in message:
+                    raise ValueError(message["error"])
+                if "cell" in message:
+                    record = self.parse_cellscan_line(message["cell"])
+                    if record is None:
+                        continue
+                    cell = dict(zip(CELL_FIELDS, record))
+                    if store is not None:
+                        if message["modem"] not in scan_ids:
+                            scan_ids[message["modem"]] = store.begin(message["modem"])
+                        store.add(scan_ids[message["modem"]], cell, modem=message["modem"])
+                    if on_cell is not None:
+                        on_cell(message["modem"], cell)
+                elif "units" in message:
+                    for modem_id, status in message["units"].items():
+                        records = self.parse_cellscan_response("\n".join(status.get("cells", [])))
+                        results[modem_id] = {"state": status.get("state"), "timing": status.get("timing", {}),
+                                             "error": status.get("error"),
+                                             "cells": [dict(zip(CELL_FIELDS, record)) for record in records]}
+                        if store is not None and status.get("state") in ("done", "failed"):
+                            scan_id = scan_ids.pop(modem_id, None) or store.begin(modem_id)
+                            store.finish(scan_id, status.get("state") or "failed", status.get("error"),
+                                         records=records, modem=modem_id)
+        finally:
+            if store is not None:
+                store.close()
+        return results
+
+    def stats(self):
+        """
+        Scheduler statistics of ats.py: per priority class queue depth, queue-wait and modem service times
+        """
+        try:
+            for _, reply in self.session.request([{"op": "stats"}]):
+                return reply
+        except Exception as e:
+            return {"error": str(e)}
+
+    def metrics(self):
+        """
+        Per-command instrumentation of ats.py: phase histograms, result counters and bytes per priority class
+        """
+        try:
+            for _, reply in self.session.request([{"op": "metrics"}]):
+                return reply
+        except Exception as e:
+            return {"error": str(e)}
+
+    def trace(self, last=20):
+        """
+        The latest commands ats.py sent to the modem, with their timings
+        """
+        try:
+            for _, reply in self.session.request([{"op": "trace", "last": last}]):
+                return reply
+        except Exception as e:
+            return {"error": str(e)}
+
+
+def output(data, fmt, name=None, modem=None):
+    """
+    Print one CLI result as text, JSON or one NDJSON line
+    """
+    if fmt == "json":
+        print(json.dumps(data, ensure_ascii=False, indent=2))
+    elif fmt == "ndjson":
+        data = dict(data, query=name) if name else data
+        print(json.dumps(dict(data, modem=modem) if modem else data, ensure_ascii=False), flush=True)
+    else:
+        if name:
+            print(f"[{modem}/{name}]" if modem else f"[{name}]")
+        for key, value in data.items():
+            print(f"{key}: {value}")
+
+
+def run_cli(args):
+    """
+    Non-interactive mode: run the requested action, print structured results
+    Returns the process exit code
+    """
+    if args.modem == "*" or "," in (args.modem or ""):
+        return run_fleet(args, "*" if args.modem == "*" else args.modem.split(","))
+    manager = CellularManager(args.socket, args.priority, args.modem, args.scan_db or None)
+    action, params = args.items[0], args.items[1:]
+    results = {}
+
+    if action in QUERIES:
+        unknown = [name for name in args.items if name not in QUERIES]
+        if unknown:
+            print(f"Unknown queries: {', '.join(unknown)}", file=sys.stderr)
+            return 2
+        results = manager.snapshot(args.items, status_file=args.status) if args.live else manager.query(args.items)
+    elif action == "raw":
+        if not params:
+            print("raw needs at least one AT command", file=sys.stderr)
+            return 2
+        for index, result in enumerate(manager.raw_batch(params)):
+            results[f"{index}:{result['command']}"] = result
+    elif action == "lock":
+        if args.pci is None or args.arfcn is None:
+            print("lock needs --pci and --arfcn", file=sys.stderr)
+            return 2
+        results["lock"] = manager.lock(args.pci, args.arfcn, args.band, args.scs, restart=not args.no_restart)
+    elif action == "unlock":
+        results["unlock"] = manager.unlock()
+    elif action == "scan":
+        on_cell = (lambda cell: output(cell, "ndjson", "cell")) if args.format == "ndjson" else None
+        results["scan"] = manager.scan(on_cell)
+    elif action in ("stats", "metrics"):
+        results[action] = getattr(manager, action)()
+        results[action].pop("id", None)
+    elif action == "trace":
+        results["trace"] = manager.trace(int(params[0]) if params and params[0].isdigit() else 20)
+        results["trace"].pop("id", None)
+    else:
+        print(f"Unknown action: {action}", file=sys.stderr)
+        return 2
+
+    if args.format == "json":
+        output(results, "json")
+    else:
+        for name, result in results.items():
+            output(result, args.format, name)
+    failed = [result for result in results.values() if "error" in result and result["error"]]
+    return 1 if failed else 0
+
+
+def run_fleet(args, modems):
+    """
+    run_cli() on several modems of a fleet broker at once, results are printed per modem
+    """
+    manager = CellularManager(args.socket, args.priority, modems, args.scan_db or None)
+    action, params = args.items[0], args.items[1:]
+    units = {}
+    try:
+        if action in QUERIES:
+            unknown = [name for name in args.items if name not in QUERIES]
+            if unknown:
+                print(f"Unknown queries: {', '.join(unknown)}", file=sys.stderr)
+                return 2
+            units = manager.fleet_query(args.items, modems)
+        elif action == "raw":
+            if not params:
+                print("raw needs at least one AT command", file=sys.stderr)
+                return 2
+            for modem_id, results in manager.fleet_raw(params, modems).items():
+                units[modem_id] = {f"{index}:{result['command']}": result for index, result in enumerate(results)}
+        elif action == "scan":
+            on_cell = (lambda modem_id, cell: output(cell, "ndjson", "cell", modem_id)) \
+                if args.format == "ndjson" else None
+            units = {modem_id: {"scan": result} for modem_id, result in manager.fleet_scan(modems, on_cell).items()}
+        elif action in ("stats", "metrics"):
+            reply = getattr(manager, action)()
+            if "units" not in reply:
+                raise ValueError(reply.get("error", "no response"))
+            units = {modem_id: {action: result} for modem_id, result in reply["units"].items()}
+        elif action in ("lock", "unlock"):
+            print(f"{action} needs a single --modem", file=sys.stderr)
+            return 2
+        else:
+            print(f"Unknown action: {action}", file=sys.stderr)
+            return 2
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if args.format == "json":
+        output(units, "json")
+    else:
+        for modem_id, results in units.items():
+            for name, result in results.items():
+                output(result, args.format, name, modem_id)
+    failed = [result for results in units.values() for result in results.values()
+              if "error" in result and result["error"]]
+    return 1 if failed else 0
+
 
 def main():
-    manager = CellularManager()
+    parser = argparse.ArgumentParser(
+        description="Simple Tool to Control MT5700M-CN AT PHY. Without arguments an interactive menu is shown.",
+        epilog="examples: at.py signal ccinfo lockstatus temp --format json | "
+               "at.py raw 'AT^CHIPTEMP?' ATI | at.py lock --pci 579 --arfcn 627264 | at.py scan --format ndjson")
+    parser.add_argument("items", nargs="*", metavar="action",
+                        help=f"one or more of {', '.join(QUERIES)} (run in one batch), "
+                             "or raw COMMAND..., lock, unlock, scan, stats, metrics, trace [N]")
+    parser.add_argument("--format", choices=["text", "json", "ndjson"], default="text", help="output format")
+    parser.add_argument("--socket", default=SOCKET_FILE,
+                        help=f"Unix Domain Socket file path of ats.py, or tcp://HOST[:PORT] of its --listen "
+                             f"gateway with the token in {TOKEN_ENV}")
+    parser.add_argument("--pci", help="lock: physical cell id")
+    parser.add_argument("--arfcn", help="lock: NR ARFCN")
+    parser.add_argument("--band", default="78", help="lock: NR band (default: 78)")
+    parser.add_argument("--scs", default="1", help="lock: subcarrier spacing, 0=15 1=30 kHz (default: 1)")
+    parser.add_argument("--no-restart", action="store_true", help="lock: do not restart the cellular module")
+    parser.add_argument("--priority", choices=["interactive", "control", "telemetry", "scan"],
+                        help="scheduler class of the commands in ats.py (default: telemetry for queries, "
+                             "control otherwise; interactive for the menu)")
+    parser.add_argument("--modem", help="modem id of a fleet broker (default: its first modem); '*' or a "
+                                        "comma-separated list runs queries, raw, scan and stats on all of them at once")
+    parser.add_argument("--live", action="store_true",
+                        help="answer queries from the live status ats.py publishes in shared memory when it is "
+                             f"at most {STATUS_MAX_AGE}s old (see livestatus.py)")
+    parser.add_argument("--status", default=STATUS_FILE, help="--live: status file of ats.py (default: %(default)s)")
+    parser.add_argument("--scan-db", default=SCAN_DB,
+                        help="SQLite scan history every scan is appended to, '' for none (default: %(default)s)")
+    args = parser.parse_args()
+    if remote_address(args.socket) is not None and not os.environ.get(TOKEN_ENV):
+        parser.error(f"{args.socket} needs the token of the gateway in {TOKEN_ENV}")
+
+    if args.items:
+        sys.exit(run_cli(args))
+    if args.modem == "*" or "," in (args.modem or ""):
+        parser.error("the interactive menu needs a single --modem")
+    interactive(CellularManager(args.socket, args.priority or "interactive", args.modem, args.scan_db or None))
 
+def interactive(manager):
     while True:
         print("\n 🌍 Simple Tool to Control MT5700M-CN AT PHY 🌍")
         print("Please select an option:\n")
@@ -0,0 +1,194 @@
+import re
+
+from cellscan import CELL_FIELDS, CellScanTable
+
+# Registry of response parsers, one per response name such as "^HCSQ", see parse()
+PARSERS = {}
+UNKNOWN = "255"  # Raw value of an unknown or unmeasurable ^HCSQ field
+SYSMODES = {6: "LTE", 7: "NR"}  # ^HFREQINFO sysmode codes
+# ^HCSQ fields after the sysmode: LTE reports the RSSI first, NR does not
+SIGNAL_LAYOUT = {"LTE": ("rssi", "rsrp", "sinr", "rsrq"), "NR": ("rsrp", "sinr", "rsrq")}
+
+# Precompiled grammars, each finds its lines in a whole response as well as in a single URC line
+HCSQ = re.compile(r'^[ \t]*\^HCSQ:[ \t]*"?([A-Za-z0-9-]+)"?((?:[ \t]*,[ \t]*\d+)*)', re.M)
+HFREQINFO = re.compile(r"^[ \t]*\^HFREQINFO:[ \t]*(\d+)[ \t]*,[ \t]*(\d+)([^\r\n]*)", re.M)
+NRFREQLOCK = re.compile(r"^[ \t]*\^NRFREQLOCK:[ \t]*(\d+)[^\r\n]*((?:\r?\n(?![ \t]*(?:OK|ERROR|\+CME ERROR))[^\r\n]*)*)",
+                        re.M)
+CHIPTEMP = re.compile(r"^[ \t]*\^CHIPTEMP:[ \t]*([^\r\n]*)", re.M)
+NUMBER = re.compile(r"-?\d+")
+
+
+def register(name):
+    """
+    Decorator adding a parser of the text of name responses (and URCs) to PARSERS
+    """
+    def add(parser):
+        PARSERS[name] = parser
+        return parser
+    return add
+
+
+def parse(name, text):
+    """
+    Decode a response or URC line of name, e.g. "^HCSQ", into its record
+    Returns None when there is no parser for name or the text holds no valid name line
+    """
+    parser = PARSERS.get(name)
+    return parser(text) if parser is not None and text else None
+
+
+def fields(text):
+    return [field.strip().strip('"') for field in text.split(",")]
+
+
+def to_int(value):
+    """
+    int() of a response field, the field itself when it is not a number
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class Record:
+    """
+    Decoded response, its fields are the __slots__ of the subclass, in the order of __init__ arguments
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def to_dict(self):
+        return {name: to_dict(getattr(self, name)) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+
+def to_dict(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [to_dict(item) for item in value]
+    return value
+
+
+class Signal(Record):
+    """
+    ^HCSQ: rsrp, rssi in dBm, sinr, rsrq in dB, None when unknown, capped values (sinr 251, rsrq 34) at their cap
+    raw is the sysmode and the undecoded rsrp, sinr and rsrq fields
+    """
+    __slots__ = ("sysmode", "rsrp", "sinr", "rsrq", "rssi", "raw")
+
+
+class Carrier(Record):
+    """
+    One component carrier of ^HFREQINFO, fields as reported (ints when numeric)
+    """
+    __slots__ = ("proa", "sysmode", "band_class", "dl_fcn", "dl_freq", "dl_bw", "ul_fcn", "ul_freq", "ul_bw")
+
+
+class CarrierInfo(Record):
+    """
+    ^HFREQINFO: proa and sysmode of the first line, the carriers of every line
+    """
+    __slots__ = ("proa", "sysmode", "carriers")
+
+
+class LockStatus(Record):
+    """
+    ^NRFREQLOCK: cell is the first locked cell line, fields its fields, cells [band, arfcn, scs, pci] of each one
+    """
+    __slots__ = ("locked", "cell", "fields", "cells")
+
+
+class ChipTemp(Record):
+    """
+    ^CHIPTEMP: temp_c in °C, raw the reported fields (tenths of °C)
+    """
+    __slots__ = ("temp_c", "raw")
+
+
+class CellScan(Record):
+    """
+    ^CELLSCAN: one cellscan.CELL_FIELDS record per cell line
+    """
+    __slots__ = ("records",)
+
+    def to_dict(self):
+        return {"cells": [dict(zip(CELL_FIELDS, record)) for record in self.records]}
+
+
+@register("^HCSQ")
+def parse_signal(text):
+    match = HCSQ.search(text)
+    if match is None:
+        return None
+    sysmode, values = match.group(1), NUMBER.findall(match.group(2))
+    if not values:
+        if sysmode == "NOSERVICE":
+            return Signal("NOSERVICE", None, None, None, None, ["NOSERVICE"])
+        return None
+    layout = SIGNAL_LAYOUT.get(sysmode, SIGNAL_LAYOUT["NR"])
+    if len(values) < len(layout):
+        return None
+    raw = dict(zip(layout, values))
+    rsrp, sinr, rsrq, rssi = raw["rsrp"], raw["sinr"], raw["rsrq"], raw.get("rssi", UNKNOWN)
+    return Signal(
+        sysmode,
+        None if rsrp == UNKNOWN else -140 + int(rsrp),
+        None if sinr == UNKNOWN else 30.0 if sinr == "251" else round(-20 + int(sinr) * 0.2, 1),
+        None if rsrq == UNKNOWN else -3.0 if rsrq == "34" else -19.5 + int(rsrq) * 0.5,
+        None if rssi == UNKNOWN else -120 + int(rssi),
+        [sysmode, rsrp, sinr, rsrq],
+    )
+
+
+@register("^HFREQINFO")
+def parse_ccinfo(text):
+    info = None
+    for match in HFREQINFO.finditer(text):
+        proa, sysmode = int(match.group(1)), int(match.group(2))
+        name = SYSMODES.get(sysmode, str(sysmode))
+        if info is None:
+            info = CarrierInfo(proa, name, [])
+        values = fields(match.group(3))[1:]  # The line goes on with ",<band_class>,..."
+        if sysmode in SYSMODES:
+            info.carriers += [Carrier(proa, name, values[i], *map(to_int, values[i + 1:i + 7]))
+                              for i in range(0, len(values) - 6, 7)]
+    return info
+
+
+@register("^NRFREQLOCK")
+def parse_lockstatus(text):
+    match = NRFREQLOCK.search(text)
+    if match is None:
+        return None
+    lines = [line.strip() for line in match.group(2).splitlines() if line.strip()]
+    cells = lines[1:] if match.group(1) != "0" else []  # The first line after the mode is "<mode>,<count>"
+    if not cells:
+        return LockStatus(False, None, [], [])
+    return LockStatus(True, cells[0], fields(cells[0]), [fields(cell) for cell in cells])
+
+
+@register("^CHIPTEMP")
+def parse_temp(text):
+    match = CHIPTEMP.search(text)
+    if match is None:
+        return None
+    raw = fields(match.group(1))
+    try:
+        return ChipTemp(int(raw[0]) / 10, raw)
+    except ValueError:
+        return None
+
+
+@register("^CELLSCAN")
+def parse_cellscan(text):
+    return CellScan(CellScanTable.parse(text).records())
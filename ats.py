@@ -1,15 +1,144 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import math
+import random
+import re
 import socket
 import time
 import os
 
+import atparse
+from capture import CAPTURE_LIMIT, CaptureWriter
+from livestatus import STATUS_FILE, STATUS_HEARTBEAT, STATUS_QUERIES, STATUS_REFRESH, StatusWriter
+
 SERVER_IP = "192.168.8.1"
 SERVER_PORT = 20249
 BUFFER_SIZE = 2048 * 4
-RETRY_DELAY = 3  # Delay time between each retry (seconds)
+RESPONSE_LIMIT = 1024 * 1024  # Bytes of one response kept in memory, the rest is relayed and counted only
+LINE_LIMIT = 64 * 1024  # Longest line split into responses and URCs, the rest of a longer line is not classified
+RELAY_HIGH_WATER = 256 * 1024  # Response bytes queued for a slow raw client before the modem is no longer read
+RELAY_STALL_TIMEOUT = 10  # Max time the modem waits for a raw client that stopped reading, then it is cut off (seconds)
 TIMEOUT = 120 # Setting commands timeout 120s to reconnect.
+MODEM_TIMEOUT = 60  # Max time to wait for the modem to finish one command (seconds)
+
+# Modem link supervision of the asyncio broker
+CONNECT_TIMEOUT = 5  # Max time for one connection attempt (seconds)
+RECONNECT_MIN_DELAY = 0.25  # First delay between connection attempts, doubled after each failure (seconds)
+RECONNECT_MAX_DELAY = 4  # Cap of the delay between connection attempts (seconds)
+REBOOT_RECONNECT_DELAY = 0.5  # Cap while the modem reboots on request, it is expected back any moment (seconds)
+HEARTBEAT_INTERVAL = 10  # Send "AT" after the link has been silent this long (seconds)
+HEARTBEAT_TIMEOUT = 3  # Max time for the modem to answer a heartbeat before the link is dropped (seconds)
+KEEPALIVE_IDLE = 10  # TCP keepalive: idle time before the first probe (seconds)
+KEEPALIVE_INTERVAL = 3  # TCP keepalive: time between probes (seconds)
+KEEPALIVE_COUNT = 3  # TCP keepalive: unanswered probes before the connection is reset
+KEEPALIVE_USER_TIMEOUT = 10  # Max time written data may stay unacknowledged before the connection is reset (seconds)
+LINK_WAIT = 15  # Queued commands wait this long after the link drops for it to come back, then fail fast (seconds)
+REBOOT_COMMANDS = ("AT+CFUN=1,1",)  # The modem drops the link after answering OK to these
+REBOOT_SETTLE = 10  # A reboot counts as in progress until the link has been back this long (seconds)
+SERVICE_LINES = ('^HCSQ: "NR"', '^HCSQ: "LTE"')  # ...or until the modem reports service in one of these lines
+
+# Command scheduler: priority classes, served strictly in this order
+PRIORITY_CLASSES = ("interactive", "control", "telemetry", "scan")
+# Per class: commands per second sent to the modem (0: unlimited), max queued commands,
+# and how long its commands wait for a dropped link (telemetry fails fast so health probes report the outage)
+PRIORITY_LIMITS = {
+    "interactive": {"rate": 0, "depth": 32, "link_wait": LINK_WAIT},
+    "control": {"rate": 2, "depth": 16, "link_wait": LINK_WAIT},
+    "telemetry": {"rate": 10, "depth": 64, "link_wait": 0},
+    "scan": {"rate": 0, "depth": 8, "link_wait": LINK_WAIT},
+}
+RATE_BURST = 2  # A rate limited class may send this many seconds worth of commands back to back
+# Classes held in the queue while a scan job or a modem reboot is in progress, the others keep running
+DEFER_DURING = {
+    "scan": ("control",),  # Registration changes would spoil the scan
+    "reboot": ("control", "scan"),  # Until the modem has settled after AT+CFUN=1,1
+}
+SCHEDULER_POLL = 0.5  # Recheck interval of deferred classes (seconds)
+STATS_WINDOW = 1024  # Latest queue-wait and service times kept per class for percentiles
+CLIENT_TIMEOUT = 90  # Max time a client waits for its command, queueing included (seconds)
+SUBSCRIBER_BUFFER_LIMIT = 256 * 1024  # URC events to a subscriber are dropped while this many bytes are unsent
+
+# Cell scan jobs: AT+COPS=2, AT^CELLSCAN=3 until it returns OK, AT+COPS=0
+SCAN_DEADLINE = 180  # Whole scan job, AT+COPS=0 excluded (seconds)
+SCAN_ATTEMPTS = 5  # Max AT^CELLSCAN=3 attempts per job
+SCAN_STEP_ATTEMPTS = 3  # Max attempts of AT+COPS=2 and AT+COPS=0
+SCAN_RETRY_DELAY = 2  # Delay between failed attempts (seconds)
+SCAN_MODEM_TIMEOUT = 120  # Max time the modem may take to answer AT^CELLSCAN=3 (seconds)
+SCAN_RESTORE_TIMEOUT = 30  # Max time for AT+COPS=0 after the scan (seconds)
+SCAN_JOBS_KEPT = 16  # Finished jobs kept for status queries
+
+# Per-command instrumentation of the asyncio broker
+LOG_COMMANDS = True  # Print every command, response and URC, --quiet turns it off
+LOG_RESPONSE_LIMIT = 2048  # Logged responses are cut after this many characters
+METRICS = True  # Histograms, result counters and the last-N ring of commands, --no-metrics turns them off
+# Upper bounds of the duration histograms (seconds), an implicit +Inf bucket follows
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TRACE_PHASES = ("queue", "write", "first_byte", "final", "total")  # See Trace.phases()
+TRACE_RING = 256  # Latest commands kept for the "trace" op
+TRACE_SAMPLE = 1.0  # Share of the commands written to the --trace log, 0.01 keeps one in a hundred
 
 # Unix Domain Socket file path
 SOCKET_FILE = "/tmp/at_socket.sock"
+MODEM_ID = "default"  # Id of the modem given by --host/--port, clients without a "modem" id are routed to the first one
+
+# Remote gateway (--listen): the framed protocol on TCP for other hosts, every connection authenticates with a token
+# of the --tokens file. Plain text, keep it on a trusted network or behind a VPN or SSH tunnel
+REMOTE_PORT = 20251  # Port of --listen when only a host is given
+REMOTE_AUTH_TIMEOUT = 10  # Max time for the auth request of a new connection (seconds)
+REMOTE_IDLE_TIMEOUT = 300  # A connection without requests, commands in flight or subscriptions is closed after this (seconds)
+REMOTE_MAX_CLIENTS = 64  # Remote connections served at once, more are refused
+REMOTE_TOKEN_MIN = 16  # Shortest token accepted in the --tokens file (characters)
+# Quota of a token unless its --tokens entry sets its own: commands per second and burst (rate 0: unlimited),
+# commands in flight, open connections, usable priority classes, and whether only queries ("...?") and no scans are allowed
+REMOTE_QUOTA = {"rate": 5, "burst": 10, "inflight": 8, "connections": 4, "priorities": list(PRIORITY_CLASSES),
+                "readonly": False}
+
+# Response cache for query-form commands ("...?"), TTL in seconds, 0 disables caching
+CACHE_SIZE = 64  # Max cached responses, least recently used are evicted first
+CACHE_DEFAULT_TTL = 1
+CACHE_TTL = {
+    "AT^HCSQ?": 1,
+    "AT^HFREQINFO?": 2,
+    "AT^NRFREQLOCK?": 10,
+    "AT^LTEFREQLOCK?": 10,
+    "AT^CHIPTEMP?": 5,
+    "AT^CELLSCAN?": 0,
+}
+# Set commands and the other commands whose cached answers they make stale,
+# a set command always invalidates its own query form, "*" clears the whole cache
+CACHE_INVALIDATES = {
+    "+CFUN": ["*"],
+    "+COPS": ["^HCSQ", "^HFREQINFO", "+CREG", "+CEREG", "+C5GREG", "^SYSINFOEX", "^MONSC"],
+    "^NRFREQLOCK": ["^HCSQ", "^HFREQINFO", "^MONSC"],
+    "^LTEFREQLOCK": ["^HCSQ", "^HFREQINFO", "^MONSC"],
+    "^SYSCFGEX": ["^HCSQ", "^HFREQINFO", "^SYSINFOEX", "^MONSC"],
+    "^C5GOPTION": ["^HCSQ", "^HFREQINFO", "^SYSINFOEX"],
+    "^CELLSCAN": ["^HCSQ", "^HFREQINFO", "^MONSC"],
+}
+
+def set_keepalive(sock):
+    """
+    Enable TCP keepalive and a user timeout on the modem socket so a half-open link is reset
+    instead of blocking reads and writes until the modem comes back
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT), ("TCP_USER_TIMEOUT", KEEPALIVE_USER_TIMEOUT * 1000)):
+        if hasattr(socket, option):  # Linux only options
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+def backoff(attempt, cap=RECONNECT_MAX_DELAY):
+    """
+    Delay before connection attempt number attempt + 1: exponential, capped, with jitter
+    """
+    delay = min(cap, RECONNECT_MIN_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
 
 def send_command(client_socket, command):
     """
@@ -18,22 +147,272 @@ def send_command(client_socket, command):
     print(f"Sending command: {command}")
     client_socket.sendall(command.encode() + b"\r")
 
-def receive_response(client_socket):
+# Final result codes, only recognised as a whole line
+FINAL_RESULT_CODES = (b"OK", b"ERROR")
+FINAL_RESULT_PREFIXES = (b"+CME ERROR:", b"+CMS ERROR:")
+
+class Response:
     """
-    Receive server response and detect if it's the end flag (OK or ERROR)
+    One framed AT response with its size and final result code
     """
-    response = bytearray()
-    while True:
-        data = client_socket.recv(BUFFER_SIZE)
-        if not data:
-            break  # Server closed the connection
-        response.extend(data)
-        decoded_response = response.decode(errors='ignore')
-        if "OK" in decoded_response or "ERROR" in decoded_response:
-            print(f"Received response: {decoded_response}")
-            break  # Received OK or ERROR, consider the command processing is done
+    __slots__ = ("data", "result", "nbytes", "nlines", "truncated", "decoded", "record", "parsed")
+
+    def __init__(self, data, result, nbytes=None, nlines=None, truncated=False):
+        self.data = data  # Bytes as received, at most RESPONSE_LIMIT of them, final result line included
+        self.result = result  # "OK", "ERROR", "+CME ERROR: 10", ...
+        self.nbytes = len(data) if nbytes is None else nbytes  # Bytes received, kept or not
+        self.nlines = nlines  # Non-empty lines received, final result line included
+        self.truncated = truncated  # Bytes past RESPONSE_LIMIT were dropped from data
+        self.decoded = None
+        self.record = None
+        self.parsed = False
+        if nlines is None:
+            self.nlines = len(self.lines)
+
+    @property
+    def lines(self):
+        """
+        Non-empty decoded lines of data, decoded on first use
+        """
+        if self.decoded is None:
+            self.decoded = [line.strip() for line in self.text.split("\n") if line.strip()]
+        return self.decoded
+
+    @property
+    def ok(self):
+        return self.result == "OK"
+
+    def parse(self, command):
+        """
+        atparse record of the response to command, or None, decoded once and shared by every reader
+        of this Response: coalesced clients, cache hits and fleet replies
+        """
+        if not self.parsed:
+            self.record = atparse.parse(command_name(command), self.text) if self.ok else None
+            self.parsed = True
+        return self.record
+
+    @property
+    def text(self):
+        return self.data.decode(errors='ignore')
+
+    def excerpt(self, limit=LOG_RESPONSE_LIMIT):
+        """
+        text for the log, a long AT^CELLSCAN=3 output is cut after limit characters
+        """
+        text = self.data[:limit + 1].decode(errors='ignore')
+        if len(text) > limit:
+            return f"{text[:limit]}... ({self.nbytes - limit} more bytes)"
+        return text
+
+
+# Unsolicited result codes the modem may push at any time
+URC_PREFIXES = (
+    b"^HCSQ:", b"^MODE:", b"^RSSI:", b"^CERSSI:", b"^SRVST:", b"^SIMST:", b"^SYSSTART",
+    b"^NDISSTAT:", b"^NDISEND:", b"^DSFLOWRPT:", b"^CSQLVL:", b"^ECCLIST:",
+    b"+CREG:", b"+CGREG:", b"+CEREG:", b"+C5GREG:", b"+CGEV:", b"+CUSATP:", b"RING",
+)
+
+class URC:
+    """
+    One unsolicited result code line, e.g. ^HCSQ: "NR",60,150,50
+    """
+    __slots__ = ("name", "fields", "line", "time", "event", "record", "parsed")
+
+    def __init__(self, line):
+        self.line = line
+        self.time = time.time()
+        name, _, rest = line.partition(":")
+        self.name = name.strip()
+        self.fields = [field.strip().strip('"') for field in rest.split(",")] if rest.strip() else []
+        self.event = None
+        self.record = None
+        self.parsed = False
+
+    def parse(self):
+        """
+        atparse record of the line, or None, decoded once for the status slot and every subscriber
+        """
+        if not self.parsed:
+            self.record = atparse.parse(self.name, self.line)
+            self.parsed = True
+        return self.record
+
+    def to_dict(self):
+        """
+        Event message of the URC, with its atparse record as "parsed" when there is a parser for it
+        Built once and shared by every subscriber
+        """
+        if self.event is None:
+            self.event = {"event": self.name, "fields": self.fields, "line": self.line, "time": self.time}
+            record = self.parse()
+            if record is not None:
+                self.event["parsed"] = record.to_dict()
+        return self.event
+
+
+class ResponseFramer:
+    """
+    Split the modem byte stream into responses and URCs on line boundaries
+    Each byte is scanned once, so a long AT^CELLSCAN=3 output costs linear time,
+    and "OK" or "ERROR" inside a PLMN or payload never ends a response early.
+    Lines are found and classified in place in the received buffer, only a line split across
+    reads is copied. A response keeps at most limit bytes, the rest is only counted and passed to
+    on_data, and a line longer than LINE_LIMIT (an echo storm, noise) is never taken for a URC or final result
+    """
+    def __init__(self, limit=RESPONSE_LIMIT):
+        self.limit = limit
+        self.carry = bytearray()  # Start of a line split across reads
+        self.overlong = False  # The line in progress passed LINE_LIMIT
+        self.expecting = False  # A command is in flight
+        self.solicited = b""  # Response prefix of the command in flight, e.g. b"^HCSQ:"
+        self.on_line = None
+        self.on_data = None
+        self.reset()
+
+    def reset(self):
+        self.data = bytearray()
+        self.nbytes = 0
+        self.nlines = 0
+        self.truncated = False
+
+    def begin(self, command="", on_line=None, on_data=None):
+        """
+        Expect the response to command, its own lines are never taken for URCs
+        on_line, if given, is called with each decoded response line as soon as it arrives, and on_data
+        with a memoryview of the response bytes of each line, only valid during the call
+        """
+        name = command_name(command)
+        self.expecting = True
+        self.solicited = (name + ":").encode() if name else b""
+        self.on_line = on_line
+        self.on_data = on_data
+
+    def is_urc(self, buffer, start, end):
+        if not self.expecting:
+            return True
+        if self.solicited and buffer.startswith(self.solicited, start, end):
+            return False
+        return buffer.startswith(URC_PREFIXES, start, end)
 
-    return decoded_response
+    def feed(self, data, size=None):
+        """
+        Add received bytes, the first size of data (bytes or bytearray), return the list of Response
+        and URC items completed by them. data is not kept, it may be reused for the next read
+        """
+        size = len(data) if size is None else size
+        items = []
+        start = 0
+        while start < size:
+            end = data.find(b"\n", start, size)
+            if end < 0:
+                self.carry_over(data, start, size)
+                break
+            if self.overlong:
+                self.fragment(data, start, end + 1)
+                self.overlong = False
+                self.nlines += self.expecting
+            elif self.carry:
+                self.carry += memoryview(data)[start:end + 1]
+                line, self.carry = self.carry, bytearray()
+                self.line(line, 0, len(line), items)
+            elif end + 1 - start > LINE_LIMIT:
+                self.fragment(data, start, end + 1)
+                self.nlines += self.expecting
+            else:
+                self.line(data, start, end + 1, items)
+            start = end + 1
+        return items
+
+    def carry_over(self, data, start, size):
+        """
+        Keep the start of a line split across reads, or pass on an overlong one without keeping it
+        """
+        if self.overlong or len(self.carry) + size - start > LINE_LIMIT:
+            if self.carry:
+                self.fragment(self.carry, 0, len(self.carry))
+                self.carry = bytearray()
+            self.fragment(data, start, size)
+            self.overlong = True
+        else:
+            self.carry += memoryview(data)[start:size]
+
+    def fragment(self, buffer, start, end):
+        """
+        Part of an overlong line: response bytes while a command is in flight, dropped otherwise
+        """
+        if self.expecting:
+            self.store(buffer, start, end)
+
+    def store(self, buffer, start, end, keep=False):
+        """
+        Add response bytes, kept while they fit in the limit (always with keep), and pass them to on_data
+        """
+        self.nbytes += end - start
+        stop = end if keep or len(self.data) + end - start <= self.limit else start
+        if stop > start:
+            self.data += memoryview(buffer)[start:stop]
+        if stop < end:
+            self.truncated = True
+        if self.on_data is not None:
+            self.on_data(memoryview(buffer)[start:end])
+
+    def line(self, buffer, start, end, items):
+        """
+        Classify the complete line buffer[start:end], newline included
+        """
+        first, last = start, end
+        while first < last and buffer[first] in b" \t\r\n":
+            first += 1
+        while last > first and buffer[last - 1] in b" \t\r\n":
+            last -= 1
+        if first == last:
+            if self.expecting:
+                self.store(buffer, start, end)
+            return
+        code = last - first <= 5 and bytes(buffer[first:last]) in FINAL_RESULT_CODES  # 5: len(b"ERROR")
+        final = code or buffer.startswith(FINAL_RESULT_PREFIXES, first, last)
+        if self.is_urc(buffer, first, last):
+            if not code:  # A stray final result has nobody to go to
+                items.append(URC(buffer[first:last].decode(errors='ignore')))
+            return
+        self.store(buffer, start, end, keep=final)  # The final result line is kept even past the limit
+        self.nlines += 1
+        if final:
+            items.append(Response(self.data, buffer[first:last].decode(errors='ignore'), self.nbytes, self.nlines,
+                                  self.truncated))
+            self.reset()
+            self.expecting = False
+            self.on_line = None
+            self.on_data = None
+        elif self.on_line is not None:
+            self.on_line(buffer[first:last].decode(errors='ignore'))
+
+    def pending(self):
+        """
+        Bytes of the response in flight received so far
+        """
+        return bytes(self.data + self.carry)
+
+
+def receive_response(client_socket, command):
+    """
+    Receive server response to command until a final result code (OK, ERROR, +CME ERROR, +CMS ERROR) line
+    URCs arriving meanwhile are printed and kept out of the response, which is returned as a Response
+    """
+    framer = ResponseFramer()
+    framer.begin(command)
+    buffer = bytearray(BUFFER_SIZE)
+    while True:
+        size = client_socket.recv_into(buffer)
+        if not size:
+            raise ConnectionError("Server closed the connection")
+        for item in framer.feed(buffer, size):
+            if isinstance(item, URC):
+                print(f"Received URC: {item.line}")
+            else:
+                print(f"Received response ({item.nbytes} bytes, {item.nlines} lines): {item.excerpt()}")
+                return item  # Received final result code, consider the command processing is done
 
 def handle_commands(client_socket):
     """
@@ -54,34 +433,1725 @@ def handle_commands(client_socket):
                 conn, _ = unix_socket.accept()
                 with conn:
                     command = conn.recv(1024).decode().strip()
-                    if command:
+                    if command.startswith("{"):
+                        # Framed clients fall back to raw commands on this reply
+                        conn.sendall(b"ERROR: framed protocol needs the asyncio broker")
+                    elif command:
                         print(f"Received command: {command}")
                         unix_socket.settimeout(TIMEOUT)  # Reset to 2 minutes timeout
-                        send_command(client_socket, command)
-                        response = receive_response(client_socket)
+                        try:
+                            send_command(client_socket, command)
+                            response = receive_response(client_socket, command)
+                        except OSError:
+                            # Link lost: answer the client, then reconnect right away
+                            conn.sendall(b"No response received from server")
+                            raise
 
                         # Send the response back to terminal
-                        if response:
-                            conn.sendall(response.encode())
+                        if response.data:
+                            conn.sendall(response.data)
                         else:
                             conn.sendall(b"No response received from server")
             except socket.timeout:
                 break  # No command received within 2 minutes, attempt to reconnect
 
-def main():
+def legacy_main():
+    attempt = 0
     while True:
         try:
             print("Attempting to connect to server...")
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
                 client_socket.settimeout(60)
                 client_socket.connect((SERVER_IP, SERVER_PORT))
+                set_keepalive(client_socket)
                 print("Connected to server.")
+                attempt = 0
                 handle_commands(client_socket)
         except socket.timeout:
             print("Connection timeout, retrying...")
         except Exception as e:
             print(f"Error: {e}")
-        time.sleep(RETRY_DELAY)
+        time.sleep(backoff(attempt))
+        attempt += 1
+
+class LinkProtocol(asyncio.BufferedProtocol):
+    """
+    Modem connection reading straight into one preallocated buffer, no bytes object per read
+    """
+    def __init__(self, link):
+        self.link = link
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.transport = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        self.link.received(self, nbytes)
+
+    def eof_received(self):
+        self.link.lost_connection(self, ConnectionError("Server closed the connection"))
+
+    def connection_lost(self, exc):
+        self.link.lost_connection(self, exc or ConnectionError("Server closed the connection"))
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+class ModemLink:
+    """
+    Persistent TCP session to the modem
+    The socket is read continuously into a preallocated buffer, responses go to the command
+    in flight and URCs to on_urc. Only one command is on the wire at a time.
+    supervise() keeps the link up: it reconnects as soon as a read or write fails,
+    and sends an "AT" heartbeat when the link has been silent for HEARTBEAT_INTERVAL
+    """
+    def __init__(self, host=SERVER_IP, port=SERVER_PORT, on_urc=None, name=None):
+        self.host = host
+        self.port = port
+        self.on_urc = on_urc
+        self.prefix = f"[{name}] " if name else ""  # Tags log lines when the broker runs a fleet
+        self.protocol = None  # LinkProtocol of the current connection
+        self.framer = None
+        self.pending = None  # Future of the Response in flight
+        self.lock = asyncio.Lock()  # Held while a command is on the wire
+        self.up = asyncio.Event()  # Set while connected
+        self.lost = asyncio.Event()  # Set once the current connection drops
+        self.down_since = time.monotonic()
+        self.last_activity = 0  # Monotonic time of the last byte received
+        self.reboot_until = 0  # Monotonic end of the last reboot, inf until the link is back
+        self.trace = None  # Trace of the command in flight, if it is instrumented
+        self.capture = None  # capture.CaptureLink recording the bytes of the link, None when off
+
+    @property
+    def connected(self):
+        return self.protocol is not None and not self.protocol.transport.is_closing()
+
+    @property
+    def rebooting(self):
+        return time.monotonic() < self.reboot_until
+
+    async def connect(self):
+        """
+        Connect to the modem, retrying with exponential backoff and jitter until it succeeds
+        The link only counts as up once the modem answers "AT", a rebooting modem may accept and drop connections
+        """
+        attempt = 0
+        while not self.up.is_set():
+            try:
+                print(f"{self.prefix}Attempting to connect to server...")
+                self.framer = ResponseFramer()
+                _, self.protocol = await asyncio.wait_for(asyncio.get_running_loop().create_connection(
+                    lambda: LinkProtocol(self), self.host, self.port), CONNECT_TIMEOUT)
+                if self.capture is not None:
+                    self.capture.connect()
+                sock = self.protocol.transport.get_extra_info("socket")
+                if sock is not None:
+                    set_keepalive(sock)
+                await self.execute("AT", HEARTBEAT_TIMEOUT, log=False)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.drop(e if isinstance(e, OSError) else ConnectionError("No answer to AT"))
+                delay = backoff(attempt, REBOOT_RECONNECT_DELAY if self.reboot_until == math.inf else RECONNECT_MAX_DELAY)
+                attempt += 1
+                print(f"{self.prefix}Connection error: {e!r}, retrying in {delay:.2f}s...")
+                await asyncio.sleep(delay)
+                continue
+            self.lost.clear()
+            self.up.set()
+            if self.reboot_until == math.inf:
+                self.reboot_until = time.monotonic() + REBOOT_SETTLE
+            print(f"{self.prefix}Connected to server, link was down {time.monotonic() - self.down_since:.2f}s.")
+
+    def drop(self, error):
+        """
+        Tear the connection down and fail the command in flight, supervise() reconnects
+        """
+        if self.pending is not None and not self.pending.done():
+            self.pending.set_exception(error)
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            if self.capture is not None:
+                self.capture.close()
+        self.protocol = None
+        if self.up.is_set():
+            print(f"{self.prefix}Modem link lost: {error!r}")
+            self.up.clear()
+            self.lost.set()
+            self.down_since = time.monotonic()
+
+    async def close(self):
+        protocol = self.protocol
+        self.drop(ConnectionError("Modem link closed"))
+        if protocol is not None:
+            await protocol.closed
+
+    async def wait_up(self, wait=LINK_WAIT):
+        """
+        Wait for the link to come back, at most until wait seconds after it dropped
+        Returns whether it is up, so commands queued during a long outage fail fast
+        """
+        remaining = self.down_since + wait - time.monotonic()
+        if not self.up.is_set() and remaining > 0:
+            try:
+                await asyncio.wait_for(self.up.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return self.up.is_set()
+
+    async def supervise(self):
+        """
+        Keep the link up for the lifetime of the broker
+        """
+        while True:
+            await self.connect()
+            while self.up.is_set():
+                idle = time.monotonic() - self.last_activity
+                if idle < HEARTBEAT_INTERVAL or self.lock.locked():
+                    try:
+                        await asyncio.wait_for(self.lost.wait(), max(HEARTBEAT_INTERVAL - idle, 1))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                try:
+                    await self.execute("AT", HEARTBEAT_TIMEOUT, log=False)
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"{self.prefix}Heartbeat failed: {e!r}")
+
+    def received(self, protocol, nbytes):
+        """
+        Demultiplex the bytes just read into the pending Response and URCs
+        """
+        if protocol is not self.protocol:
+            return
+        self.last_activity = time.monotonic()
+        if self.trace is not None and self.trace.first_byte is None:
+            self.trace.first_byte = self.last_activity
+        if self.capture is not None:
+            self.capture.rx(protocol.view[:nbytes])  # Before the framer, it may reuse the buffer
+        for item in self.framer.feed(protocol.buffer, nbytes):
+            if self.reboot_until != math.inf and self.rebooting:
+                self.settle(item)
+            if isinstance(item, URC):
+                if self.on_urc is not None:
+                    self.on_urc(item)
+            elif self.pending is not None and not self.pending.done():
+                self.pending.set_result(item)
+
+    def lost_connection(self, protocol, error):
+        if protocol is self.protocol:
+            self.drop(error)
+
+    def pause(self):
+        """
+        Stop reading the modem until resume(), while a client cannot keep up with a relayed response
+        """
+        if self.connected:
+            self.protocol.transport.pause_reading()
+
+    def resume(self):
+        if self.connected:
+            self.protocol.transport.resume_reading()
+
+    def settle(self, item):
+        """
+        End the reboot in progress once a URC or response reports NR/LTE service, instead of waiting out REBOOT_SETTLE
+        """
+        lines = [item.line] if isinstance(item, URC) else item.lines
+        if any(line.startswith(SERVICE_LINES) for line in lines):
+            print(f"{self.prefix}Modem serving again, {self.reboot_until - time.monotonic():.2f}s of settle time skipped.")
+            self.reboot_until = time.monotonic()
+
+    async def execute(self, command, timeout=MODEM_TIMEOUT, on_line=None, log=True, trace=None, on_data=None):
+        """
+        Send AT command and wait for its final result code, return a Response
+        Raises ConnectionError at once while the link is down. The link is dropped on any
+        failure, a half-read response must not leak into the next command.
+        trace, if given, gets the write, first byte and final result times, on_data the response bytes as they arrive
+        """
+        log = log and LOG_COMMANDS
+        async with self.lock:
+            if not self.connected:
+                raise ConnectionError("Modem link is down")
+            self.pending = asyncio.get_running_loop().create_future()
+            self.framer.begin(command, on_line, on_data)
+            self.trace = trace
+            try:
+                if log:
+                    print(f"{self.prefix}Sending command: {command}")
+                data = command.encode() + b"\r"
+                self.protocol.transport.write(data)  # A few bytes, the modem never keeps them waiting
+                if self.capture is not None:
+                    self.capture.tx(data)
+                if trace is not None:
+                    trace.written = time.monotonic()
+                    trace.bytes_out = len(data)
+                response = await asyncio.wait_for(self.pending, timeout)
+                if trace is not None:
+                    trace.finished = time.monotonic()
+                    trace.bytes_in = response.nbytes
+            except OSError as e:
+                self.drop(e)
+                raise
+            except asyncio.TimeoutError:
+                self.drop(ConnectionError(f"No response to {command} within {timeout}s"))
+                raise
+            finally:
+                self.pending = None
+                self.trace = None
+            if log:
+                print(f"{self.prefix}Received response ({response.nbytes} bytes, {response.nlines} lines): "
+                      f"{response.excerpt()}")
+            if response.ok and command_key(command) in REBOOT_COMMANDS:
+                # Reconnect right away instead of waiting for the dead socket to time out
+                self.reboot_until = math.inf
+                self.drop(ConnectionError("Modem rebooting"))
+            return response
+
+
+class Job:
+    """
+    One client command waiting for the modem
+    """
+    __slots__ = ("command", "client_id", "future", "enqueued", "modem_timeout", "on_line", "priority", "on_data")
+
+    def __init__(self, command, client_id, future, modem_timeout=MODEM_TIMEOUT, on_line=None, priority="control",
+                 on_data=None):
+        self.command = command
+        self.client_id = client_id
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.modem_timeout = modem_timeout
+        self.on_line = on_line
+        self.priority = priority
+        self.on_data = on_data
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ScanError(Exception):
+    pass
+
+
+class ScanJob:
+    """
+    One cell scan: AT+COPS=2, AT^CELLSCAN=3 retried until it returns OK, then AT+COPS=0
+    ^CELLSCAN: lines are collected and pushed to listeners as they arrive
+    """
+    def __init__(self, job_id, deadline=SCAN_DEADLINE, attempts=SCAN_ATTEMPTS):
+        self.id = job_id
+        self.deadline = deadline
+        self.max_attempts = attempts
+        self.attempts = 0
+        self.state = "queued"  # queued, running, done, failed
+        self.error = None
+        self.cells = []
+        self.seen = set()  # A retried scan reports the same cells again
+        self.listeners = set()
+        self.task = None
+        self.created = time.time()
+        self.started = None
+        self.scanned = None  # When AT^CELLSCAN=3 returned OK
+        self.finished = None
+
+    def add_line(self, line):
+        if line.startswith("^CELLSCAN:") and line not in self.seen:
+            self.seen.add(line)
+            self.cells.append(line)
+            for listener in list(self.listeners):
+                listener({"job": self.id, "cell": line})
+
+    def status(self, cells=True):
+        status = {
+            "job": self.id,
+            "state": self.state,
+            "attempts": self.attempts,
+            "timing": {
+                "created": self.created,
+                "started": self.started,
+                "scanned": self.scanned,
+                "finished": self.finished,
+                "duration": round(self.finished - self.started, 3) if self.finished and self.started else None,
+            },
+        }
+        if self.error:
+            status["error"] = self.error
+        if cells:
+            status["cells"] = self.cells
+        return status
+
+
+# Control characters are refused in client commands: an embedded CR or LF would send a second command to the modem
+# past the checks of the first (read-only tokens, priority classes, cache invalidation)
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x1f\x7f]")
+
+def command_key(command):
+    """
+    Normalized form of an AT command used for caching
+    """
+    return command.strip().upper()
+
+def command_name(command):
+    """
+    Name of an AT command without the AT prefix and parameters, e.g. "^NRFREQLOCK" for AT^NRFREQLOCK=0
+    """
+    match = re.match(r"AT([+^&%$]?[A-Z0-9]+)", command_key(command))
+    return match.group(1) if match else ""
+
+def is_query(command):
+    """
+    Whether command only reads: one query-form command ("...?"), cached and scheduled as telemetry.
+    A chain such as AT+CFUN=0;^HCSQ? also sets, it is control traffic and never answered from the cache
+    """
+    key = command_key(command)
+    return key.endswith("?") and ";" not in key
+
+
+class ResponseCache:
+    """
+    TTL cache for query-form commands
+    Identical queries in flight at the same time share one modem round trip,
+    set commands invalidate the entries they make stale
+    """
+    def __init__(self, size=CACHE_SIZE, ttls=CACHE_TTL, default_ttl=CACHE_DEFAULT_TTL):
+        self.size = size
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.entries = collections.OrderedDict()  # key -> (expires, response), LRU order
+        self.inflight = {}  # key -> future of the query on its way to the modem
+        self.generation = 0  # Bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def ttl(self, key):
+        if not is_query(key):
+            return 0
+        return self.ttls.get(key, self.default_ttl)
+
+    async def get(self, key, fetch):
+        """
+        Return the cached Response for key, or the Response of the coroutine fetch()
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            future = asyncio.ensure_future(fetch())
+            self.inflight[key] = future
+            generation = self.generation
+            future.add_done_callback(lambda f: self.fetched(key, generation, f))
+        # A waiter giving up must not cancel the fetch the others share
+        return await asyncio.shield(future)
+
+    def fetched(self, key, generation, future):
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        response = future.result()
+        # An invalidation while the query was out means the answer may predate the change
+        if response.ok and not response.truncated and generation == self.generation:
+            self.entries[key] = (time.monotonic() + self.ttl(key), response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, command):
+        """
+        Drop the entries a set command makes stale, all of them for a chain of commands
+        """
+        name = command_name(command)
+        if not name:
+            return  # Plain "AT" changes nothing
+        stale = set(CACHE_INVALIDATES.get(name, ())) | {name}
+        self.generation += 1
+        if "*" in stale or ";" in command:
+            self.entries.clear()
+            self.inflight.clear()
+            return
+        for store in (self.entries, self.inflight):
+            for key in [key for key in store if command_name(key) in stale]:
+                del store[key]
+
+
+class FairQueue:
+    """
+    FIFO queue per client, served round-robin
+    A client with many pending commands cannot starve the others
+    """
+    def __init__(self):
+        self.clients = collections.OrderedDict()  # client_id -> deque of jobs
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, job):
+        self.clients.setdefault(job.client_id, collections.deque()).append(job)
+        self.size += 1
+
+    def pop(self):
+        client_id, jobs = self.clients.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            self.clients[client_id] = jobs  # Back of the rotation
+        self.size -= 1
+        return job
+
+
+def command_priority(command):
+    """
+    Class of a command sent without one: queries are telemetry, anything else is control
+    """
+    return "telemetry" if is_query(command) else "control"
+
+
+def summarize(values):
+    """
+    Mean, p50, p99 and max of a window of durations, in milliseconds
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+    return {
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": round(pick(50) * 1000, 3),
+        "p99": round(pick(99) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+class ClassStats:
+    """
+    Counters and the latest queue-wait / modem service times of one priority class
+    """
+    __slots__ = ("dispatched", "rejected", "failed", "wait", "service")
+
+    def __init__(self):
+        self.dispatched = 0
+        self.rejected = 0
+        self.failed = 0
+        self.wait = collections.deque(maxlen=STATS_WINDOW)
+        self.service = collections.deque(maxlen=STATS_WINDOW)
+
+
+def result_class(response):
+    """
+    Outcome of a command for the result counters: ok, error, cme_error or cms_error
+    """
+    if response.ok:
+        return "ok"
+    if response.result.startswith("+CME ERROR"):
+        return "cme_error"
+    if response.result.startswith("+CMS ERROR"):
+        return "cms_error"
+    return "error"
+
+
+class Trace:
+    """
+    Timings and outcome of one command sent to the modem, times are monotonic
+    """
+    __slots__ = ("command", "client_id", "priority", "enqueued", "dispatched", "written", "first_byte",
+                 "finished", "bytes_out", "bytes_in", "result")
+
+    def __init__(self, job):
+        self.command = job.command
+        self.client_id = job.client_id
+        self.priority = job.priority
+        self.enqueued = job.enqueued
+        self.dispatched = self.written = self.first_byte = self.finished = None
+        self.bytes_out = self.bytes_in = 0
+        self.result = None  # ok, error, cme_error, cms_error, timeout, link_error or link_down
+
+    def phases(self):
+        """
+        (phase, seconds) of every phase the command got through
+        queue: enqueue to dispatch, write: dispatch to written, first_byte and final: written to
+        the first byte and to the final result code, total: enqueue to the final result code
+        """
+        for phase, start, end in zip(TRACE_PHASES, (self.enqueued, self.dispatched, self.written, self.written,
+                                                    self.enqueued),
+                                     (self.dispatched, self.written, self.first_byte, self.finished, self.finished)):
+            if start is not None and end is not None:
+                yield phase, end - start
+
+    def to_dict(self, modem_id, now=None):
+        now = now or time.monotonic()
+        record = {"time": round(time.time() - (now - self.enqueued), 3), "modem": modem_id, "client": self.client_id,
+                  "command": self.command, "priority": self.priority, "result": self.result,
+                  "bytes_out": self.bytes_out, "bytes_in": self.bytes_in}
+        for phase, seconds in self.phases():
+            record[phase + "_ms"] = round(seconds * 1000, 3)
+        return record
+
+
+class Histogram:
+    """
+    Counts of durations in the HISTOGRAM_BUCKETS, with their sum
+    """
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.sum += value
+
+    def to_dict(self):
+        """
+        Cumulative buckets like Prometheus: [[upper bound, count of values <= bound], ..., ["+Inf", count]]
+        """
+        buckets = list(zip(HISTOGRAM_BUCKETS + ("+Inf",), itertools.accumulate(self.counts)))
+        return {"buckets": buckets, "count": buckets[-1][1], "sum": round(self.sum, 6)}
+
+
+class CommandMetrics:
+    """
+    Per-command instrumentation of one modem: phase histograms and result counters per priority class,
+    byte counts, the latest TRACE_RING commands, and a sampled JSON line per command to trace_file
+    """
+    def __init__(self, modem_id, trace_file=None, sample=TRACE_SAMPLE, ring=TRACE_RING):
+        self.modem_id = modem_id
+        self.trace_file = trace_file
+        self.sample = sample
+        self.histograms = {}  # (phase, priority) -> Histogram
+        self.results = collections.Counter()  # (priority, result) -> commands
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.ring = collections.deque(maxlen=ring)
+
+    def record(self, trace):
+        for phase, seconds in trace.phases():
+            histogram = self.histograms.get((phase, trace.priority))
+            if histogram is None:
+                histogram = self.histograms[(phase, trace.priority)] = Histogram()
+            histogram.observe(seconds)
+        self.results[(trace.priority, trace.result)] += 1
+        self.bytes_out += trace.bytes_out
+        self.bytes_in += trace.bytes_in
+        self.ring.append(trace)
+        if self.trace_file is not None and (self.sample >= 1 or random.random() < self.sample):
+            self.trace_file.write(json.dumps(trace.to_dict(self.modem_id)) + "\n")
+
+    def status(self):
+        """
+        {"histograms": {phase: {priority: histogram}}, "results": {priority: {result: n}}, "bytes_out", "bytes_in"}
+        """
+        histograms = {}
+        for phase in TRACE_PHASES:
+            for priority in PRIORITY_CLASSES:
+                if (phase, priority) in self.histograms:
+                    histograms.setdefault(phase, {})[priority] = self.histograms[(phase, priority)].to_dict()
+        results = {}
+        for (priority, result), count in sorted(self.results.items(), key=lambda item: (
+                PRIORITY_CLASSES.index(item[0][0]), item[0][1])):
+            results.setdefault(priority, {})[result] = count
+        return {"histograms": histograms, "results": results, "bytes_out": self.bytes_out, "bytes_in": self.bytes_in}
+
+    def recent(self, last=TRACE_RING):
+        now = time.monotonic()
+        traces = list(self.ring)[-last:] if last > 0 else []
+        return [trace.to_dict(self.modem_id, now) for trace in traces]
+
+
+class Scheduler:
+    """
+    Priority queue of modem commands
+    Classes are served strictly in PRIORITY_CLASSES order and round-robin between clients
+    within a class. A class over its rate limit or held back by deferred() is skipped
+    so the classes below it keep running, a class at its depth limit rejects new commands
+    """
+    def __init__(self, limits=PRIORITY_LIMITS, deferred=None):
+        self.limits = limits
+        self.deferred = deferred or (lambda: ())  # Returns the classes held back right now
+        self.queues = {name: FairQueue() for name in PRIORITY_CLASSES}
+        self.stats = {name: ClassStats() for name in PRIORITY_CLASSES}
+        now = time.monotonic()
+        self.tokens = {name: self.burst(name) for name in PRIORITY_CLASSES}
+        self.refilled = {name: now for name in PRIORITY_CLASSES}
+        self.event = asyncio.Event()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def burst(self, name):
+        return max(1, self.limits[name]["rate"] * RATE_BURST)
+
+    def put(self, job):
+        queue = self.queues[job.priority]
+        if len(queue) >= self.limits[job.priority]["depth"]:
+            self.stats[job.priority].rejected += 1
+            raise QueueFull(f"{job.priority} queue is full")
+        queue.put(job)
+        self.event.set()
+
+    def refill(self, name, now):
+        """
+        Top up the rate tokens of a class, return the seconds until it has one (0: it has)
+        """
+        rate = self.limits[name]["rate"]
+        if not rate:
+            return 0
+        self.tokens[name] = min(self.burst(name), self.tokens[name] + (now - self.refilled[name]) * rate)
+        self.refilled[name] = now
+        return max(0, (1 - self.tokens[name]) / rate)
+
+    async def get(self):
+        while True:
+            now = time.monotonic()
+            deferred = self.deferred()
+            delay = None
+            for name in PRIORITY_CLASSES:
+                queue = self.queues[name]
+                if not queue:
+                    continue
+                if name in deferred:
+                    delay = SCHEDULER_POLL if delay is None else min(delay, SCHEDULER_POLL)
+                    continue
+                wait = self.refill(name, now)
+                if wait:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                job = queue.pop()
+                if job.future.done():
+                    break  # Client gave up while queued, costs no token
+                if self.limits[name]["rate"]:
+                    self.tokens[name] -= 1
+                return job
+            else:
+                self.event.clear()
+                try:
+                    await asyncio.wait_for(self.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def status(self):
+        """
+        Per class queue depth, limits, counters and queue-wait / service time summaries
+        """
+        deferred = self.deferred()
+        return {
+            name: {
+                "queued": len(self.queues[name]),
+                "depth": self.limits[name]["depth"],
+                "rate": self.limits[name]["rate"],
+                "deferred": name in deferred,
+                "dispatched": self.stats[name].dispatched,
+                "rejected": self.stats[name].rejected,
+                "failed": self.stats[name].failed,
+                "wait_ms": summarize(self.stats[name].wait),
+                "service_ms": summarize(self.stats[name].service),
+            }
+            for name in PRIORITY_CLASSES
+        }
+
+
+class Modem:
+    """
+    One MT5700M unit: its link, command scheduler, response cache and scan jobs
+    """
+    def __init__(self, modem_id, link, cache=None, metrics=None, status=None, status_refresh=STATUS_REFRESH,
+                 limits=PRIORITY_LIMITS):
+        self.id = modem_id
+        self.link = link
+        self.cache = cache
+        self.metrics = metrics  # CommandMetrics, None when instrumentation is off
+        self.status = status  # livestatus.StatusSlot the decoded values are published to, None when off
+        self.status_refresh = status_refresh
+        self.queue = Scheduler(limits, deferred=self.deferred)
+        self.scans = collections.OrderedDict()  # job id -> ScanJob
+        self.scan_ids = itertools.count(1)
+
+    async def submit(self, command, client_id, timeout=CLIENT_TIMEOUT, cached=True,
+                     modem_timeout=MODEM_TIMEOUT, on_line=None, priority=None, on_data=None):
+        """
+        Queue a command in its priority class and wait for its Response
+        on_data gets its bytes as they arrive, unless it is answered from the cache or shares a query in flight
+        Raises asyncio.TimeoutError if the client's deadline passes first, the job is then dropped from the queue,
+        and QueueFull if its class is at the depth limit
+        """
+        priority = priority or command_priority(command)
+        if self.cache is not None:
+            key = command_key(command)
+            if not is_query(key):
+                self.cache.invalidate(command)
+            elif cached and self.cache.ttl(key) > 0:
+                return await asyncio.wait_for(
+                    self.cache.get(key, lambda: self.enqueue(command, client_id, priority=priority)), timeout)
+        return await asyncio.wait_for(self.enqueue(command, client_id, modem_timeout, on_line, priority, on_data),
+                                      timeout)
+
+    def enqueue(self, command, client_id, modem_timeout=MODEM_TIMEOUT, on_line=None, priority="control",
+                on_data=None):
+        """
+        Queue a command, return the future of its Response
+        """
+        job = Job(command, client_id, asyncio.get_running_loop().create_future(), modem_timeout, on_line, priority,
+                  on_data)
+        self.queue.put(job)
+        return job.future
+
+    def deferred(self):
+        """
+        Priority classes held back right now, see DEFER_DURING
+        """
+        classes = set()
+        if any(job.state == "running" for job in self.scans.values()):
+            classes.update(DEFER_DURING["scan"])
+        if self.link.rebooting:
+            classes.update(DEFER_DURING["reboot"])
+        return classes
+
+    async def run(self):
+        """
+        Feed queued jobs to the modem one at a time
+        While the link is down jobs wait up to LINK_WAIT for it, then fail fast
+        """
+        supervisor = asyncio.create_task(self.link.supervise())
+        publisher = asyncio.create_task(self.publish_status()) if self.status is not None else None
+        try:
+            await self.feed()
+        finally:
+            supervisor.cancel()
+            if publisher is not None:
+                publisher.cancel()
+
+    async def feed(self):
+        while True:
+            job = await self.queue.get()
+            stats = self.queue.stats[job.priority]
+            trace = Trace(job) if self.metrics is not None else None
+            if not await self.link.wait_up(self.queue.limits[job.priority]["link_wait"]):
+                stats.failed += 1
+                if trace is not None:
+                    trace.result = "link_down"
+                    self.metrics.record(trace)
+                if not job.future.done():
+                    job.future.set_exception(ConnectionError("Modem link is down"))
+                continue
+            if job.future.done():
+                continue  # Client gave up while waiting for the link
+            started = time.monotonic()
+            stats.dispatched += 1
+            stats.wait.append(started - job.enqueued)
+            if trace is not None:
+                trace.dispatched = started
+            try:
+                response = await self.link.execute(job.command, job.modem_timeout, job.on_line, trace=trace,
+                                                   on_data=job.on_data)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"Error: {e!r}")
+                stats.failed += 1
+                if trace is not None:
+                    trace.result = "timeout" if isinstance(e, asyncio.TimeoutError) else "link_error"
+                    self.metrics.record(trace)
+                if not job.future.done():
+                    job.future.set_exception(ConnectionError(f"Modem link failed: {e!r}"))
+                continue
+            finally:
+                stats.service.append(time.monotonic() - started)
+            if trace is not None:
+                trace.result = result_class(response)
+                self.metrics.record(trace)
+            if self.cache is not None and not is_query(job.command):
+                self.cache.invalidate(job.command)  # Again, for queries answered while this one was queued
+            if self.status is not None and command_key(job.command) in STATUS_QUERIES.values():
+                self.status.update(response.parse(job.command))  # Whoever asked, every reader gets the value
+            if not job.future.done():
+                job.future.set_result(response)
+
+    async def publish_status(self):
+        """
+        Keep the status slot current: the link state at once when it changes and at least every
+        STATUS_HEARTBEAT, and the STATUS_QUERIES nobody else sent within status_refresh, at telemetry priority
+        """
+        while True:
+            up = self.link.up.is_set()
+            self.status.link(up, self.link.rebooting)
+            if up and self.status_refresh and not self.link.rebooting:
+                now = time.time()
+                for section, command in STATUS_QUERIES.items():
+                    if self.status.age(section, now) < self.status_refresh:
+                        continue
+                    try:
+                        response = await self.submit(command, "status", priority="telemetry")
+                    except (OSError, asyncio.TimeoutError, QueueFull):
+                        break  # Link trouble, the state is published on the next round
+                    self.status.update(response.parse(command))  # Also when it came from the cache
+            try:
+                await asyncio.wait_for((self.link.lost if up else self.link.up).wait(), STATUS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                pass
+
+    def start_scan(self, deadline=SCAN_DEADLINE, attempts=SCAN_ATTEMPTS):
+        """
+        Start a scan job and return it, or return the job already in progress
+        """
+        for job in self.scans.values():
+            if job.state in ("queued", "running"):
+                return job
+        job = ScanJob(next(self.scan_ids), deadline, attempts)
+        self.scans[job.id] = job
+        while len(self.scans) > SCAN_JOBS_KEPT:
+            self.scans.popitem(last=False)
+        job.task = asyncio.create_task(self.run_scan(job))
+        return job
+
+    async def run_scan(self, job):
+        loop = asyncio.get_running_loop()
+        end = loop.time() + job.deadline
+        job.state = "running"
+        job.started = time.time()
+        state = "failed"
+        try:
+            await self.scan_step(job, "AT+COPS=2", end, SCAN_STEP_ATTEMPTS)
+            await self.scan_step(job, "AT^CELLSCAN=3", end, job.max_attempts, job.add_line)
+            job.scanned = time.time()
+            state = "done"
+        except asyncio.TimeoutError:
+            job.error = f"deadline of {job.deadline}s exceeded"
+        except (OSError, ScanError) as e:
+            job.error = str(e)
+        finally:
+            # The job stays running until registration is restored, so a new scan cannot overlap it
+            try:
+                await self.scan_step(job, "AT+COPS=0", loop.time() + SCAN_RESTORE_TIMEOUT, SCAN_STEP_ATTEMPTS)
+            except (OSError, ScanError, asyncio.TimeoutError) as e:
+                job.error = f"{job.error + '; ' if job.error else ''}AT+COPS=0 failed: {e!r}"
+            job.state = state
+            job.finished = time.time()
+            print(f"Scan job {job.id} {job.state} in {job.finished - job.started:.1f}s, {len(job.cells)} cells")
+
+    async def scan_step(self, job, command, end, attempts, on_line=None):
+        """
+        Run one command of a scan job, retrying until it returns OK, attempts run out or end passes
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, attempts + 1):
+            if command == "AT^CELLSCAN=3":
+                job.attempts = attempt
+            remaining = end - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                response = await self.submit(command, f"scan-{job.id}", remaining,
+                                             modem_timeout=min(remaining, SCAN_MODEM_TIMEOUT), on_line=on_line,
+                                             priority="scan")
+                if response.ok:
+                    return response
+                print(f"Command '{command}' failed with {response.result}. Retrying...")
+            except (OSError, QueueFull) as e:
+                print(f"Command '{command}' failed: {e!r}. Retrying...")
+            if attempt < attempts:
+                await asyncio.sleep(max(0, min(SCAN_RETRY_DELAY, end - loop.time())))
+        raise ScanError(f"{command} failed after {attempts} attempts")
+
+
+    def status(self):
+        """
+        Scheduler, link and cache statistics
+        """
+        status = {
+            "classes": self.queue.status(),
+            "deferred": sorted(self.deferred()),
+            "link": {"host": self.link.host, "port": self.link.port,
+                     "up": self.link.up.is_set(), "rebooting": self.link.rebooting},
+        }
+        if self.cache is not None:
+            status["cache"] = {"entries": len(self.cache.entries), "hits": self.cache.hits,
+                               "misses": self.cache.misses, "coalesced": self.cache.coalesced}
+        return status
+
+
+class Relay:
+    """
+    Pass the response bytes of a raw client's command to it as they arrive from the modem
+    Chunks are written as memoryviews of the link's receive buffer, the transport copies only what the socket
+    does not take at once. Past RELAY_HIGH_WATER unsent bytes the modem is no longer read until the client
+    catches up, so a runaway response costs at most RELAY_HIGH_WATER of memory here
+    """
+    def __init__(self, writer, link):
+        self.writer = writer
+        self.link = link
+        self.nbytes = 0
+        self.paused = False
+        self.cut = False  # The client stalled past RELAY_STALL_TIMEOUT and was disconnected
+
+    def write(self, chunk):
+        if self.cut or self.writer.is_closing():
+            return
+        self.writer.write(chunk)
+        self.nbytes += len(chunk)
+        if not self.paused and self.writer.transport.get_write_buffer_size() > RELAY_HIGH_WATER:
+            self.paused = True
+            self.link.pause()
+            asyncio.ensure_future(self.catch_up())
+
+    async def catch_up(self):
+        try:
+            await asyncio.wait_for(self.writer.drain(), RELAY_STALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Raw client stalled for {RELAY_STALL_TIMEOUT}s, disconnecting it")
+            self.cut = True
+            self.writer.transport.abort()
+        except OSError:
+            self.cut = True
+        finally:
+            self.paused = False
+            self.link.resume()
+
+
+class RemoteQuota:
+    """
+    Access of one --tokens entry, shared by every connection authenticated with its token:
+    token bucket of commands per second, commands in flight, open connections and usable priority classes
+    """
+    def __init__(self, name, quota):
+        self.name = name
+        self.quota = quota
+        self.rate = float(quota["rate"])
+        self.burst = max(float(quota["burst"]), 1)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.inflight = 0
+        self.connections = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def take(self, cost):
+        """
+        Take cost commands of the bucket, False when the rate is exceeded
+        """
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        cost = min(cost, self.burst)  # A fan-out wider than the burst waits for a full bucket
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def check(self, op, request, units):
+        """
+        Error of a request the token may not send now, None when it is admitted
+        units is the number of modems it is routed to
+        """
+        if op == "at":
+            command = str(request.get("cmd", "")).strip()  # As op_at sends it
+            if CONTROL_CHARACTERS.search(command):
+                return "control characters in cmd"
+            priority = request.get("priority") or command_priority(command)
+            if self.quota["readonly"] and not is_query(command):
+                return "read-only token, only queries are allowed"
+            if priority not in self.quota["priorities"]:
+                return f"priority not allowed: {priority}"
+            if self.inflight >= self.quota["inflight"]:
+                return "too many commands in flight"
+        elif op == "scan" and (self.quota["readonly"] or "scan" not in self.quota["priorities"]):
+            return "scan not allowed"
+        if not self.take(units if op == "at" else 1):
+            return "rate limit exceeded"
+        return None
+
+    def status(self):
+        return {"connections": self.connections, "inflight": self.inflight, "requests": self.requests,
+                "rejected": self.rejected, "quota": self.quota}
+
+
+class Broker:
+    """
+    Accept many Unix socket clients at once and serialize their commands onto the modem links of the fleet
+    A request is routed by its "modem" id, the first modem when it has none.
+    "modem": "*" or a list of ids fans it out to those units concurrently, the reply is merged by unit.
+    tokens, if given, are the RemoteQuota of each token digest (load_tokens()) TCP clients authenticate with
+    """
+    def __init__(self, modems, tokens=None):
+        self.modems = collections.OrderedDict((modem.id, modem) for modem in modems)
+        self.default = next(iter(self.modems.values()))
+        self.client_ids = itertools.count(1)
+        self.tokens = tokens or {}
+        self.remotes = {}  # client_id -> RemoteQuota of each authenticated TCP connection
+        self.gateway_clients = 0  # TCP connections open, authenticated or not
+        # (client_id, request id) -> (writer, set of URC names, set of modem ids), an empty set matches all
+        self.subscribers = {}
+        for modem in self.modems.values():
+            modem.link.on_urc = functools.partial(self.publish, modem.id)
+
+    def route(self, request):
+        """
+        Modems a request is for and whether it fans out
+        Raises ValueError for an unknown modem id
+        """
+        target = request.get("modem")
+        if target is None:
+            return [self.default], False
+        ids = list(self.modems) if target == "*" else target if isinstance(target, list) else [target]
+        unknown = [str(modem_id) for modem_id in ids if str(modem_id) not in self.modems]
+        if unknown:
+            raise ValueError(f"unknown modem: {', '.join(unknown)}")
+        return [self.modems[str(modem_id)] for modem_id in ids], target == "*" or isinstance(target, list)
+
+    @staticmethod
+    def merge(modems, results, fanout):
+        """
+        One reply body for the results of each modem: tagged with the modem id, or {"units": {id: result}}
+        """
+        if fanout:
+            return {"units": {modem.id: result for modem, result in zip(modems, results)}}
+        return dict(results[0], modem=modems[0].id)
+
+    async def run(self):
+        await asyncio.gather(*(modem.run() for modem in self.modems.values()))
+
+    async def handle_client(self, reader, writer):
+        """
+        Serve one client connection
+        A first byte of "{" selects the framed protocol, anything else is a raw command string
+        """
+        client_id = next(self.client_ids)
+        try:
+            data = await reader.read(1024)
+            if data.startswith(b"{"):
+                await self.serve_framed(client_id, data, reader, writer)
+            else:
+                await self.serve_raw(client_id, data, writer)
+        except OSError:
+            pass  # Client went away
+        finally:
+            writer.close()
+
+    async def handle_remote(self, reader, writer):
+        """
+        Serve one TCP connection of the remote gateway: the first line authenticates,
+        {"id": 0, "op": "auth", "token": "..."} -> {"id": 0, "result": "OK", "name": "noc", "quota": {...}},
+        then the framed protocol within the quota of the token
+        """
+        client_id = next(self.client_ids)
+        peer = writer.get_extra_info("peername")
+        peer = f"{peer[0]}:{peer[1]}" if peer else "?"
+        if self.gateway_clients >= REMOTE_MAX_CLIENTS:  # Connections waiting to authenticate count too
+            print(f"Remote client {peer}: too many connections")
+            self.reply(writer, {"id": None, "error": "too many connections"})
+            writer.close()
+            return
+        self.gateway_clients += 1
+        remote = None
+        try:
+            set_keepalive(writer.get_extra_info("socket"))  # Reset half-open connections of vanished hosts
+            try:
+                request = json.loads(await asyncio.wait_for(reader.readline(), REMOTE_AUTH_TIMEOUT))
+            except (asyncio.TimeoutError, ValueError):
+                request = None
+            if not isinstance(request, dict):
+                request = {}
+            token = request.get("token") if request.get("op") == "auth" else None
+            quota = self.tokens.get(hashlib.sha256(token.encode()).digest()) if isinstance(token, str) else None
+            if quota is None:
+                print(f"Remote client {peer}: authentication failed")
+                self.reply(writer, {"id": request.get("id"), "error": "authentication failed"})
+            elif quota.connections >= quota.quota["connections"]:
+                print(f"Remote client {peer} ({quota.name}): too many connections")
+                self.reply(writer, {"id": request.get("id"), "error": "too many connections for this token"})
+            else:
+                remote = self.remotes[client_id] = quota
+                remote.connections += 1
+                if LOG_COMMANDS:
+                    print(f"Remote client {peer} connected as {remote.name}")
+                self.reply(writer, {"id": request.get("id"), "result": "OK", "name": remote.name,
+                                    "quota": remote.quota})
+                await self.serve_framed(client_id, b"", reader, writer)
+            await writer.drain()
+        except OSError:
+            pass  # Client went away
+        finally:
+            self.gateway_clients -= 1
+            if remote is not None:
+                remote.connections -= 1
+                del self.remotes[client_id]
+            writer.close()
+
+    async def serve_raw(self, client_id, data, writer):
+        """
+        Raw-string client: one command per connection, reply, close
+        """
+        command = data.decode(errors='ignore').strip()
+        if CONTROL_CHARACTERS.search(command):
+            print(f"Refused command with control characters: {command!r}")
+            writer.write(b"Command contains control characters")
+            await writer.drain()
+        elif command:
+            if LOG_COMMANDS:
+                print(f"Received command: {command}")
+            writer.transport.set_write_buffer_limits(RELAY_HIGH_WATER)
+            relay = Relay(writer, self.default.link)
+            try:
+                response = await self.default.submit(command, client_id, on_data=relay.write)
+            except (OSError, asyncio.TimeoutError, QueueFull) as e:
+                print(f"Command '{command}' failed: {e!r}")
+                response = None
+
+            # Send the response back to terminal, unless it went out as it arrived
+            if response:
+                if not relay.nbytes:  # Answered from the cache or shared with a query in flight
+                    writer.write(response.data)
+            else:
+                writer.write(b"No response received from server")
+            if not relay.cut:
+                await writer.drain()
+
+    async def serve_framed(self, client_id, data, reader, writer):
+        """
+        Framed client: newline-delimited JSON requests tagged with an "id"
+        The connection stays open, requests may be pipelined in one write and
+        each tagged reply is written as soon as its command finishes.
+        A remote client is closed after REMOTE_IDLE_TIMEOUT without requests, commands in flight or subscriptions
+        """
+        buffer = bytearray(data)
+        tasks = set()
+        remote = client_id in self.remotes
+        try:
+            while True:
+                while True:
+                    end = buffer.find(b"\n")
+                    if end < 0:
+                        break
+                    line = bytes(buffer[:end])
+                    del buffer[:end + 1]
+                    self.dispatch(client_id, line, writer, tasks)
+                if not remote:
+                    data = await reader.read(BUFFER_SIZE)
+                else:
+                    try:
+                        data = await asyncio.wait_for(reader.read(BUFFER_SIZE), REMOTE_IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        if tasks or any(key[0] == client_id for key in self.subscribers):
+                            continue
+                        if LOG_COMMANDS:
+                            print(f"Remote client {self.remotes[client_id].name}: idle, closing")
+                        self.reply(writer, {"id": None, "error": "idle timeout"})
+                        return
+                if not data:
+                    break  # Client finished sending, answer what is pending
+                buffer.extend(data)
+            self.dispatch(client_id, bytes(buffer), writer, tasks)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for key in [key for key in self.subscribers if key[0] == client_id]:
+                del self.subscribers[key]
+
+    def dispatch(self, client_id, line, writer, tasks):
+        """
+        Start answering one framed request line
+        """
+        if not line.strip():
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as e:
+            self.reply(writer, {"id": None, "error": f"bad request: {e}"})
+            return
+        op = str(request.get("op", "at"))
+        handler = getattr(self, "op_" + op, None)
+        if handler is None:
+            self.reply(writer, {"id": request.get("id"), "error": f"unknown op: {request.get('op')}"})
+            return
+        remote = self.remotes.get(client_id)
+        if remote is not None:
+            try:
+                units = len(self.route(request)[0])
+            except ValueError:
+                units = 1  # The handler replies with the error
+            error = remote.check(op, request, units)
+            remote.requests += 1
+            if error:
+                remote.rejected += 1
+                self.reply(writer, {"id": request.get("id"), "error": error})
+                return
+        task = asyncio.create_task(handler(client_id, request, writer))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        if remote is not None and op == "at":
+            remote.inflight += 1
+            task.add_done_callback(lambda task: setattr(remote, "inflight", remote.inflight - 1))
+
+    def reply(self, writer, message):
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b"\n")
+
+    async def op_at(self, client_id, request, writer):
+        """
+        {"id": 1, "cmd": "AT^HCSQ?", "timeout": 30, "cache": true, "priority": "interactive", "modem": "unit1"}
+        -> {"id": 1, "modem": "unit1", "result": "OK", "response": "...", "bytes": 35, "lines": 2}
+        Without "priority" queries run as telemetry and other commands as control. With "parse": true the reply
+        also has "parsed", the atparse record of the response as a dict (null when there is no parser or it is invalid)
+        {"id": 2, "cmd": "AT^HCSQ?", "modem": "*"}
+        -> {"id": 2, "units": {"unit1": {"result": "OK", ...}, "unit2": {"error": "timeout"}}}
+        """
+        reply = {"id": request.get("id")}
+        command = str(request.get("cmd", "")).strip()
+        priority = request.get("priority")
+        try:
+            timeout = float(request.get("timeout", CLIENT_TIMEOUT))
+        except (TypeError, ValueError):
+            timeout = None
+        error = None
+        try:
+            modems, fanout = self.route(request)
+        except ValueError as e:
+            error = str(e)
+        if error:
+            reply["error"] = error
+        elif not command:
+            reply["error"] = "missing cmd"
+        elif CONTROL_CHARACTERS.search(command):
+            reply["error"] = "control characters in cmd"
+        elif timeout is None:
+            reply["error"] = "bad timeout"
+        elif priority is not None and priority not in PRIORITY_CLASSES:
+            reply["error"] = f"unknown priority: {priority}"
+        else:
+            if LOG_COMMANDS:
+                print(f"Received command: {command}")
+            cached = bool(request.get("cache", True))
+            parse = bool(request.get("parse", False))
+            results = await asyncio.gather(*(self.execute(modem, client_id, command, timeout, cached, priority, parse)
+                                             for modem in modems))
+            reply.update(self.merge(modems, results, fanout))
+        self.reply(writer, reply)
+        await writer.drain()
+
+    async def execute(self, modem, client_id, command, timeout, cached, priority, parse=False):
+        """
+        Run one command on one modem, return the reply fields
+        """
+        try:
+            response = await modem.submit(command, client_id, timeout, cached, priority=priority)
+            reply = {"result": response.result, "response": response.text,
+                     "bytes": response.nbytes, "lines": response.nlines}
+            if response.truncated:
+                reply["truncated"] = True  # "response" holds the first RESPONSE_LIMIT bytes and the final result
+            if parse:
+                record = response.parse(command)
+                reply["parsed"] = record.to_dict() if record is not None else None
+            return reply
+        except asyncio.TimeoutError:
+            return {"error": "timeout"}
+        except (OSError, QueueFull) as e:
+            return {"error": str(e)}
+
+
+    async def op_scan(self, client_id, request, writer):
+        """
+        {"id": 3, "op": "scan", "stream": true, "deadline": 180, "attempts": 5, "modem": "unit1"}
+        -> {"id": 3, "modem": "unit1", "job": 1, "state": "running", ...}
+        -> {"id": 3, "modem": "unit1", "job": 1, "cell": "^CELLSCAN: 3,..."}   one per cell as it is found (stream only)
+        -> {"id": 3, "modem": "unit1", "job": 1, "state": "done", "cells": [...], "timing": {...}}   (stream only)
+        Without "stream" only the job id is returned, poll it with scan_status.
+        Fanned out, the units scan concurrently and the first and last replies are {"id": 3, "units": {id: status}}
+        """
+        request_id = request.get("id")
+        try:
+            modems, fanout = self.route(request)
+        except ValueError as e:
+            self.reply(writer, {"id": request_id, "error": str(e)})
+            return
+        try:
+            deadline = float(request.get("deadline", SCAN_DEADLINE))
+            attempts = int(request.get("attempts", SCAN_ATTEMPTS))
+        except (TypeError, ValueError):
+            self.reply(writer, {"id": request_id, "error": "bad deadline or attempts"})
+            return
+        jobs = [modem.start_scan(deadline, attempts) for modem in modems]
+        self.reply(writer, dict(self.merge(modems, [job.status(cells=False) for job in jobs], fanout), id=request_id))
+        if not request.get("stream"):
+            return
+
+        listeners = []
+        for modem, job in zip(modems, jobs):
+            listener = self.forward(writer, request_id, modem.id)
+            for line in job.cells:  # Joined a scan already in progress
+                listener({"job": job.id, "cell": line})
+            job.listeners.add(listener)
+            listeners.append(listener)
+        try:
+            await asyncio.shield(asyncio.gather(*(job.task for job in jobs)))
+        finally:
+            for job, listener in zip(jobs, listeners):
+                job.listeners.discard(listener)
+        self.reply(writer, dict(self.merge(modems, [job.status() for job in jobs], fanout), id=request_id))
+        await writer.drain()
+
+    def forward(self, writer, request_id, modem_id):
+        """
+        Scan job listener writing its messages to a client, tagged with the request and modem
+        """
+        return lambda message: self.reply(writer, dict(message, id=request_id, modem=modem_id))
+
+    async def op_scan_status(self, client_id, request, writer):
+        """
+        {"id": 4, "op": "scan_status", "job": 1, "wait": true, "modem": "unit1"}
+        -> {"id": 4, "modem": "unit1", "job": 1, "state": "done", "cells": [...], "timing": {...}}
+        With "wait" the reply is sent once the job has finished
+        """
+        try:
+            modems, fanout = self.route(request)
+            if fanout:
+                raise ValueError("scan_status needs one modem")
+        except ValueError as e:
+            self.reply(writer, {"id": request.get("id"), "error": str(e)})
+            return
+        job = modems[0].scans.get(request.get("job"))
+        if job is None:
+            self.reply(writer, {"id": request.get("id"), "error": "unknown job"})
+            return
+        if request.get("wait"):
+            await asyncio.shield(job.task)
+        self.reply(writer, dict(job.status(), id=request.get("id"), modem=modems[0].id))
+
+    async def op_stats(self, client_id, request, writer):
+        """
+        {"id": 5, "op": "stats"}
+        -> {"id": 5, "modem": "default", "classes": {"interactive": {"queued": 0, "wait_ms": {...},
+            "service_ms": {...}, ...}, ...}, "deferred": [...], "link": {...}, "cache": {...}}
+        """
+        try:
+            modems, fanout = self.route(request)
+        except ValueError as e:
+            self.reply(writer, {"id": request.get("id"), "error": str(e)})
+            return
+        self.reply(writer, dict(self.merge(modems, [modem.status() for modem in modems], fanout),
+                                id=request.get("id")))
+        await writer.drain()
+
+    async def op_metrics(self, client_id, request, writer):
+        """
+        {"id": 9, "op": "metrics"}
+        -> {"id": 9, "modem": "default", "histograms": {"queue": {"telemetry": {"buckets": [[0.001, 12], ...,
+            ["+Inf", 40]], "count": 40, "sum": 0.52}, ...}, "write": ..., "first_byte": ..., "final": ..., "total": ...},
+            "results": {"telemetry": {"ok": 39, "timeout": 1}}, "bytes_out": 480, "bytes_in": 2210}
+        """
+        await self.reply_modems(request, writer, lambda modem: modem.metrics.status())
+
+    async def op_trace(self, client_id, request, writer):
+        """
+        {"id": 10, "op": "trace", "last": 20}
+        -> {"id": 10, "modem": "default", "commands": [{"time": 1733700000.0, "client": 3, "command": "AT^HCSQ?",
+            "priority": "telemetry", "result": "ok", "bytes_out": 9, "bytes_in": 35, "queue_ms": 0.1, "write_ms": 0.05,
+            "first_byte_ms": 20.3, "final_ms": 20.4, "total_ms": 20.6}, ...]}
+        The latest commands sent to the modem, oldest first
+        """
+        try:
+            last = int(request.get("last", TRACE_RING))
+        except (TypeError, ValueError):
+            self.reply(writer, {"id": request.get("id"), "error": "bad last"})
+            return
+        await self.reply_modems(request, writer, lambda modem: {"commands": modem.metrics.recent(last)})
+
+    async def reply_modems(self, request, writer, get):
+        """
+        Reply with get(modem) of the instrumented modems a request is routed to
+        """
+        try:
+            modems, fanout = self.route(request)
+        except ValueError as e:
+            self.reply(writer, {"id": request.get("id"), "error": str(e)})
+            return
+        if any(modem.metrics is None for modem in modems):
+            self.reply(writer, {"id": request.get("id"), "error": "metrics are off (ats.py --no-metrics)"})
+            return
+        self.reply(writer, dict(self.merge(modems, [get(modem) for modem in modems], fanout), id=request.get("id")))
+        await writer.drain()
+
+    async def op_modems(self, client_id, request, writer):
+        """
+        {"id": 6, "op": "modems"}
+        -> {"id": 6, "modems": {"unit1": {"host": "192.168.8.1", "port": 20249, "up": true, "rebooting": false}, ...}}
+        """
+        modems = {modem.id: modem.status()["link"] for modem in self.modems.values()}
+        self.reply(writer, {"id": request.get("id"), "modems": modems})
+
+    def publish(self, modem_id, urc):
+        """
+        Push a URC of one modem to every subscriber interested in it
+        """
+        if LOG_COMMANDS:
+            print(f"Received URC: {urc.line}")
+        modem = self.modems[modem_id]
+        if modem.cache is not None:
+            modem.cache.invalidate("AT" + urc.name)  # Newer than a cached query of the same name, e.g. ^HCSQ
+        if modem.status is not None:
+            modem.status.update(urc.parse())
+        for (client_id, request_id), (writer, names, modem_ids) in list(self.subscribers.items()):
+            if (names and urc.name not in names) or modem_id not in modem_ids:
+                continue
+            if writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+                continue  # Subscriber is not reading, drop the event rather than buffer without bound
+            self.reply(writer, dict(urc.to_dict(), id=request_id, modem=modem_id))
+
+    async def op_remote(self, client_id, request, writer):
+        """
+        {"id": 9, "op": "remote"}
+        -> {"id": 9, "clients": 2, "tokens": {"noc": {"connections": 1, "inflight": 0, "requests": 12,
+            "rejected": 0, "quota": {...}}}}
+        A remote client only sees its own token
+        """
+        own = self.remotes.get(client_id)
+        tokens = [own] if own is not None else self.tokens.values()
+        self.reply(writer, {"id": request.get("id"), "clients": len(self.remotes) if own is None else own.connections,
+                            "tokens": {quota.name: quota.status() for quota in tokens}})
+        await writer.drain()
+
+    async def op_subscribe(self, client_id, request, writer):
+        """
+        {"id": 7, "op": "subscribe", "events": ["^HCSQ", "+CREG"], "modem": "*"}
+        -> {"id": 7, "result": "OK"}
+        -> {"id": 7, "modem": "unit1", "event": "^HCSQ", "fields": ["NR", "60", "150", "50"], "line": "...",
+            "time": 1733700000.0}
+        An empty or missing "events" list subscribes to every URC, the stream ends with the connection
+        """
+        try:
+            modems, _ = self.route(request)
+        except ValueError as e:
+            self.reply(writer, {"id": request.get("id"), "error": str(e)})
+            return
+        names = {str(name).strip().rstrip(":").upper() for name in request.get("events") or ()}
+        self.subscribers[(client_id, request.get("id"))] = (writer, names, {modem.id for modem in modems})
+        self.reply(writer, {"id": request.get("id"), "result": "OK"})
+
+    async def op_unsubscribe(self, client_id, request, writer):
+        """
+        {"id": 8, "op": "unsubscribe", "sub": 7}
+        """
+        self.subscribers.pop((client_id, request.get("sub")), None)
+        self.reply(writer, {"id": request.get("id"), "result": "OK"})
+
+
+def parse_modem(spec):
+    """
+    "ID=HOST[:PORT]" -> (id, host, port)
+    """
+    modem_id, sep, address = spec.partition("=")
+    host, _, port = address.partition(":")
+    if not sep or not modem_id or not host:
+        raise ValueError(f"bad modem {spec!r}, expected ID=HOST[:PORT]")
+    return modem_id, host, int(port) if port else SERVER_PORT
+
+
+def load_modems(path):
+    """
+    Modems of a JSON file: {"unit1": "192.168.8.1:20249", "unit2": {"host": "192.168.9.1", "port": 20249}}
+    """
+    with open(path) as f:
+        config = json.load(f)
+    modems = []
+    for modem_id, address in config.items():
+        if isinstance(address, dict):
+            modems.append((modem_id, address["host"], int(address.get("port", SERVER_PORT))))
+        else:
+            modems.append(parse_modem(f"{modem_id}={address}"))
+    return modems
+
+
+def parse_listen(spec):
+    """
+    "HOST[:PORT]" of --listen -> (host, port)
+    """
+    host, sep, port = spec.rpartition(":")
+    if not sep or not port.isdigit() or (":" in host and not host.endswith("]")):  # A bare IPv6 address
+        host, port = spec, ""
+    host = host.strip("[]")
+    if not host:
+        raise ValueError(f"bad listen address {spec!r}, expected HOST[:PORT]")
+    return host, int(port) if port else REMOTE_PORT
+
+
+def load_tokens(path):
+    """
+    Tokens of the remote gateway from a JSON file, by token or "sha256:" and its hex digest:
+    {"TOKEN": {"name": "noc", "rate": 2, "priorities": ["telemetry"]}, "sha256:9f86...": {"readonly": true}}
+    Keys missing in an entry take the REMOTE_QUOTA defaults. Returns {SHA-256 digest: RemoteQuota}
+    """
+    with open(path) as f:
+        config = json.load(f)
+    tokens = {}
+    for index, (token, entry) in enumerate(config.items(), 1):
+        entry = dict(entry or {})
+        name = str(entry.pop("name", f"token{index}"))
+        unknown = sorted(set(entry) - set(REMOTE_QUOTA))
+        if unknown:
+            raise ValueError(f"token {name}: unknown setting {', '.join(unknown)}")
+        quota = dict(REMOTE_QUOTA, **entry)
+        quota["priorities"] = list(quota["priorities"])
+        unknown = sorted(set(quota["priorities"]) - set(PRIORITY_CLASSES))
+        if unknown:
+            raise ValueError(f"token {name}: unknown priority {', '.join(unknown)}")
+        if token.startswith("sha256:"):
+            digest = bytes.fromhex(token[7:])
+            if len(digest) != hashlib.sha256().digest_size:
+                raise ValueError(f"token {name}: bad SHA-256 digest")
+        elif len(token) < REMOTE_TOKEN_MIN:
+            raise ValueError(f"token {name}: shorter than {REMOTE_TOKEN_MIN} characters")
+        else:
+            digest = hashlib.sha256(token.encode()).digest()
+        tokens[digest] = RemoteQuota(name, quota)
+    if not tokens:
+        raise ValueError(f"no tokens in {path}")
+    return tokens
+
+
+async def serve(socket_file=SOCKET_FILE, cache=True, host=SERVER_IP, port=SERVER_PORT, modems=None,
+                metrics=METRICS, trace_file=None, trace_sample=TRACE_SAMPLE, status_file=STATUS_FILE,
+                status_refresh=STATUS_REFRESH, capture=None, listen=None, tokens=None):
+    """
+    Run the asyncio broker on the Unix Domain Socket
+    modems is a list of (id, host, port), by default the single modem host:port with id MODEM_ID.
+    trace_file, if given, is an open text file that gets one JSON line per sampled command.
+    status_file, unless empty, gets the live status of every modem (livestatus.py).
+    capture, if given, is a capture.CaptureWriter that records every byte exchanged with the modems.
+    listen, if given, is the (host, port) of the remote gateway for the clients of tokens (load_tokens())
+    """
+    # Remove the local Unix Socket file if it exists
+    if os.path.exists(socket_file):
+        os.remove(socket_file)
+
+    modems = modems or [(MODEM_ID, host, port)]
+    fleet = len(modems) > 1
+    status = StatusWriter(status_file, [modem[0] for modem in modems]) if status_file else None
+    try:
+        broker = Broker([Modem(modem_id, ModemLink(host, port, name=modem_id if fleet else None),
+                               ResponseCache() if cache else None,
+                               CommandMetrics(modem_id, trace_file, trace_sample) if metrics else None,
+                               status.slots[i] if status is not None else None, status_refresh)
+                         for i, (modem_id, host, port) in enumerate(modems)], tokens)
+        if capture is not None:
+            for modem in broker.modems.values():
+                modem.link.capture = capture.link(modem.id)
+        server = await asyncio.start_unix_server(broker.handle_client, path=socket_file)
+        print(f"Listening for commands on {socket_file}")
+        gateway = None
+        if listen is not None:
+            gateway = await asyncio.start_server(broker.handle_remote, *listen)
+            print(f"Listening for remote clients on {listen[0]}:{listen[1]} ({len(broker.tokens)} tokens)")
+        if status is not None:
+            print(f"Publishing the live status to {status_file}")
+        async with server:
+            try:
+                await broker.run()
+            finally:
+                if gateway is not None:
+                    gateway.close()
+    finally:
+        if status is not None:
+            status.close()
+
+
+def main():
+    global SOCKET_FILE, SERVER_IP, SERVER_PORT, LOG_COMMANDS
+    parser = argparse.ArgumentParser(description="MT5700M AT command server")
+    parser.add_argument("--legacy", action="store_true",
+                        help="serve one client at a time with the original blocking loop")
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path")
+    parser.add_argument("--host", default=SERVER_IP, help="modem AT port address")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="modem AT port")
+    parser.add_argument("--modem", action="append", default=[], metavar="ID=HOST[:PORT]",
+                        help="serve this modem, repeat for a fleet (replaces --host/--port)")
+    parser.add_argument("--modems", metavar="FILE", help="JSON file of the fleet: {\"ID\": \"HOST[:PORT]\", ...}")
+    parser.add_argument("--no-cache", action="store_true", help="send every query to the modem")
+    parser.add_argument("--quiet", action="store_true", help="do not print every command, response and URC")
+    parser.add_argument("--no-metrics", action="store_true", help="turn per-command instrumentation off")
+    parser.add_argument("--trace", metavar="FILE", help="append one JSON line per command sent to the modem")
+    parser.add_argument("--trace-sample", type=float, default=TRACE_SAMPLE,
+                        help="share of the commands written to --trace (default: %(default)s)")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="append every byte sent to and received from the modems to this file (capture.py)")
+    parser.add_argument("--capture-limit", type=int, default=CAPTURE_LIMIT // (1024 * 1024), metavar="MB",
+                        help="stop capturing once the file has grown this much (default: %(default)s)")
+    parser.add_argument("--status", default=STATUS_FILE, metavar="FILE",
+                        help="shared-memory file of the live modem status, '' for none (default: %(default)s)")
+    parser.add_argument("--status-refresh", type=float, default=STATUS_REFRESH, metavar="S",
+                        help="query values for the status nobody else asked for within S seconds, "
+                             "0 only publishes what clients query and URCs (default: %(default)s)")
+    parser.add_argument("--listen", metavar="HOST[:PORT]",
+                        help=f"also serve the framed protocol on TCP for remote clients (default port: {REMOTE_PORT})")
+    parser.add_argument("--tokens", metavar="FILE",
+                        help="--listen: JSON file of the client tokens and their quotas")
+    args = parser.parse_args()
+    try:
+        modems = [parse_modem(spec) for spec in args.modem] + (load_modems(args.modems) if args.modems else [])
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+    if len({modem[0] for modem in modems}) != len(modems):
+        parser.error("modem ids must be unique")
+
+    if args.legacy and args.capture:
+        parser.error("--capture needs the asyncio broker, drop --legacy")
+    if args.listen and not args.tokens:
+        parser.error("--listen needs --tokens")
+    if args.legacy and args.listen:
+        parser.error("--listen needs the asyncio broker, drop --legacy")
+    try:
+        listen = parse_listen(args.listen) if args.listen else None
+        tokens = load_tokens(args.tokens) if args.listen else None
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.trace and args.no_metrics:
+        parser.error("--trace needs the metrics, drop --no-metrics")
+    LOG_COMMANDS = not args.quiet
+
+    if args.legacy:
+        if len(modems) > 1:
+            parser.error("--legacy serves a single modem")
+        if modems:
+            args.host, args.port = modems[0][1:]
+        SOCKET_FILE, SERVER_IP, SERVER_PORT = args.socket, args.host, args.port
+        legacy_main()
+    else:
+        trace_file = capture = None
+        try:
+            if args.trace:
+                trace_file = open(args.trace, "a", buffering=1)
+            if args.capture:
+                capture = CaptureWriter(args.capture, args.capture_limit * 1024 * 1024)
+            asyncio.run(serve(args.socket, cache=not args.no_cache, host=args.host, port=args.port, modems=modems,
+                              metrics=not args.no_metrics, trace_file=trace_file, trace_sample=args.trace_sample,
+                              status_file=args.status, status_refresh=args.status_refresh, capture=capture,
+                              listen=listen, tokens=tokens))
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if trace_file is not None:
+                trace_file.close()
+            if capture is not None:
+                capture.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,336 @@
+import argparse
+import json
+import re
+import shlex
+import sys
+import time
+
+from workflow import CONDITIONS, POLL_GROWTH, POLL_MAX, POLL_MIN, SERVICE_TIMEOUT, Waiter
+
+BATCH_PRIORITY = "interactive"  # Scheduler class of every batch command: one class keeps them in file order in
+# ats.py, and unlike control it is not rate limited, a 20 command file runs at modem speed
+PIPELINE_DEPTH = 16  # Max commands written to the broker in one batch request
+OPTIONS = ("expect", "retry", "timeout", "on-error", "stop-if", "until")
+
+
+def split_line(text):
+    """
+    Split a command file line into (command, options text), dropping a trailing # comment
+    "#" and "|" inside double quotes belong to the command
+    """
+    quoted = False
+    bar = None
+    for index, char in enumerate(text):
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "#":
+            text = text[:index]
+            break
+        elif char == "|" and bar is None:
+            bar = index
+    if bar is None:
+        return text.strip(), ""
+    return text[:bar].strip(), text[bar + 1:].strip()
+
+
+def matches(pattern, result, response):
+    """
+    Whether a reply satisfies an expect / stop-if pattern: "any", /regex/ searched in the response,
+    or a final result code the result starts with, e.g. OK or +CME ERROR
+    """
+    if pattern == "any":
+        return True
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return re.search(pattern[1:-1], response or "") is not None
+    return result is not None and result.startswith(pattern)
+
+
+class Step:
+    """
+    One line of a command file:
+        AT+CGDCONT=8,"IPV4V6" | expect=OK retry=2 timeout=10 on-error=continue stop-if=/regex/ until=service
+    """
+    __slots__ = ("line", "command", "expect", "retry", "timeout", "on_error", "stop_if", "until")
+
+    def __init__(self, line, command, expect="OK", retry=0, timeout=None, on_error="stop", stop_if=None, until=None):
+        self.line = line
+        self.command = command
+        self.expect = expect
+        self.retry = retry  # Extra attempts after a failed one
+        self.timeout = timeout  # Broker deadline of one attempt, None for its default (seconds)
+        self.on_error = on_error  # "stop" or "continue"
+        self.stop_if = stop_if  # Pattern ending the batch successfully after this step
+        self.until = until  # Condition of workflow.CONDITIONS waited for after the command
+
+    @classmethod
+    def parse(cls, line, text):
+        command, options = split_line(text)
+        if not command:
+            if options:
+                raise ValueError(f"line {line}: options without a command")
+            return None
+        if not command.upper().startswith("AT"):
+            raise ValueError(f"line {line}: not an AT command: {command}")
+        step = cls(line, command)
+        for option in shlex.split(options):
+            name, _, value = option.partition("=")
+            if name not in OPTIONS or not value:
+                raise ValueError(f"line {line}: bad option {option!r}, expected one of {', '.join(OPTIONS)}")
+            try:
+                if name == "retry":
+                    step.retry = int(value)
+                elif name == "timeout":
+                    step.timeout = float(value)
+                elif name == "on-error":
+                    if value not in ("stop", "continue"):
+                        raise ValueError(value)
+                    step.on_error = value
+                elif name == "until":
+                    if value not in CONDITIONS:
+                        raise ValueError(value)
+                    step.until = value
+                else:
+                    setattr(step, name.replace("-", "_"), value)
+            except ValueError:
+                raise ValueError(f"line {line}: bad {name} {value!r}") from None
+        return step
+
+    @property
+    def harmless(self):
+        """
+        Whether the command changes nothing, so sending it ahead of a step that may stop the batch is safe
+        """
+        command = self.command.strip().upper()
+        return (command.endswith("?") and ";" not in command) or command in ("AT", "ATI")
+
+    @property
+    def branches(self):
+        """
+        Whether the outcome of this step decides what runs next, followers then wait for its reply
+        """
+        return self.retry > 0 or self.until is not None or self.stop_if is not None or self.on_error == "stop"
+
+
+def load(path):
+    """
+    Parse a command file into Steps, raise ValueError with the line number of a bad line
+    """
+    with open(path, errors="ignore") as f:
+        lines = f.read().splitlines()
+    steps = [Step.parse(number, text) for number, text in enumerate(lines, 1)]
+    return [step for step in steps if step is not None]
+
+
+class Batch:
+    """
+    Run Steps through one persistent broker session of a CellularManager
+    Consecutive steps are written to the broker together while that cannot change the outcome: behind a step
+    whose reply decides what runs next only harmless queries are sent ahead, a retry, wait or reboot ends the group
+    """
+    def __init__(self, manager, steps, pipeline=True, priority=BATCH_PRIORITY, service_timeout=SERVICE_TIMEOUT,
+                 on_step=None):
+        self.manager = manager
+        self.steps = steps
+        self.pipeline = pipeline and manager.framed
+        self.priority = priority
+        self.service_timeout = service_timeout
+        self.on_step = on_step  # Called with each step report as soon as the step is settled
+        self.reboot = manager.at_commands["restart_cellular"].upper()
+
+    def groups(self):
+        """
+        Split the steps into runs sent in one write
+        """
+        group = []
+        for step in self.steps:
+            if group and (not self.pipeline or len(group) >= PIPELINE_DEPTH or self.ends_group(group[-1])
+                          or (any(previous.branches for previous in group) and not step.harmless)):
+                yield group
+                group = []
+            group.append(step)
+        if group:
+            yield group
+
+    def ends_group(self, step):
+        return step.retry > 0 or step.until is not None or step.command.strip().upper() == self.reboot
+
+    def send(self, steps):
+        """
+        Send steps in one batch request, yield (step, reply dict, seconds from the write to its reply)
+        """
+        if not self.manager.framed:
+            for step in steps:
+                t0 = time.monotonic()
+                yield step, self.manager.raw(step.command), time.monotonic() - t0
+            return
+        requests = []
+        for step in steps:
+            request = {"cmd": step.command, "priority": self.priority, "cache": False}
+            if step.timeout is not None:
+                request["timeout"] = step.timeout
+            requests.append(request)
+        t0 = time.monotonic()
+        try:
+            replies = self.manager.session.request(requests)
+            for index, reply in replies:
+                yield steps[index], self.manager.raw_result(steps[index].command, reply.get("response"),
+                                                            reply.get("error")), time.monotonic() - t0
+        except ValueError:
+            print("Broker does not support the framed protocol, sending raw commands")
+            self.manager.framed = self.pipeline = False
+            yield from self.send(steps)
+
+    def run(self):
+        """
+        Returns {"state": "done", "failed" or "stopped", "steps": [...], "elapsed", "passed", "failed_steps",
+        "skipped", "error"}. Each step report has line, command, state (passed, failed, stopped, skipped),
+        result, attempts and latency (seconds from its write to its reply, the last attempt's), and waited
+        """
+        report = {"state": "done", "steps": [], "elapsed": None, "passed": 0, "failed_steps": 0, "skipped": 0,
+                  "error": None}
+        start = time.monotonic()
+        waiter = Waiter(self.manager) if any(step.until for step in self.steps) else None
+        try:
+            for group in self.groups():
+                if report["state"] != "done":
+                    for step in group:
+                        self.settle(report, self.step_report(step, "skipped"))
+                    continue
+                results = {}
+                for step, result, latency in self.send(group):
+                    results[step.line] = (result, latency)
+                for step in group:
+                    if report["state"] != "done":
+                        self.settle(report, self.step_report(step, "skipped", *results[step.line], attempts=1))
+                        continue
+                    self.settle(report, self.finish(step, *results[step.line], waiter=waiter), step)
+            return report
+        finally:
+            report["elapsed"] = round(time.monotonic() - start, 3)
+            if waiter is not None:
+                waiter.close()
+
+    def step_report(self, step, state, result=None, latency=None, attempts=0):
+        entry = {"line": step.line, "command": step.command, "state": state, "attempts": attempts}
+        if result is not None:
+            entry["result"] = result.get("result")
+            entry["latency"] = round(latency, 4)
+            if "error" in result:
+                entry["error"] = result["error"]
+            elif state != "passed":
+                entry["response"] = result.get("response")
+        return entry
+
+    def finish(self, step, result, latency, waiter=None):
+        """
+        Check the reply of the first attempt, retry the step while it fails, then wait for its condition
+        """
+        attempts = 1
+        delay = POLL_MIN
+        while not self.passed(step, result) and attempts <= step.retry:
+            time.sleep(delay)
+            delay = min(delay * POLL_GROWTH, POLL_MAX)
+            _, result, latency = next(self.send([step]))
+            attempts += 1
+        if not self.passed(step, result):
+            return self.step_report(step, "failed", result, latency, attempts)
+        entry = self.step_report(step, "passed", result, latency, attempts)
+        if step.until is not None:
+            value, entry["waited"] = waiter.poll(lambda: CONDITIONS[step.until](self.manager), self.service_timeout)
+            if value is None:
+                entry["state"] = "failed"
+                entry["error"] = f"no {step.until} within {self.service_timeout}s"
+        if entry["state"] == "passed" and step.stop_if is not None and \
+                matches(step.stop_if, result.get("result"), result.get("response")):
+            entry["state"] = "stopped"
+        return entry
+
+    @staticmethod
+    def passed(step, result):
+        return "error" not in result and matches(step.expect, result.get("result"), result.get("response"))
+
+    def settle(self, report, entry, step=None):
+        report["steps"].append(entry)
+        if entry["state"] == "passed":
+            report["passed"] += 1
+        elif entry["state"] == "skipped":
+            report["skipped"] += 1
+        elif entry["state"] == "stopped":
+            report["passed"] += 1
+            report["state"] = "stopped"
+        else:
+            report["failed_steps"] += 1
+            if step is not None and step.on_error == "stop":
+                report["state"] = "failed"
+                report["error"] = f"line {step.line}: {step.command}: {entry.get('error') or entry.get('result')}"
+        if self.on_step is not None:
+            self.on_step(entry)
+
+
+def print_step(entry):
+    latency = f"{entry['latency'] * 1000:.0f} ms" if "latency" in entry else "-"
+    detail = entry.get("error") or entry.get("result") or ""
+    waited = f", service after {entry['waited']}s" if "waited" in entry else ""
+    attempts = f", {entry['attempts']} attempts" if entry["attempts"] > 1 else ""
+    print(f"{entry['line']:>4}  {entry['state']:<8} {entry['command']:<40} {detail} ({latency}{attempts}{waited})")
+
+
+def main():
+    from at import CellularManager, SOCKET_FILE
+    parser = argparse.ArgumentParser(
+        description="Run AT command files through ats.py, one command per line with optional checks after a '|'",
+        epilog="line options: expect=OK|ERROR|any|/regex/ retry=N timeout=S on-error=stop|continue "
+               "stop-if=/regex/ until=service")
+    parser.add_argument("files", nargs="+", help="command files, run one after the other")
+    parser.add_argument("--format", choices=["text", "json", "ndjson"], default="text",
+                        help="text: one line per step, json: the report at the end, ndjson: one line per step")
+    parser.add_argument("--report", help="also write the JSON report of all files to this file")
+    parser.add_argument("--no-pipeline", action="store_true", help="wait for each reply before sending the next")
+    parser.add_argument("--continue", dest="keep_going", action="store_true",
+                        help="run the next file even if one failed")
+    parser.add_argument("--priority", choices=["interactive", "control", "telemetry", "scan"], default=BATCH_PRIORITY,
+                        help="scheduler class of the commands in ats.py (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=SERVICE_TIMEOUT,
+                        help="max wait of an until=service step (default: %(default)s)")
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path of ats.py")
+    parser.add_argument("--modem", help="modem id of a fleet broker (default: its first modem)")
+    args = parser.parse_args()
+
+    try:
+        batches = [(path, load(path)) for path in args.files]
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    manager = CellularManager(args.socket, modem=args.modem)
+    on_step = {"text": print_step, "json": None,
+               "ndjson": lambda entry: print(json.dumps(entry, ensure_ascii=False), flush=True)}[args.format]
+    reports = []
+    for path, steps in batches:
+        if args.format == "text":
+            print(f"== {path}: {len(steps)} steps")
+        report = Batch(manager, steps, not args.no_pipeline, args.priority, args.timeout, on_step).run()
+        report["file"] = path
+        reports.append(report)
+        if args.format == "text":
+            print(f"== {path}: {report['state']}, {report['passed']} passed, {report['failed_steps']} failed, "
+                  f"{report['skipped']} skipped in {report['elapsed']}s"
+                  + (f": {report['error']}" if report["error"] else ""))
+        elif args.format == "ndjson":
+            print(json.dumps({key: value for key, value in report.items() if key != "steps"}, ensure_ascii=False))
+        if report["state"] == "failed" and not args.keep_going:
+            break
+    manager.session.close()
+
+    if args.format == "json":
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if len(reports) == len(batches) and all(r["state"] != "failed" for r in reports) else 1)
+
+
+if __name__ == "__main__":
+    main()
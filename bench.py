@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from at import CellularManager
+from fake_modem import JITTER, LATENCY
+
+BENCH_SOCKET = "/tmp/at_bench.sock"
+BENCH_PORT = 28249  # Port of the fake modem started by the benchmark
+DURATION = 10  # Measured time per run (seconds)
+WARMUP = 1  # Unmeasured time before each run (seconds)
+CLIENTS = 8
+COMMANDS = ["AT^HCSQ?", "AT^HFREQINFO?", "AT^NRFREQLOCK?", "AT^CHIPTEMP?"]
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def process_cpu(pid):
+    """
+    User + system CPU seconds used so far by a child process, None where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def modem_stats(port):
+    """
+    Counters of the fake modem, read on a separate connection with AT+FAKESTATS?
+    """
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            sock.sendall(b"AT+FAKESTATS?\r")
+            response = b""
+            while b"OK\r\n" not in response:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+        line = response.decode().split("+FAKESTATS: ")[1].split("\r\n")[0]
+        return {key: int(value) for key, value in (item.split("=") for item in line.split(","))}
+    except (OSError, IndexError, ValueError):
+        return {}
+
+
+def wait_for_socket(path, process, timeout=10):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if process.poll() is not None:
+            raise RuntimeError(f"broker exited with code {process.returncode}")
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"broker did not listen on {path} within {timeout}s")
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Worker(threading.Thread):
+    """
+    One client sending the command mix back to back through its own CellularManager
+    """
+    def __init__(self, index, socket_file, commands, protocol, priority, start, warmup_end, end):
+        super().__init__(daemon=True)
+        self.manager = CellularManager(socket_file, priority)
+        self.manager.framed = protocol == "framed"
+        self.commands = commands[index % len(commands):] + commands[:index % len(commands)]
+        self.start_event = start
+        self.warmup_end = warmup_end
+        self.end = end
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        self.start_event.wait()
+        i = 0
+        while True:
+            command = self.commands[i % len(self.commands)]
+            i += 1
+            t0 = time.perf_counter()
+            if t0 >= self.end:
+                break
+            response = self.manager.send_command(command)
+            t1 = time.perf_counter()
+            if t0 < self.warmup_end:
+                continue
+            if response is None or "OK" not in response:
+                self.errors += 1
+            else:
+                self.latencies.append(t1 - t0)
+        self.manager.session.close()
+
+
+def run(args):
+    """
+    Start the fake modem and the broker, drive them with the clients and return the results
+    """
+    children = []
+    broker = None
+    try:
+        if not args.socket:
+            modem_command = [sys.executable, os.path.join(HERE, "fake_modem.py"), "--port", str(args.port),
+                             "--latency", str(args.latency), "--jitter", str(args.jitter),
+                             "--urc-interval", str(args.urc_interval), "--chunk", str(args.chunk)]
+            children.append(subprocess.Popen(modem_command, stdout=subprocess.DEVNULL))
+            broker_command = [sys.executable, os.path.join(HERE, "ats.py"), "--socket", BENCH_SOCKET,
+                              "--host", "127.0.0.1", "--port", str(args.port),
+                              "--status", ""]  # Leave the live status of a real broker alone, no refresh queries
+            if args.legacy:
+                broker_command.append("--legacy")
+            if args.no_cache:
+                broker_command.append("--no-cache")
+            if args.quiet:
+                broker_command.append("--quiet")
+            if args.no_metrics:
+                broker_command.append("--no-metrics")
+            time.sleep(0.3)
+            broker = subprocess.Popen(broker_command, stdout=subprocess.DEVNULL)
+            children.append(broker)
+            wait_for_socket(BENCH_SOCKET, broker)
+        socket_file = args.socket or BENCH_SOCKET
+
+        start = threading.Event()
+        t_start = time.perf_counter()
+        warmup_end = t_start + args.warmup
+        end = warmup_end + args.duration
+        workers = [Worker(i, socket_file, args.commands, args.protocol, args.priority, start, warmup_end, end)
+                   for i in range(args.clients)]
+        for worker in workers:
+            worker.start()
+        modem_before = {} if args.socket else modem_stats(args.port)
+        start.set()
+        time.sleep(max(0, warmup_end - time.perf_counter()))
+
+        broker_cpu = process_cpu(broker.pid) if broker else None
+        client_cpu = time.process_time()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - warmup_end
+        client_cpu = time.process_time() - client_cpu
+        if broker_cpu is not None:
+            broker_cpu = process_cpu(broker.pid) - broker_cpu
+        modem_after = {} if args.socket else modem_stats(args.port)
+    finally:
+        for child in children:
+            child.terminate()
+            child.wait()
+
+    latencies = sorted(latency for worker in workers for latency in worker.latencies)
+    completed = len(latencies)
+    # Warmup commands still in flight at warmup_end are in neither count nor CPU window, close enough
+    modem_commands = modem_after.get("commands", 0) - modem_before.get("commands", 0) if modem_after else None
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "broker": "external" if args.socket else "legacy" if args.legacy else "asyncio",
+        "protocol": args.protocol,
+        "priority": args.priority,
+        "cache": not args.no_cache,
+        "log": not args.quiet,
+        "metrics": not args.no_metrics,
+        "clients": args.clients,
+        "commands": args.commands,
+        "latency": args.latency,
+        "duration": round(elapsed, 3),
+        "completed": completed,
+        "errors": sum(worker.errors for worker in workers),
+        "commands_per_second": round(completed / elapsed, 1),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p90_ms": ms(percentile(latencies, 90)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "broker_cpu_ms_per_command": ms(broker_cpu / completed) if broker_cpu is not None and completed else None,
+        "client_cpu_ms_per_command": ms(client_cpu / completed) if completed else None,
+        "modem_commands": modem_commands,
+    }
+
+
+METRICS = [
+    # (key, label, True if higher is better)
+    ("commands_per_second", "commands/s", True),
+    ("p50_ms", "p50 ms", False),
+    ("p90_ms", "p90 ms", False),
+    ("p99_ms", "p99 ms", False),
+    ("max_ms", "max ms", False),
+    ("broker_cpu_ms_per_command", "broker CPU ms/cmd", False),
+    ("client_cpu_ms_per_command", "client CPU ms/cmd", False),
+    ("modem_commands", "modem commands", False),
+]
+
+
+def report(result, baseline=None):
+    print(f"{result['broker']} broker, {result['protocol']} protocol, cache {'on' if result['cache'] else 'off'}, "
+          f"{result['clients']} clients, {result['latency'] * 1000:g} ms modem latency")
+    print(f"{result['completed']} commands in {result['duration']}s, {result['errors']} errors")
+    for key, label, higher_is_better in METRICS:
+        value = result.get(key)
+        line = f"  {label:<20} {'-' if value is None else value:>10}"
+        old = baseline.get(key) if baseline else None
+        if value is not None and old:
+            change = (value - old) / old * 100
+            better = change > 0 if higher_is_better else change < 0
+            line += f"   baseline {old:>10}  {change:+6.1f}% {'better' if better else 'worse' if change else ''}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark of ats.py against a fake modem")
+    parser.add_argument("--clients", type=int, default=CLIENTS, help="concurrent CellularManager clients")
+    parser.add_argument("--duration", type=float, default=DURATION, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=WARMUP, help="unmeasured seconds before measuring")
+    parser.add_argument("--commands", type=lambda value: value.split(";"), default=COMMANDS,
+                        help="';'-separated command mix, sent round robin (default: %(default)s)")
+    parser.add_argument("--protocol", choices=["framed", "raw"], default="framed",
+                        help="framed session per client, or one raw connection per command")
+    parser.add_argument("--priority", default="interactive",
+                        help="scheduler class of the commands, interactive is not rate limited (default: %(default)s)")
+    parser.add_argument("--legacy", action="store_true", help="benchmark ats.py --legacy")
+    parser.add_argument("--no-cache", action="store_true", help="run ats.py with --no-cache")
+    parser.add_argument("--quiet", action="store_true", help="run ats.py with --quiet")
+    parser.add_argument("--no-metrics", action="store_true", help="run ats.py with --no-metrics")
+    parser.add_argument("--socket", help="benchmark a broker already listening here instead of starting one")
+    parser.add_argument("--port", type=int, default=BENCH_PORT, help="port of the fake modem")
+    parser.add_argument("--latency", type=float, default=LATENCY, help="fake modem response latency (seconds)")
+    parser.add_argument("--jitter", type=float, default=JITTER, help="fake modem random extra latency (seconds)")
+    parser.add_argument("--urc-interval", type=float, default=0, help="fake modem ^HCSQ URC period (seconds)")
+    parser.add_argument("--chunk", type=int, default=0, help="fake modem write size (bytes, 0: whole responses)")
+    parser.add_argument("--output", help="write the results as JSON, e.g. to keep as a baseline")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    try:
+        result = run(args)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main()
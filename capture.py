@@ -0,0 +1,458 @@
+import argparse
+import asyncio
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+CAPTURE_LIMIT = 256 * 1024 * 1024  # Capture stops once the file has grown this much (bytes)
+CAPTURE_BUFFER = 64 * 1024  # Bytes buffered in memory before they are written out
+CAPTURE_FLUSH = 1  # Buffered records are written out at least this often, a crash loses less (seconds)
+REPLAY_HOST = "127.0.0.1"
+REPLAY_PORT = 20249
+REPLAY_LOOKAHEAD = 64  # Captured commands searched for the one the client sent, skipped ones are not replayed
+DRIVE_PRIORITY = "interactive"  # Scheduler class of the commands --drive sends, no rate limit to skew a fast replay
+
+# File layout: an 8 byte magic and a version, then records of an 8 byte header and a payload:
+# microseconds since the previous record, payload length, kind, link (modem) index.
+# Every broker start appends a START record with its wall clock time, the times that follow count from it.
+MAGIC = b"MT57CAP1"
+VERSION = 1
+FILE_HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<IHBB")  # delta us, length, kind, link
+MAX_PAYLOAD = 0xFFFF  # Longer chunks are split into several records
+MAX_DELTA = 0xFFFFFFFF  # Longer gaps (71 minutes) are bridged by a CLOCK record
+START, CONNECT, CLOSE, TX, RX, CLOCK = range(6)
+KINDS = ("start", "connect", "close", "tx", "rx", "clock")
+START_PAYLOAD = struct.Struct("<d")  # Wall clock time of the start
+CLOCK_PAYLOAD = struct.Struct("<Q")  # Microseconds since the last START
+
+
+def now_us():
+    return time.monotonic_ns() // 1000
+
+
+class CaptureWriter:
+    """
+    Append-only log of the bytes exchanged with the modems, one CaptureLink per modem link
+    Records are buffered, written out every CAPTURE_FLUSH and when the buffer fills up
+    """
+    def __init__(self, path, limit=CAPTURE_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        if self.size:
+            with open(path, "rb") as f:
+                magic, version = FILE_HEADER.unpack(f.read(FILE_HEADER.size).ljust(FILE_HEADER.size, b"\0"))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a capture file of version {VERSION}")
+        self.file = open(path, "ab", buffering=CAPTURE_BUFFER)
+        if not self.size:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+            self.size = FILE_HEADER.size
+        self.start = self.last = self.flushed = now_us()
+        self.links = []
+        self.record(START, 0, START_PAYLOAD.pack(time.time()))
+
+    def link(self, name):
+        """
+        CaptureLink for the modem link name, e.g. the modem id
+        """
+        link = CaptureLink(self, len(self.links), name)
+        self.links.append(link)
+        return link
+
+    def record(self, kind, link, data=b""):
+        if self.file is None:
+            return
+        t = now_us()
+        delta = t - self.last
+        if delta > MAX_DELTA:
+            self.file.write(RECORD.pack(0, CLOCK_PAYLOAD.size, CLOCK, link))
+            self.file.write(CLOCK_PAYLOAD.pack(t - self.start))
+            self.size += RECORD.size + CLOCK_PAYLOAD.size
+            delta = 0
+        self.last = t
+        size = len(data)
+        self.file.write(RECORD.pack(delta, min(size, MAX_PAYLOAD), kind, link))
+        if size:
+            self.file.write(data[:MAX_PAYLOAD])
+            for offset in range(MAX_PAYLOAD, size, MAX_PAYLOAD):
+                self.file.write(RECORD.pack(0, min(size - offset, MAX_PAYLOAD), kind, link))
+                self.file.write(data[offset:offset + MAX_PAYLOAD])
+                self.size += RECORD.size
+        self.size += RECORD.size + size
+        if self.size > self.limit:
+            print(f"Capture file {self.path} reached {self.limit} bytes, capture stopped.")
+            self.close()
+        elif t - self.flushed > CAPTURE_FLUSH * 1000000:
+            self.file.flush()
+            self.flushed = t
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CaptureLink:
+    """
+    The records of one modem link, called by ats.ModemLink
+    """
+    __slots__ = ("writer", "index", "name")
+
+    def __init__(self, writer, index, name):
+        self.writer = writer
+        self.index = index
+        self.name = name
+
+    def connect(self):
+        self.writer.record(CONNECT, self.index, self.name.encode())
+
+    def close(self):
+        self.writer.record(CLOSE, self.index)
+
+    def tx(self, data):
+        self.writer.record(TX, self.index, data)
+
+    def rx(self, data):
+        """
+        data may be a memoryview of the read buffer, it is written out before the call returns
+        """
+        self.writer.record(RX, self.index, data)
+
+
+def read_records(path):
+    """
+    Records of a capture file as (time, kind, link, payload bytes), time in Unix seconds
+    A record cut short by a crash ends the capture
+    """
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version = FILE_HEADER.unpack_from(mm.read(FILE_HEADER.size).ljust(FILE_HEADER.size, b"\0"))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a capture file of version {VERSION}")
+        records = []
+        offset, size = FILE_HEADER.size, len(mm)
+        start = t = 0
+        while offset + RECORD.size <= size:
+            delta, length, kind, link = RECORD.unpack_from(mm, offset)
+            offset += RECORD.size
+            if offset + length > size:
+                break
+            payload = mm[offset:offset + length]
+            offset += length
+            t += delta
+            if kind == START:
+                start, t = START_PAYLOAD.unpack(payload)[0], 0
+            elif kind == CLOCK:
+                t = CLOCK_PAYLOAD.unpack(payload)[0]
+                continue
+            records.append((start + t / 1000000, kind, link, payload))
+        return records
+    finally:
+        mm.close()
+
+
+class Session:
+    """
+    One connection of a modem link: its records from CONNECT to CLOSE
+    """
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.events = []  # (time, kind, payload), TX and RX only
+        self.end = None
+
+    @property
+    def commands(self):
+        return [payload.strip().decode(errors="replace") for _, kind, payload in self.events if kind == TX]
+
+
+def sessions(records):
+    """
+    Split the records into the Sessions of each connection, in order of connection
+    """
+    result = []
+    current = {}  # link index of the current START -> open Session
+    for t, kind, link, payload in records:
+        if kind == START:
+            current = {}
+        elif kind == CONNECT:
+            current[link] = Session(payload.decode(errors="replace"), t)
+            result.append(current[link])
+        elif kind in (TX, RX) and link in current:
+            current[link].events.append((t, kind, payload))
+        elif kind == CLOSE and link in current:
+            current.pop(link).end = t
+    return result
+
+
+class Replayer:
+    """
+    Fake modem serving the sessions of a capture, the n-th connection gets the n-th session
+    In sync mode the response bytes of a captured command are held until the client sends that command,
+    then replayed with the captured timing; bytes between commands (URCs) follow the clock of the capture.
+    A command not found within REPLAY_LOOKAHEAD captured commands gets a plain OK ("AT") or ERROR.
+    speed scales the captured gaps: 2 plays twice as fast, 0 as fast as possible
+    """
+    def __init__(self, sessions, speed=1.0, sync=True):
+        self.sessions = collections.deque(sessions)
+        self.speed = speed
+        self.sync = sync
+        self.connected = asyncio.Event()  # Set once a client, the broker, connected
+        self.done = asyncio.Event()
+        self.stats = {"sessions": 0, "commands": 0, "matched": 0, "skipped": 0, "unknown": 0, "bytes": 0}
+
+    async def pause(self, seconds):
+        if self.speed and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    async def handle(self, reader, writer):
+        if not self.sessions:
+            writer.close()
+            return
+        session = self.sessions.popleft()
+        self.stats["sessions"] += 1
+        self.connected.set()
+        commands = asyncio.Queue()
+        listener = asyncio.create_task(self.listen(reader, commands))
+        try:
+            await self.play(session, commands, writer)
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass  # Client gone, or the replay is over
+        finally:
+            listener.cancel()
+            writer.close()
+            if not self.sessions:
+                self.done.set()
+
+    async def listen(self, reader, commands):
+        """
+        Queue each command line the client sends, None once it disconnects
+        """
+        try:
+            while True:
+                line = await reader.readuntil(b"\r")
+                if line.strip():
+                    await commands.put(line.strip())
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            await commands.put(None)
+
+    async def play(self, session, commands, writer):
+        events = session.events
+        previous = session.start
+        i = 0
+        while i < len(events):
+            t, kind, payload = events[i]
+            if kind == RX:
+                await self.pause(t - previous)
+                previous = t
+                writer.write(payload)
+                self.stats["bytes"] += len(payload)
+                await writer.drain()
+                i += 1
+                continue
+            if not self.sync:
+                previous = t
+                i += 1
+                continue
+            command = await commands.get()
+            if command is None:
+                return  # Client gone, the session ends with it
+            self.stats["commands"] += 1
+            found = self.find(events, i, command)
+            if found is None:
+                self.stats["unknown"] += 1
+                writer.write(b"\r\nOK\r\n" if command.upper() == b"AT" else b"\r\nERROR\r\n")
+                continue
+            self.stats["matched"] += 1
+            self.stats["skipped"] += sum(kind == TX for _, kind, _ in events[i:found])
+            previous, i = events[found][0], found + 1
+        if session.end is not None:
+            await self.pause(session.end - previous)
+        while self.sync and not commands.empty() and await commands.get() is not None:
+            self.stats["commands"] += 1
+            self.stats["unknown"] += 1
+
+    @staticmethod
+    def find(events, start, command):
+        """
+        Index of the first captured TX of command from start on, within REPLAY_LOOKAHEAD commands
+        """
+        seen = 0
+        for i in range(start, len(events)):
+            if events[i][1] == TX:
+                if events[i][2].strip() == command:
+                    return i
+                seen += 1
+                if seen >= REPLAY_LOOKAHEAD:
+                    break
+        return None
+
+
+async def drive(socket_file, sessions, speed, timeout):
+    """
+    Send the commands of sessions to a broker (ats.py) as a client, with the captured pacing scaled by speed
+    Bare "AT" is taken for a probe or heartbeat of the broker itself and not sent. The capture holds what
+    reached the modem, so the broker driven should run with --no-cache to send all of it again
+    Returns the latency of each command (seconds, None when it failed)
+    """
+    from at import open_session
+    loop = asyncio.get_running_loop()
+    client = open_session(socket_file)
+    latencies = []
+    begin, first = loop.time(), sessions[0].start
+    try:
+        for t, kind, payload in (event for session in sessions for event in session.events):
+            command = payload.strip().decode(errors="replace")
+            if kind != TX or command.upper() == "AT":
+                continue
+            if speed:
+                delay = begin + (t - first) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            started = loop.time()
+            try:
+                reply = (await asyncio.wait_for(loop.run_in_executor(
+                    None, lambda: client.execute([command], timeout, DRIVE_PRIORITY)), timeout + 1))[0]
+                latencies.append(None if "error" in reply else loop.time() - started)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                latencies.append(None)
+    finally:
+        client.close()
+    return latencies
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(share * len(values)))] if values else None
+
+
+async def replay(args, records):
+    chosen = [session for session in sessions(records) if args.modem in (None, session.name)]
+    if not chosen:
+        raise ValueError(f"no session of modem {args.modem} in {args.file}" if args.modem else
+                         f"no session in {args.file}")
+    names = {session.name for session in chosen}
+    if len(names) > 1:
+        raise ValueError(f"sessions of several modems ({', '.join(sorted(names))}), pick one with --modem")
+    replayer = Replayer(chosen, args.speed, not args.no_sync)
+    server = await asyncio.start_server(replayer.handle, args.host, args.port)
+    print(f"Replaying {len(chosen)} sessions of {args.file} on {args.host}:{args.port}")
+    start = time.monotonic()
+    latencies = []
+    async with server:
+        if args.drive:
+            await replayer.connected.wait()
+            latencies = await drive(args.drive, chosen, args.speed, args.timeout)
+        else:
+            await replayer.done.wait()
+    elapsed = time.monotonic() - start
+    print(f"Replayed in {elapsed:.2f}s: " + ", ".join(f"{key} {value}" for key, value in replayer.stats.items()))
+    if args.drive:
+        ok = sorted(latency for latency in latencies if latency is not None)
+        print(f"Driven: {len(latencies)} commands, {len(latencies) - len(ok)} failed, "
+              f"{len(latencies) / elapsed:.1f} commands/s, p50 {1000 * (percentile(ok, 0.5) or 0):.1f} ms, "
+              f"p99 {1000 * (percentile(ok, 0.99) or 0):.1f} ms")
+
+
+def decode(args, records):
+    """
+    Frame and parse the received bytes offline with the parsers of this tree, one JSON line per response and URC,
+    so the output before and after a parser change can be compared
+    """
+    from ats import ResponseFramer, URC, command_name
+    import atparse
+    framers = {}
+    command = {}
+    for t, kind, link, payload in records:
+        if kind == START:
+            framers, command = {}, {}
+        elif kind == CONNECT:
+            framers[link] = ResponseFramer()
+            command[link] = None
+        elif kind == TX and link in framers:
+            command[link] = payload.strip().decode(errors="replace")
+            framers[link].begin(command[link])
+        elif kind == RX and link in framers:
+            for item in framers[link].feed(payload):
+                if isinstance(item, URC):
+                    record = item.parse()
+                    message = {"time": t, "link": link, "urc": item.line}
+                else:
+                    record = atparse.parse(command_name(command[link] or ""), item.text) if item.ok else None
+                    message = {"time": t, "link": link, "command": command[link], "result": item.result,
+                               "bytes": item.nbytes, "lines": item.nlines}
+                if record is not None:
+                    message["parsed"] = record.to_dict()
+                print(json.dumps(message, ensure_ascii=False))
+
+
+def dump(args, records):
+    for t, kind, link, payload in records:
+        if args.since is None or t >= args.since:
+            print(f"{t:.6f} {link} {KINDS[kind]:7} {payload!r}" if kind in (TX, RX, CONNECT) else
+                  f"{t:.6f} {link} {KINDS[kind]}")
+
+
+def info(args, records):
+    print(f"file: {args.file} ({os.path.getsize(args.file)} bytes)")
+    if not records:
+        print("records: 0")
+        return
+    counts = collections.Counter(KINDS[kind] for _, kind, _, _ in records)
+    payload = collections.Counter()
+    for _, kind, _, data in records:
+        payload[KINDS[kind]] += len(data)
+    print(f"range: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(records[0][0]))} - "
+          f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(records[-1][0]))}")
+    print(f"records: {len(records)} ({', '.join(f'{kind} {count}' for kind, count in counts.items())})")
+    print(f"bytes: tx {payload['tx']}, rx {payload['rx']}, record headers {len(records) * RECORD.size}")
+    for session in sessions(records):
+        duration = (session.end or (session.events[-1][0] if session.events else session.start)) - session.start
+        print(f"session {session.name} at {session.start:.3f}: {len(session.commands)} commands, {duration:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay modem traffic captured by ats.py --capture")
+    parser.add_argument("file", help="capture file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("info", help="records, bytes and sessions of the capture").set_defaults(func=info)
+    dumper = commands.add_parser("dump", help="print every record")
+    dumper.add_argument("--since", type=float, help="from this Unix time on")
+    dumper.set_defaults(func=dump)
+    commands.add_parser("decode", help="frame and parse the received bytes offline, one JSON line per response "
+                                       "and URC").set_defaults(func=decode)
+
+    replayer = commands.add_parser("replay", help="serve the capture as a fake modem")
+    replayer.add_argument("--host", default=REPLAY_HOST)
+    replayer.add_argument("--port", type=int, default=REPLAY_PORT)
+    replayer.add_argument("--speed", type=float, default=1.0,
+                          help="1 original timing, 10 ten times faster, 0 as fast as possible (default: 1)")
+    replayer.add_argument("--modem", help="replay the sessions of this modem id of a fleet capture")
+    replayer.add_argument("--no-sync", action="store_true",
+                          help="play the received bytes on the captured clock, whatever the client sends")
+    replayer.add_argument("--drive", metavar="SOCKET",
+                          help="also send the captured commands to the ats.py on this socket, and report latency")
+    replayer.add_argument("--timeout", type=float, default=60, help="--drive: max time per command (seconds)")
+    replayer.set_defaults(func=lambda args, records: asyncio.run(replay(args, records)))
+    args = parser.parse_args()
+
+    try:
+        records = read_records(args.file)
+        args.func(args, records)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import array
+import itertools
+import json
+import math
+import sys
+
+# NR bands (38.101-1 / 38.101-2): DL low and high edge (MHz)
+NR_BANDS = {
+    1: (2110, 2170), 2: (1930, 1990), 3: (1805, 1880), 5: (869, 894), 7: (2620, 2690),
+    8: (925, 960), 12: (729, 746), 13: (746, 756), 14: (758, 768), 18: (860, 875),
+    20: (791, 821), 24: (1525, 1559), 25: (1930, 1995), 26: (859, 894), 28: (758, 803),
+    29: (717, 728), 30: (2350, 2360), 34: (2010, 2025), 38: (2570, 2620), 39: (1880, 1920),
+    40: (2300, 2400), 41: (2496, 2690), 46: (5150, 5925), 47: (5855, 5925), 48: (3550, 3700),
+    50: (1432, 1517), 51: (1427, 1432), 53: (2483.5, 2495), 54: (1670, 1675), 65: (2110, 2200),
+    66: (2110, 2200), 67: (738, 758), 70: (1995, 2020), 71: (617, 652), 72: (461, 466),
+    74: (1475, 1518), 75: (1432, 1517), 76: (1427, 1432), 77: (3300, 4200), 78: (3300, 3800),
+    79: (4400, 5000), 85: (728, 746), 90: (2496, 2690), 91: (1427, 1432), 92: (1432, 1517),
+    93: (1427, 1432), 94: (1432, 1517), 96: (5925, 7125), 100: (919.4, 925), 101: (1900, 1910),
+    102: (5925, 6425), 104: (6425, 7125), 105: (612, 652),
+    257: (26500, 29500), 258: (24250, 27500), 259: (39500, 43500), 260: (37000, 40000),
+    261: (27500, 28350), 262: (47200, 48200), 263: (57000, 71000),
+}
+
+# NR global frequency raster (38.104 5.4.2.1): (F_REF-Offs kHz, N_REF-Offs, ΔF_Global kHz) by range
+NR_RASTERS = ((0, 3000000, (0, 0, 5)), (3000000, 24250000, (3000000, 600000, 15)),
+              (24250000, 100000000, (24250080, 2016667, 60)))
+
+# LTE bands (36.101 5.7.3): F_DL_low (MHz) and N_Offs-DL
+LTE_BANDS = {
+    1: (2110, 0), 2: (1930, 600), 3: (1805, 1200), 4: (2110, 1950), 5: (869, 2400),
+    6: (875, 2650), 7: (2620, 2750), 8: (925, 3450), 9: (1844.9, 3800), 10: (2110, 4150),
+    11: (1475.9, 4750), 12: (729, 5010), 13: (746, 5180), 14: (758, 5280), 17: (734, 5730),
+    18: (860, 5850), 19: (875, 6000), 20: (791, 6150), 21: (1495.9, 6450), 22: (3510, 6600),
+    23: (2180, 7500), 24: (1525, 7700), 25: (1930, 8040), 26: (859, 8690), 27: (852, 9040),
+    28: (758, 9210), 29: (717, 9660), 30: (2350, 9770), 31: (462.5, 9870), 32: (1452, 9920),
+    33: (1900, 36000), 34: (2010, 36200), 35: (1850, 36350), 36: (1930, 36950), 37: (1910, 37550),
+    38: (2570, 37750), 39: (1880, 38250), 40: (2300, 38650), 41: (2496, 39650), 42: (3400, 41590),
+    43: (3600, 43590), 44: (703, 45590), 45: (1447, 46590), 46: (5150, 46790), 47: (5855, 54540),
+    48: (3550, 55240), 49: (3550, 56740), 50: (1432, 58240), 51: (1427, 59090), 52: (3300, 59140),
+    53: (2483.5, 60140), 65: (2110, 65536), 66: (2110, 66436), 67: (738, 67336), 68: (753, 67536),
+    69: (2570, 67836), 70: (1995, 68336), 71: (617, 68586), 72: (461, 68936), 73: (460, 68986),
+    74: (1475, 69036), 75: (1432, 69466), 76: (1427, 70316), 85: (728, 70366), 87: (420, 70546),
+    88: (422, 70596),
+}
+
+def nr_raster(band_low_mhz):
+    f = round(band_low_mhz * 1000)
+    for low, high, raster in NR_RASTERS:
+        if low <= f < high:
+            return raster
+    return None
+
+# Precomputed lookup tables, band -> conversion constants
+# NR: ARFCN = (freq_khz - f_offs) // step + n_offs
+NR_ARFCN_TABLE = {band: nr_raster(low) for band, (low, _) in NR_BANDS.items()}
+# LTE (^CELLSCAN reports LTE frequencies in 100 kHz): EARFCN = freq - f_low + n_offs
+LTE_ARFCN_TABLE = {band: (round(low * 10), n_offs) for band, (low, n_offs) in LTE_BANDS.items()}
+
+RATS = {1: "UMTS (FDD)", 2: "LTE", 3: "NR"}
+RAT_CODES = {name: code for code, name in RATS.items()}
+SCS_KHZ = {"0": 15, "1": 30, "2": 60, "3": 120, "4": 240}
+# Field names of a parsed ^CELLSCAN: record
+CELL_FIELDS = ["rat", "plmn", "freq", "pci", "band", "lac", "scs", "rsrp", "rsrq", "sinr", "lte_sinr", "arfcn"]
+CELLSCAN_PREFIX = "^CELLSCAN: "
+CELLSCAN_FIELDS = 15
+
+def nr_arfcn(band, freq):
+    """
+    NR ARFCN of a DL frequency in kHz, None for an unknown band
+    """
+    params = NR_ARFCN_TABLE.get(band)
+    if params is None:
+        return None
+    f_offs, n_offs, step = params
+    return (freq - f_offs) // step + n_offs
+
+def lte_arfcn(band, freq):
+    """
+    LTE EARFCN of a DL frequency in 100 kHz, None for an unknown band
+    """
+    params = LTE_ARFCN_TABLE.get(band)
+    if params is None:
+        return None
+    f_low, n_offs = params
+    return freq - f_low + n_offs
+
+
+class CellScanTable:
+    """
+    Columnar (struct of arrays) form of a whole AT^CELLSCAN=3 dump
+    Missing numeric values are -1 for integer columns and NaN for float columns
+    """
+    INT_COLUMNS = (("rat", "b"), ("freq", "q"), ("pci", "i"), ("band", "i"), ("lac", "q"),
+                   ("scs", "h"), ("arfcn", "q"))
+    FLOAT_COLUMNS = ("rsrp", "rsrq", "sinr", "lte_sinr")
+
+    def __init__(self, columns=None):
+        columns = columns or {}
+        for name, typecode in self.INT_COLUMNS:
+            setattr(self, name, columns.get(name, array.array(typecode)))
+        for name in self.FLOAT_COLUMNS:
+            setattr(self, name, columns.get(name, array.array("d")))
+        self.plmn = columns.get("plmn", [])
+
+    def __len__(self):
+        return len(self.rat)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse every ^CELLSCAN: line of text in one pass per column
+        """
+        rows = [line[len(CELLSCAN_PREFIX):].rstrip("\r").split(",")
+                for line in text.split("\n") if line.startswith(CELLSCAN_PREFIX)]
+        rows = [row for row in rows if len(row) >= CELLSCAN_FIELDS]
+        if not rows:
+            return cls()
+        cols = list(zip(*rows))
+        nan = math.nan
+        sixteen = itertools.repeat(16)
+        rat = array.array("b", map(int, cols[0]))
+        freq = array.array("q", map(int, cols[2]))
+        band = array.array("i", map(int, cols[4], sixteen))
+        arfcn = array.array("q", [
+            -1 if value is None else value
+            for value in (nr_arfcn(b, f) if r == 3 else lte_arfcn(b, f) if r == 2 else None
+                          for r, b, f in zip(rat, band, freq))
+        ])
+        return cls({
+            "rat": rat,
+            "plmn": [plmn.strip('"') for plmn in cols[1]],
+            "freq": freq,
+            "pci": array.array("i", [int(x) if x else -1 for x in cols[3]]),
+            "band": band,
+            "lac": array.array("q", map(int, cols[5], sixteen)),
+            "scs": array.array("h", [SCS_KHZ.get(x.strip(), -1) for x in cols[10]]),
+            "rsrp": array.array("d", [float(x) if x else nan for x in cols[11]]),
+            "rsrq": array.array("d", [int(x) * 0.5 if x else nan for x in cols[12]]),
+            "sinr": array.array("d", [int(x) * 0.5 if x else nan for x in cols[13]]),
+            "lte_sinr": array.array("d", [int(x, 16) * 0.125 if x.strip() else nan for x in cols[14]]),
+            "arfcn": arfcn,
+        })
+
+    def take(self, indices):
+        """
+        New table with the rows at indices, in that order
+        """
+        columns = {"plmn": [self.plmn[i] for i in indices]}
+        for name, typecode in self.INT_COLUMNS:
+            column = getattr(self, name)
+            columns[name] = array.array(typecode, [column[i] for i in indices])
+        for name in self.FLOAT_COLUMNS:
+            column = getattr(self, name)
+            columns[name] = array.array("d", [column[i] for i in indices])
+        return CellScanTable(columns)
+
+    def filter(self, rat=None, band=None, arfcn=None, pci=None, min_rsrp=None):
+        """
+        Rows matching every given condition, rat is "NR", "LTE" or a RAT code
+        """
+        conditions = []
+        if rat is not None:
+            code = RAT_CODES.get(rat, rat)
+            conditions.append((self.rat, lambda value: value == code))
+        if band is not None:
+            conditions.append((self.band, lambda value: value == band))
+        if arfcn is not None:
+            conditions.append((self.arfcn, lambda value: value == arfcn))
+        if pci is not None:
+            conditions.append((self.pci, lambda value: value == pci))
+        if min_rsrp is not None:
+            conditions.append((self.rsrp, lambda value: value >= min_rsrp))
+        indices = range(len(self))
+        for column, test in conditions:
+            indices = [i for i in indices if test(column[i])]
+        return self.take(list(indices))
+
+    def sort(self, keys=("scs", "rsrp", "sinr", "rsrq")):
+        """
+        Rows sorted best first on keys (descending), missing values last
+        """
+        sort_keys = []
+        for name in keys:
+            column = getattr(self, name)
+            # Missing values become -inf so they sort after every real value
+            if name in self.FLOAT_COLUMNS:
+                sort_keys.append([-math.inf if value != value else value for value in column])
+            else:
+                sort_keys.append([-math.inf if value == -1 else value for value in column])
+        order = sorted(range(len(self)), key=lambda i: tuple(key[i] for key in sort_keys), reverse=True)
+        return self.take(order)
+
+    def records(self):
+        """
+        Rows in the list form of CellularManager.parse_cellscan_response
+        [rat, plmn, freq, pci, band, lac, scs, rsrp, rsrq, sinr, lte_sinr, arfcn]
+        """
+        def num(value):
+            return None if value != value else value
+
+        records = []
+        for i in range(len(self)):
+            rat = RATS.get(self.rat[i], "Unknown")
+            if self.arfcn[i] != -1:
+                arfcn = self.arfcn[i]
+            else:
+                arfcn = "Unknown earfcn" if rat in ("NR", "LTE") else "Unknown arfcn"
+            records.append([
+                rat, self.plmn[i], self.freq[i],
+                None if self.pci[i] == -1 else self.pci[i],
+                self.band[i], self.lac[i],
+                None if self.scs[i] == -1 else str(self.scs[i]),
+                None if self.rsrp[i] != self.rsrp[i] else int(self.rsrp[i]),
+                num(self.rsrq[i]), num(self.sinr[i]), num(self.lte_sinr[i]),
+                arfcn,
+            ])
+        return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse, filter and sort archived AT^CELLSCAN=3 dumps")
+    parser.add_argument("files", nargs="*", help="scan dumps, stdin when none")
+    parser.add_argument("--rat", choices=["NR", "LTE"], help="keep only this RAT")
+    parser.add_argument("--band", type=int, help="keep only this band")
+    parser.add_argument("--min-rsrp", type=float, help="keep only cells with at least this RSRP (dBm)")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    args = parser.parse_args()
+
+    text = "\n".join(open(path, errors="ignore").read() for path in args.files) if args.files else sys.stdin.read()
+    table = CellScanTable.parse(text).filter(rat=args.rat, band=args.band, min_rsrp=args.min_rsrp).sort()
+    if args.format == "csv":
+        print(",".join(CELL_FIELDS))
+    for record in table.records():
+        if args.format == "csv":
+            print(",".join("" if value is None else str(value) for value in record))
+        else:
+            print(json.dumps(dict(zip(CELL_FIELDS, record))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import time
+
+from cellscan import CELL_FIELDS, SCS_KHZ, CellScanTable
+from workflow import Workflow, restart_steps
+
+VERIFY_WINDOW = 20  # Signal sampling after the locked cell serves, before the lock is accepted (seconds)
+VERIFY_INTERVAL = 2  # Delay between signal samples (seconds)
+BASELINE_WINDOW = 6  # Signal sampling before locking, the lock must not be much worse (seconds)
+RESTART_TIMEOUT = 120  # Max time for the module to serve again after a restart (seconds)
+CANDIDATES = 5  # Candidates listed in the report
+PAIR_POOL = 8  # Best cells combined into 2CC pairs
+
+# Scoring policy, every key may be overridden from a JSON file
+# score = sum(weight * (value - floor)) + scs and band bonuses, cells below any floor are not candidates.
+# A 2CC pair scores its primary + cc2_weight * its secondary + cc2_bonus
+POLICY = {
+    "rats": ["NR"],  # AT^NRFREQLOCK only locks NR cells
+    "plmns": [],  # Only these PLMNs, empty for any
+    "bands": [],  # Only these bands, empty for any
+    "weights": {"rsrp": 1.0, "sinr": 1.5, "rsrq": 0.5},  # Points per dB above the floor
+    "floors": {"rsrp": -110, "sinr": 0, "rsrq": -15},  # dBm / dB
+    "scs_bonus": {"30": 5, "15": 0},  # Points by subcarrier spacing (kHz)
+    "band_bonus": {"78": 5},  # Points by band
+    "cc2_weight": 0.5,
+    "cc2_bonus": 0,
+    "max_sinr_loss": 3,  # A lock whose median SINR is this much below the baseline is rolled back (dB)
+}
+SCS_CODES = {str(khz): code for code, khz in SCS_KHZ.items()}  # "30" -> "1", as AT^NRFREQLOCK wants it
+
+
+def load_policy(path=None):
+    """
+    POLICY with the keys of a JSON file overriding it
+    """
+    policy = json.loads(json.dumps(POLICY))
+    if path:
+        with open(path) as f:
+            policy.update(json.load(f))
+    return policy
+
+
+def score(cell, policy=POLICY):
+    """
+    Score of one scanned cell dict (see CELL_FIELDS), None when it cannot be locked or misses a floor
+    """
+    if cell["rat"] not in policy["rats"] or not isinstance(cell["arfcn"], int) or cell["pci"] is None \
+            or str(cell["scs"]) not in SCS_CODES:
+        return None
+    if (policy["plmns"] and cell["plmn"] not in policy["plmns"]) or \
+            (policy["bands"] and cell["band"] not in policy["bands"]):
+        return None
+    total = policy["scs_bonus"].get(str(cell["scs"]), 0) + policy["band_bonus"].get(str(cell["band"]), 0)
+    for key, weight in policy["weights"].items():
+        value = cell.get(key)
+        if value is None:
+            return None
+        floor = policy["floors"].get(key, 0)
+        if value < floor:
+            return None
+        total += weight * (value - floor)
+    return round(total, 2)
+
+
+def lock_cells(cells):
+    """
+    (band, arfcn, scs code, pci) tuples of CellularManager.lock_command for cell dicts
+    """
+    return [(str(cell["band"]), str(cell["arfcn"]), SCS_CODES[str(cell["scs"])], str(cell["pci"])) for cell in cells]
+
+
+def candidates(cells, policy=POLICY, ccs=2):
+    """
+    Lock candidates of a scan, best first: [{"cells": [primary, secondary], "score": ...}, ...]
+    Each cell is one candidate alone, and with ccs=2 paired with a cell of the same PLMN on another ARFCN
+    """
+    best = {}
+    for cell in cells:
+        value = score(cell, policy)
+        key = (cell["arfcn"], cell["pci"])
+        if value is not None and (key not in best or value > best[key][0]):
+            best[key] = (value, cell)
+    ranked = sorted(best.values(), key=lambda item: item[0], reverse=True)
+    result = [{"cells": [cell], "score": value} for value, cell in ranked]
+    if ccs >= 2:
+        for (value1, cell1), (value2, cell2) in itertools.combinations(ranked[:PAIR_POOL], 2):
+            if cell1["arfcn"] != cell2["arfcn"] and cell1["plmn"] == cell2["plmn"]:
+                value = round(value1 + policy["cc2_weight"] * value2 + policy["cc2_bonus"], 2)
+                result.append({"cells": [cell1, cell2], "score": value})
+    result.sort(key=lambda candidate: candidate["score"], reverse=True)
+    return result
+
+
+def describe(cells):
+    return " + ".join(f"pci {cell['pci']} arfcn {cell['arfcn']} band {cell['band']}" for cell in cells)
+
+
+class CellSelector:
+    """
+    Lock the best candidate of a scan through a CellularManager, verify the service over a
+    short signal sampling window and restore the previous lock when it is not good enough
+    """
+    def __init__(self, manager, policy=None, window=VERIFY_WINDOW, interval=VERIFY_INTERVAL,
+                 restart_timeout=RESTART_TIMEOUT, log=print):
+        self.manager = manager
+        self.policy = policy or POLICY
+        self.window = window
+        self.interval = interval
+        self.restart_timeout = restart_timeout
+        self.log = log
+
+    def sample(self):
+        """
+        One signal sample, {"rsrp", "sinr", "rsrq", "arfcns"}, None while there is no NR/LTE service
+        """
+        results = self.manager.query(["signal", "ccinfo"])
+        signal, ccinfo = results["signal"], results["ccinfo"]
+        if "error" in signal or signal["rsrp"] is None or signal["sysmode"] not in ("NR", "LTE"):
+            return None
+        arfcns = [carrier["dl_fcn"] for carrier in ccinfo.get("carriers", [])] if "error" not in ccinfo else []
+        return {"rsrp": signal["rsrp"], "sinr": signal["sinr"], "rsrq": signal["rsrq"], "arfcns": arfcns}
+
+    def measure(self, seconds):
+        """
+        Median RSRP / SINR / RSRQ and the serving ARFCNs over seconds of sampling
+        """
+        samples = []
+        end = time.monotonic() + seconds
+        while True:
+            sample = self.sample()
+            if sample is not None:
+                samples.append(sample)
+            if time.monotonic() + self.interval > end:
+                break
+            time.sleep(self.interval)
+        summary = {"samples": len(samples), "arfcns": sorted({arfcn for s in samples for arfcn in s["arfcns"]})}
+        for key in ("rsrp", "sinr", "rsrq"):
+            values = [s[key] for s in samples if s[key] is not None]
+            summary[key] = statistics.median(values) if values else None
+        return summary
+
+    def previous_lock(self):
+        """
+        Cells locked now as (band, arfcn, scs, pci) tuples, [] when unlocked, None when unknown
+        """
+        lockstatus = self.manager.lockstatus()
+        if "error" in lockstatus:
+            return None
+        if not lockstatus["locked"]:
+            return []
+        cells = [tuple(fields) for fields in lockstatus.get("cells", []) if len(fields) == 4]
+        return cells or None
+
+    def apply(self, cells):
+        """
+        Lock cells ([] unlocks), restart the module and wait for service, return the workflow.Workflow report
+        """
+        command = self.manager.lock_command(cells) if cells else self.manager.at_commands["unlock_cell"]
+        return Workflow(self.manager, restart_steps(self.manager, command), service_timeout=self.restart_timeout,
+                        log=lambda message: None).run()
+
+    def verify(self, candidate, baseline, waited):
+        """
+        Sample the locked candidate serving since waited seconds, return (summary, reason it failed or None)
+        """
+        self.log(f"Service back after {waited}s, sampling the signal for {self.window}s...")
+        summary = dict(self.measure(self.window), service_s=waited)
+        primary = candidate["cells"][0]["arfcn"]
+        floors = self.policy["floors"]
+        if not summary["samples"]:
+            return summary, "service lost while sampling"
+        if summary["arfcns"] and primary not in summary["arfcns"]:
+            return summary, f"served on ARFCN {summary['arfcns']} instead of {primary}"
+        for key in ("rsrp", "sinr"):
+            if summary[key] is not None and key in floors and summary[key] < floors[key]:
+                return summary, f"median {key} {summary[key]} below {floors[key]}"
+        if baseline and baseline.get("sinr") is not None and summary["sinr"] is not None \
+                and summary["sinr"] < baseline["sinr"] - self.policy["max_sinr_loss"]:
+            return summary, f"median sinr {summary['sinr']} dB, {baseline['sinr']} dB before locking"
+        return summary, None
+
+    def run(self, cells, ccs=2, attempts=1, dry_run=False, previous=None):
+        """
+        Lock the best candidates of scanned cell dicts, at most attempts of them, until one verifies
+        previous is the lock to restore on failure as (band, arfcn, scs, pci) tuples, by default the current one
+        Returns a report dict, "locked" is the accepted candidate or None
+        """
+        ranked = candidates(cells, self.policy, ccs)
+        report = {
+            "candidates": [dict(candidate, command=self.manager.lock_command(lock_cells(candidate["cells"])))
+                           for candidate in ranked[:CANDIDATES]],
+            "attempts": [], "locked": None, "rolled_back": False, "error": None,
+        }
+        if not ranked:
+            report["error"] = "no cell meets the policy"
+            return report
+        if dry_run:
+            return report
+
+        if previous is None:
+            previous = self.previous_lock()
+        report["previous"] = previous
+        self.log(f"Sampling the current signal for {BASELINE_WINDOW}s...")
+        report["baseline"] = baseline = self.measure(BASELINE_WINDOW)
+        for candidate in ranked[:attempts]:
+            self.log(f"Locking {describe(candidate['cells'])} (score {candidate['score']}), restarting...")
+            attempt = {"cells": candidate["cells"], "score": candidate["score"]}
+            report["attempts"].append(attempt)
+            applied = self.apply(lock_cells(candidate["cells"]))
+            if applied["error"]:
+                attempt["verify"], attempt["error"] = {"service_s": applied["service_s"]}, applied["error"]
+                continue
+            attempt["verify"], attempt["error"] = self.verify(candidate, baseline, applied["service_s"])
+            if attempt["error"] is None:
+                report["locked"] = candidate
+                self.log(f"Locked {describe(candidate['cells'])}: {attempt['verify']}")
+                return report
+            self.log(f"Lock rejected: {attempt['error']}")
+
+        if previous is None:
+            report["error"] = "previous lock unknown, left unlocked"
+            previous = []
+        self.log("Restoring the previous lock..." if previous else "Unlocking...")
+        applied = self.apply(previous)
+        report["rolled_back"] = "waited" in applied["steps"][-1]  # Only set once AT+CFUN=1,1 was sent
+        if applied["error"]:
+            report["error"] = applied["error"] + (" after the rollback" if report["rolled_back"] else "")
+        return report
+
+
+def main():
+    from at import CellularManager, SOCKET_FILE
+    parser = argparse.ArgumentParser(description="Pick, lock and verify the best NR cell (or 2CC pair) of a scan")
+    parser.add_argument("files", nargs="*", help="archived AT^CELLSCAN=3 dumps, a new scan when none")
+    parser.add_argument("--policy", help="JSON file overriding keys of the scoring POLICY")
+    parser.add_argument("--ccs", type=int, choices=[1, 2], default=2, help="also consider 2CC pairs (default: 2)")
+    parser.add_argument("--attempts", type=int, default=1, help="candidates tried before rolling back (default: 1)")
+    parser.add_argument("--window", type=float, default=VERIFY_WINDOW, help="verification sampling (seconds)")
+    parser.add_argument("--dry-run", action="store_true", help="only rank the candidates")
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path of ats.py")
+    parser.add_argument("--modem", help="modem id of a fleet broker")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    args = parser.parse_args()
+
+    try:
+        policy = load_policy(args.policy)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+    manager = CellularManager(args.socket, modem=args.modem)
+    if args.files:
+        text = "\n".join(open(path, errors="ignore").read() for path in args.files)
+        cells = [dict(zip(CELL_FIELDS, record)) for record in CellScanTable.parse(text).records()]
+    else:
+        print("Scanning, this takes 1~2 mins...", file=sys.stderr)
+        scan = manager.scan()
+        if scan.get("error"):
+            print(f"Scan {scan.get('state')}: {scan['error']}", file=sys.stderr)
+        cells = scan.get("cells", [])
+
+    log = (lambda message: print(message, file=sys.stderr)) if args.format == "json" else print
+    selector = CellSelector(manager, policy, args.window, log=log)
+    report = selector.run(cells, args.ccs, args.attempts, args.dry_run)
+    if args.format == "json":
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        for index, candidate in enumerate(report["candidates"], 1):
+            print(f"{index}. score {candidate['score']:>7}  {describe(candidate['cells'])}  {candidate['command']}")
+        if report["locked"]:
+            print(f"Locked {describe(report['locked']['cells'])}")
+        elif not args.dry_run:
+            print(f"Nothing locked{', previous lock restored' if report['rolled_back'] else ''}")
+        if report["error"]:
+            print(f"Error: {report['error']}")
+    sys.exit(1 if report["error"] or not (report["locked"] or args.dry_run) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import argparse
+import os
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from at import CellularManager, SOCKET_FILE
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9249
+REFRESH_INTERVAL = 5  # Delay between two reads of the modem (seconds)
+MAX_AGE = 60  # Values older than this are no longer exported, only mt5700m_up 0 (seconds)
+QUERY_NAMES = ["signal", "ccinfo", "lockstatus", "temp"]
+TEXT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# (name, type, help) of every metric family, in exposition order
+FAMILIES = [
+    ("mt5700m_up", "gauge", "1 if the last refresh read the signal of the modem through ats.py"),
+    ("mt5700m_rsrp_dbm", "gauge", "Reference signal received power"),
+    ("mt5700m_sinr_db", "gauge", "Signal to interference plus noise ratio"),
+    ("mt5700m_rsrq_db", "gauge", "Reference signal received quality"),
+    ("mt5700m_chip_temperature_celsius", "gauge", "Chip temperature"),
+    ("mt5700m_carriers", "gauge", "Number of aggregated carriers"),
+    ("mt5700m_carrier_info", "gauge", "Always 1, the labels describe one carrier"),
+    ("mt5700m_carrier_dl_bandwidth_khz", "gauge", "Downlink bandwidth of one carrier"),
+    ("mt5700m_carrier_ul_bandwidth_khz", "gauge", "Uplink bandwidth of one carrier"),
+    ("mt5700m_cell_locked", "gauge", "1 if AT^NRFREQLOCK locks a cell"),
+    ("mt5700m_lock_info", "gauge", "Always 1, the labels describe the locked cell"),
+    # Per-command instrumentation of ats.py, absent when it runs with --no-metrics
+    ("mt5700m_command_duration_seconds", "histogram",
+     "Command phases in ats.py: queue wait, socket write, first byte and final result after the write, total"),
+    ("mt5700m_commands_total", "counter", "Commands sent to the modem by priority class and result"),
+    ("mt5700m_command_bytes_total", "counter", "Bytes written to and read from the modem for commands"),
+    ("mt5700m_last_refresh_timestamp_seconds", "gauge", "Unix time of the last successful refresh"),
+    ("mt5700m_refresh_duration_seconds", "gauge", "Time the last refresh took"),
+]
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def sample(name, value, **labels):
+    """
+    One exposition line, labels with a None value are left out
+    """
+    labels = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items() if value is not None)
+    return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+
+def unit_samples(results, modem=None):
+    """
+    Samples of one modem from CellularManager.query() results, {name: [line, ...]}
+    Queries that failed leave their gauges out
+    """
+    samples = {name: [] for name, _, _ in FAMILIES}
+    signal = results.get("signal", {"error": "not queried"})
+    samples["mt5700m_up"].append(sample("mt5700m_up", int("error" not in signal), modem=modem))
+    if "error" not in signal:
+        for key, name in (("rsrp", "mt5700m_rsrp_dbm"), ("sinr", "mt5700m_sinr_db"), ("rsrq", "mt5700m_rsrq_db")):
+            if signal[key] is not None:
+                samples[name].append(sample(name, signal[key], modem=modem, sysmode=signal["sysmode"]))
+
+    temp = results.get("temp", {})
+    if "error" not in temp:
+        samples["mt5700m_chip_temperature_celsius"].append(
+            sample("mt5700m_chip_temperature_celsius", temp["temp_c"], modem=modem))
+
+    ccinfo = results.get("ccinfo", {})
+    if "error" not in ccinfo:
+        carriers = ccinfo["carriers"]
+        samples["mt5700m_carriers"].append(
+            sample("mt5700m_carriers", len(carriers), modem=modem, sysmode=ccinfo["sysmode"]))
+        for index, carrier in enumerate(carriers):
+            labels = {"modem": modem, "cc": index, "sysmode": carrier["sysmode"], "band": carrier["band_class"]}
+            samples["mt5700m_carrier_info"].append(sample(
+                "mt5700m_carrier_info", 1, dl_arfcn=carrier["dl_fcn"], ul_arfcn=carrier["ul_fcn"], **labels))
+            for key, name in (("dl_bw", "mt5700m_carrier_dl_bandwidth_khz"),
+                              ("ul_bw", "mt5700m_carrier_ul_bandwidth_khz")):
+                if isinstance(carrier[key], int):
+                    samples[name].append(sample(name, carrier[key], **labels))
+
+    lockstatus = results.get("lockstatus", {})
+    if "error" not in lockstatus:
+        samples["mt5700m_cell_locked"].append(sample("mt5700m_cell_locked", int(lockstatus["locked"]), modem=modem))
+        if lockstatus["locked"]:
+            samples["mt5700m_lock_info"].append(sample("mt5700m_lock_info", 1, modem=modem, cell=lockstatus["cell"]))
+    return samples
+
+
+def command_samples(samples, metrics, modem=None):
+    """
+    Add the samples of the "metrics" op reply of one modem to samples
+    """
+    name = "mt5700m_command_duration_seconds"
+    for phase, priorities in metrics["histograms"].items():
+        for priority, histogram in priorities.items():
+            for bound, count in histogram["buckets"]:
+                samples[name].append(sample(name + "_bucket", count, modem=modem, phase=phase, priority=priority,
+                                            le=bound))
+            samples[name].append(sample(name + "_sum", histogram["sum"], modem=modem, phase=phase, priority=priority))
+            samples[name].append(sample(name + "_count", histogram["count"], modem=modem, phase=phase,
+                                        priority=priority))
+    for priority, results in metrics["results"].items():
+        for result, count in results.items():
+            samples["mt5700m_commands_total"].append(
+                sample("mt5700m_commands_total", count, modem=modem, priority=priority, result=result))
+    for direction in ("out", "in"):
+        samples["mt5700m_command_bytes_total"].append(
+            sample("mt5700m_command_bytes_total", metrics["bytes_" + direction], modem=modem, direction=direction))
+
+
+def render(units, refreshed, duration, openmetrics=False):
+    """
+    Exposition text of all modems, units is {modem id or None: {name: [line, ...]}}
+    OpenMetrics names a counter family without its _total suffix and ends with # EOF
+    """
+    lines = []
+    for name, kind, help_text in FAMILIES:
+        if name == "mt5700m_last_refresh_timestamp_seconds":
+            values = [sample(name, round(refreshed, 3))] if refreshed else []
+        elif name == "mt5700m_refresh_duration_seconds":
+            values = [sample(name, round(duration, 4))]
+        else:
+            values = [line for samples in units.values() for line in samples[name]]
+        if values:
+            family = name[:-len("_total")] if openmetrics and kind == "counter" else name
+            lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"] + values
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class Exporter:
+    """
+    Background refresher reading the modem every interval through ats.py,
+    scrapes are served from the last rendered snapshot and never reach the modem
+    """
+    def __init__(self, socket_file=SOCKET_FILE, interval=REFRESH_INTERVAL, max_age=MAX_AGE, modems=None):
+        self.modems = modems  # None: the broker's first modem, "*" or a list of ids of a fleet broker
+        self.manager = CellularManager(socket_file, priority="telemetry", modem=modems)
+        self.interval = interval
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.units = {}  # (time, samples) of the last successful read of each modem, one entry per modem
+        self.refreshed = 0  # Unix time of the last successful refresh
+        self.body = render({}, 0, 0).encode()
+        self.openmetrics_body = render({}, 0, 0, openmetrics=True).encode()
+
+    def refresh(self):
+        t0 = time.monotonic()
+        try:
+            if self.modems is None:
+                units = {None: unit_samples(self.manager.query(QUERY_NAMES))}
+            else:
+                units = {modem_id: unit_samples(results, modem_id)
+                         for modem_id, results in self.manager.fleet_query(QUERY_NAMES, self.modems).items()}
+            metrics = self.manager.metrics()  # Kept by ats.py, costs no modem round trip
+            for modem_id, samples in units.items():
+                unit = metrics if modem_id is None else metrics.get("units", {}).get(modem_id, {})
+                if "histograms" in unit:
+                    command_samples(samples, unit, modem_id)
+        except (OSError, ValueError) as e:
+            print(f"Refresh failed: {e}")
+            units = {}
+        now = time.time()
+        with self.lock:
+            up = {modem_id: samples["mt5700m_up"] for modem_id, samples in units.items()}
+            for modem_id, samples in units.items():
+                if samples["mt5700m_up"][0].endswith(" 1"):
+                    self.units[modem_id] = (now, samples)
+                    self.refreshed = now
+            current = {}
+            for modem_id in list(units) + [modem_id for modem_id in self.units if modem_id not in units]:
+                refreshed, samples = self.units.get(modem_id, (0, None))
+                if samples is None or now - refreshed > self.max_age:
+                    samples = {name: [] for name, _, _ in FAMILIES}  # Nothing recent enough to trust
+                # A failed read keeps the last values until they are too old, with mt5700m_up 0
+                current[modem_id] = dict(samples, mt5700m_up=up.get(
+                    modem_id, [sample("mt5700m_up", 0, modem=modem_id)]))
+            duration = time.monotonic() - t0
+            self.body = render(current, self.refreshed, duration).encode()
+            self.openmetrics_body = render(current, self.refreshed, duration, openmetrics=True).encode()
+
+    def run(self):
+        next_refresh = time.monotonic()
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:  # Keep serving the last snapshot whatever happens
+                print(f"Refresh error: {e}")
+            next_refresh += self.interval
+            delay = next_refresh - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_refresh = time.monotonic()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def snapshot(self, openmetrics=False):
+        with self.lock:
+            return self.openmetrics_body if openmetrics else self.body
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    exporter = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        body = self.exporter.snapshot(openmetrics)
+        content_type = OPENMETRICS_TYPE if openmetrics else TEXT_TYPE
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per scrape would flood the log
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0)  # BaseHTTPRequestHandler expects a (host, port) address
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prometheus/OpenMetrics exporter of MT5700M signal, carriers and lock")
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path of ats.py")
+    parser.add_argument("--host", default=METRICS_HOST, help="address to serve /metrics on")
+    parser.add_argument("--port", type=int, default=METRICS_PORT, help="port to serve /metrics on")
+    parser.add_argument("--listen-socket", help="serve /metrics on this Unix socket instead of a TCP port")
+    parser.add_argument("--interval", type=float, default=REFRESH_INTERVAL, help="seconds between modem reads")
+    parser.add_argument("--max-age", type=float, default=MAX_AGE, help="seconds after which values are dropped")
+    parser.add_argument("--modem", help="modem id of a fleet broker, '*' or a comma-separated list for several")
+    args = parser.parse_args()
+
+    modems = None
+    if args.modem:
+        modems = "*" if args.modem == "*" else args.modem.split(",")
+    exporter = Exporter(args.socket, args.interval, args.max_age, modems)
+    MetricsHandler.exporter = exporter
+
+    try:
+        if args.listen_socket:
+            if os.path.exists(args.listen_socket):
+                os.remove(args.listen_socket)
+            server = UnixHTTPServer(args.listen_socket, MetricsHandler)
+            print(f"Serving metrics on {args.listen_socket}")
+        else:
+            server = ThreadingHTTPServer((args.host, args.port), MetricsHandler)
+            server.daemon_threads = True
+            print(f"Serving metrics on http://{args.host}:{args.port}/metrics")
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    exporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.listen_socket and os.path.exists(args.listen_socket):
+            os.remove(args.listen_socket)
+
+if __name__ == "__main__":
+    main()
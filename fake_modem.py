@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import random
+import time
+
+HOST = "127.0.0.1"
+PORT = 20249
+LATENCY = 0.02  # Delay before each response (seconds)
+JITTER = 0.01  # Random extra delay, up to this many seconds
+SCAN_CELLS = 20  # ^CELLSCAN: lines returned by AT^CELLSCAN=3
+SCAN_TIME = 2  # Time AT^CELLSCAN=3 takes (seconds)
+REBOOT_TIME = 5  # Time the AT port stays down after AT+CFUN=1,1 (seconds)
+ATTACH_TIME = 2  # Time without service after the port is up again or after AT+COPS=0 (seconds)
+
+# Cells the fake modem "sees": (rat, plmn, DL frequency, pci, band), frequency in kHz for NR and 100 kHz for LTE
+CELLS = [
+    (3, "46001", 3549120, 579, 78),
+    (3, "46001", 3408960, 16, 78),
+    (3, "46011", 3500000, 334, 78),
+    (3, "46000", 2524950, 88, 41),
+    (2, "46001", 18500, 201, 3),
+    (2, "46011", 21000, 72, 1),
+    (2, "46000", 25850, 380, 41),
+]
+
+
+class FakeModem:
+    """
+    Simulated MT5700M AT port for benchmarks and testing without hardware
+    Answers the queries used by at.py with drifting values, keeps the lock and COPS state,
+    and can inject URCs, fragment responses, drop connections and reboot.
+    Service comes back attach_time after a reboot or AT+COPS=0, announced with a ^HCSQ URC
+    """
+    def __init__(self, latency=LATENCY, jitter=JITTER, cells=SCAN_CELLS, scan_time=SCAN_TIME,
+                 reboot_time=REBOOT_TIME, urc_interval=0, chunk=0, disconnect_every=0, drop_rate=0, echo=False,
+                 attach_time=ATTACH_TIME):
+        self.latency = latency
+        self.jitter = jitter
+        self.cells = cells
+        self.scan_time = scan_time
+        self.reboot_time = reboot_time
+        self.attach_time = attach_time
+        self.urc_interval = urc_interval
+        self.chunk = chunk
+        self.disconnect_every = disconnect_every
+        self.drop_rate = drop_rate
+        self.echo = echo
+        self.writers = set()
+        self.down_until = 0
+        self.service_at = 0  # Monotonic time the modem is registered again
+        self.locked = []  # Cells of the last AT^NRFREQLOCK=2,...
+        self.cops = 0
+        self.rsrp, self.sinr, self.rsrq, self.temp = 60, 150, 50, 450
+        self.stats = {"connections": 0, "commands": 0, "disconnects": 0, "reboots": 0, "urcs": 0}
+
+    def drift(self):
+        self.rsrp = min(97, max(1, self.rsrp + random.randint(-2, 2)))
+        self.sinr = min(251, max(1, self.sinr + random.randint(-4, 4)))
+        self.rsrq = min(126, max(1, self.rsrq + random.randint(-2, 2)))
+        self.temp = min(700, max(300, self.temp + random.randint(-3, 3)))
+
+    def hcsq(self):
+        if self.cops == 2 or time.monotonic() < self.service_at:
+            return '^HCSQ: "NOSERVICE"'
+        self.drift()
+        return f'^HCSQ: "NR",{self.rsrp},{self.sinr},{self.rsrq}'
+
+    def attach(self, delay):
+        """
+        Lose service for delay seconds, then report the signal with a ^HCSQ URC
+        """
+        self.service_at = time.monotonic() + delay
+        asyncio.get_running_loop().call_later(delay, self.announce)
+
+    def announce(self):
+        if time.monotonic() >= self.service_at and self.cops != 2:
+            self.broadcast(self.hcsq())
+
+    def broadcast(self, urc):
+        for writer in list(self.writers):
+            writer.write(f"\r\n{urc}\r\n".encode())
+            self.stats["urcs"] += 1
+
+    def hfreqinfo(self):
+        """
+        Serving carriers: the locked cells, or the default carrier while unlocked
+        """
+        carriers = []
+        for cell in self.locked or ['"78","627264","1","16"']:
+            band, arfcn = (field.strip('"') for field in cell.split(",")[:2])
+            freq = 3000000 + (int(arfcn) - 600000) * 15 if int(arfcn) >= 600000 else int(arfcn) * 5
+            carriers.append(f"{band},{arfcn},{freq},100000,{arfcn},{freq},100000")
+        return "^HFREQINFO: 0,7," + ",".join(carriers)
+
+    def scan_lines(self):
+        lines = []
+        for i in range(self.cells):
+            rat, plmn, freq, pci, band = CELLS[i % len(CELLS)]
+            pci = (pci + i // len(CELLS)) % 1008
+            rsrp = random.randint(-120, -70)
+            lines.append(f'^CELLSCAN: {rat},"{plmn}",{freq},{pci},{band:X},{0x1234 + i:X},0,0,0,0,1,'
+                         f'{rsrp},{random.randint(-30, -6)},{random.randint(-10, 60)},')
+        return lines
+
+    def respond(self, command):
+        """
+        Response lines and final result for one command, or None to reboot after answering OK
+        """
+        upper = command.upper()
+        if upper == "AT^HCSQ?":
+            return [self.hcsq()], "OK"
+        if upper == "AT^HFREQINFO?":
+            return [self.hfreqinfo()], "OK"
+        if upper == "AT^CHIPTEMP?":
+            self.drift()
+            return [f"^CHIPTEMP: {self.temp},{self.temp - 10},{self.temp - 20},0,0"], "OK"
+        if upper == "AT^NRFREQLOCK?":
+            if not self.locked:
+                return ["^NRFREQLOCK: 0"], "OK"
+            return ["^NRFREQLOCK: 2", f"0,{len(self.locked)}"] + self.locked + [""], "OK"
+        if upper.startswith("AT^NRFREQLOCK="):
+            fields = command.split("=", 1)[1].split(",")
+            if fields[0] == "0":
+                self.locked = []
+            elif fields[0] == "2" and len(fields) >= 3 and fields[2].isdigit():
+                n = int(fields[2])
+                cells = fields[3:]
+                if len(cells) != 4 * n:
+                    return [], "+CME ERROR: 50"
+                self.locked = [",".join(cells[i:i + 4]) for i in range(0, len(cells), 4)]
+            else:
+                return [], "+CME ERROR: 50"
+            return [], "OK"
+        if upper == "AT+COPS?":
+            return [f'+COPS: {self.cops},0,"CHN-UNICOM",13'], "OK"
+        if upper.startswith("AT+COPS="):
+            cops = 2 if command.split("=", 1)[1].startswith("2") else 0
+            if cops == 0 and self.cops == 2:
+                self.attach(self.attach_time)
+            self.cops = cops
+            return [], "OK"
+        if upper.startswith("AT^CELLSCAN="):
+            return self.scan_lines(), "OK"
+        if upper == "AT+CFUN=1,1":
+            return None
+        if upper == "ATI":
+            return ["Manufacturer: Fake", "Model: MT5700M-CN", "Revision: 0.0.0"], "OK"
+        if upper.startswith("AT"):
+            return [], "OK"
+        return [], "ERROR"
+
+    async def write(self, writer, data):
+        if self.chunk:
+            for i in range(0, len(data), self.chunk):
+                writer.write(data[i:i + self.chunk])
+                await writer.drain()
+                await asyncio.sleep(0)
+        else:
+            writer.write(data)
+            await writer.drain()
+
+    async def handle(self, reader, writer):
+        if time.monotonic() < self.down_until:
+            writer.close()  # Port open but the modem is not up yet
+            return
+        self.writers.add(writer)
+        self.stats["connections"] += 1
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                buffer += data
+                while b"\r" in buffer:
+                    line, buffer = buffer.split(b"\r", 1)
+                    command = line.decode(errors="replace").strip()
+                    if command and not await self.execute(command, writer):
+                        return
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def execute(self, command, writer):
+        """
+        Answer one command, False once the connection is gone
+        """
+        if self.echo:
+            await self.write(writer, command.encode() + b"\r")
+        if command.upper() == "AT+FAKESTATS?":  # Not counted, read by bench.py
+            stats = ",".join(f"{key}={value}" for key, value in self.stats.items())
+            await self.write(writer, f"\r\n+FAKESTATS: {stats}\r\n\r\nOK\r\n".encode())
+            return True
+        self.stats["commands"] += 1
+
+        if (self.disconnect_every and self.stats["commands"] % self.disconnect_every == 0) or \
+                random.random() < self.drop_rate:
+            self.stats["disconnects"] += 1
+            return False
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        result = self.respond(command)
+        if result is None:
+            await self.write(writer, b"\r\nOK\r\n")
+            self.reboot()
+            return False
+        lines, final = result
+        if command.upper().startswith("AT^CELLSCAN="):
+            # Results trickle in over the scan time, like the real modem
+            for i, line in enumerate(lines):
+                await asyncio.sleep(self.scan_time / max(len(lines), 1))
+                await self.write(writer, (b"\r\n" if i == 0 else b"") + line.encode() + b"\r\n")
+            await self.write(writer, f"\r\n{final}\r\n".encode())
+            return True
+        body = "".join(f"{line}\r\n" for line in lines)
+        await self.write(writer, f"\r\n{body}\r\n{final}\r\n".encode() if lines else f"\r\n{final}\r\n".encode())
+        return True
+
+    def reboot(self):
+        """
+        AT+CFUN=1,1: drop every connection and refuse new ones for the reboot time
+        """
+        self.stats["reboots"] += 1
+        self.down_until = time.monotonic() + self.reboot_time
+        self.cops = 0  # The lock survives, it is kept in NV like on the real modem
+        self.attach(self.reboot_time + self.attach_time)
+        for writer in list(self.writers):
+            writer.close()
+
+    async def inject_urcs(self):
+        while True:
+            await asyncio.sleep(self.urc_interval)
+            self.broadcast(self.hcsq())
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Fake modem listening on {host}:{port}")
+        if self.urc_interval:
+            asyncio.ensure_future(self.inject_urcs())
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated MT5700M AT port for benchmarks and testing")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="delay before each response (seconds)")
+    parser.add_argument("--jitter", type=float, default=JITTER, help="random extra delay, up to this many seconds")
+    parser.add_argument("--cells", type=int, default=SCAN_CELLS, help="^CELLSCAN: lines per AT^CELLSCAN=3")
+    parser.add_argument("--scan-time", type=float, default=SCAN_TIME, help="time AT^CELLSCAN=3 takes (seconds)")
+    parser.add_argument("--reboot-time", type=float, default=REBOOT_TIME,
+                        help="time the port stays down after AT+CFUN=1,1 (seconds)")
+    parser.add_argument("--attach-time", type=float, default=ATTACH_TIME,
+                        help="time without service after the port is up again or after AT+COPS=0 (seconds)")
+    parser.add_argument("--urc-interval", type=float, default=0, help="send a ^HCSQ URC every N seconds (0: off)")
+    parser.add_argument("--chunk", type=int, default=0, help="write responses in chunks of N bytes (0: whole)")
+    parser.add_argument("--disconnect-every", type=int, default=0, help="drop the connection every N commands")
+    parser.add_argument("--drop-rate", type=float, default=0, help="probability of dropping the connection per command")
+    parser.add_argument("--echo", action="store_true", help="echo commands back like ATE1")
+    args = parser.parse_args()
+
+    modem = FakeModem(args.latency, args.jitter, args.cells, args.scan_time, args.reboot_time,
+                      args.urc_interval, args.chunk, args.disconnect_every, args.drop_rate, args.echo,
+                      args.attach_time)
+    try:
+        asyncio.run(modem.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import argparse
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+STATUS_FILE = "/dev/shm/at_status" if os.path.isdir("/dev/shm") else "/tmp/at_status"
+STATUS_REFRESH = 5  # The broker queries a value nobody else asked for within this long (seconds), 0: never
+STATUS_HEARTBEAT = 1  # The broker rewrites its slots at least this often, readers tell a dead broker by the age (seconds)
+STATUS_STALE = 3 * STATUS_HEARTBEAT  # A reader looks for a new file (broker restarted) once the slot is this old (seconds)
+READ_ATTEMPTS = 1000  # Reads of a slot the writer keeps changing before the reader gives up
+MAX_CARRIERS = 8  # Component carriers kept of ^HFREQINFO
+MAX_CELLS = 4  # Locked cells kept of ^NRFREQLOCK
+# Queries refreshed by the broker, one per section of a slot, named as the queries of at.py
+STATUS_QUERIES = {
+    "signal": "AT^HCSQ?",
+    "ccinfo": "AT^HFREQINFO?",
+    "lockstatus": "AT^NRFREQLOCK?",
+    "temp": "AT^CHIPTEMP?",
+}
+
+# File layout: a 64 byte header, then one fixed-size slot per modem of the broker.
+# A slot is a seqlock: the generation is odd while the broker rewrites the slot and even once it is
+# consistent, and the CRC-32 of the payload is published with it. A reader copies the payload and accepts it
+# when the generation was even, did not change meanwhile and the CRC matches, otherwise it reads again.
+MAGIC = b"MT57STA1"
+VERSION = 1
+HEADER = struct.Struct("<8sIII")  # magic, version, slot count, slot size
+HEADER_SIZE = 64
+SEQUENCE = struct.Struct("<QI")  # generation, CRC-32 of the payload
+SLOT_HEADER_SIZE = 16
+SYSMODES = {"NOSERVICE": 0, "GSM": 1, "WCDMA": 2, "TD-SCDMA": 3, "LTE": 6, "NR": 7}  # As telemetry.py
+CARRIER_FIELDS = ("band_class", "dl_fcn", "dl_freq", "dl_bw", "ul_fcn", "ul_freq", "ul_bw")
+CELL_FIELDS = ("band", "arfcn", "scs", "pci")
+FIELDS = (
+    ("modem", "32s"),  # Modem id of the broker
+    ("heartbeat", "d"),  # Unix time the broker last wrote the slot
+    ("link_up", "?"),
+    ("rebooting", "?"),
+    ("link_changed", "d"),  # Unix time the link last went up or down, 0 when not since the broker started
+    # Each section has the Unix time the broker last saw its value, 0 when never
+    ("signal_time", "d"),
+    ("sysmode", "b"),  # See SYSMODES, -1 when unknown
+    ("rsrp", "f"),  # dBm, NaN when unknown
+    ("sinr", "f"),  # dB
+    ("rsrq", "f"),  # dB
+    ("rssi", "f"),  # dBm, LTE only
+    ("ccinfo_time", "d"),
+    ("proa", "b"),
+    ("cc_sysmode", "b"),
+    ("ccs", "B"),  # Carriers reported, the first MAX_CARRIERS are kept
+) + tuple((f"cc{i}_{name}", "i") for i in range(MAX_CARRIERS) for name in CARRIER_FIELDS) + (  # -1 when unknown
+    ("lockstatus_time", "d"),
+    ("locked", "b"),  # 1 locked, 0 not locked
+    ("cells", "B"),  # Locked cells reported, the first MAX_CELLS are kept
+) + tuple((f"cell{i}_{name}", "i") for i in range(MAX_CELLS) for name in CELL_FIELDS) + (
+    ("temp_time", "d"),
+    ("temp_c", "f"),
+)
+PAYLOAD = struct.Struct("<" + "".join(typecode for _, typecode in FIELDS))
+SLOT_SIZE = (SLOT_HEADER_SIZE + PAYLOAD.size + 63) & ~63  # One slot per cache line run
+NAMES = [name for name, _ in FIELDS]
+
+
+def number(value, default=-1):
+    """
+    int() of a response field, default when it is not a number
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def measure(value):
+    return math.nan if value is None else value
+
+
+class StatusSlot:
+    """
+    Writer of the slot of one modem, owned by the broker: update() takes atparse records
+    """
+    def __init__(self, mm, offset, modem_id):
+        self.mm = mm
+        self.offset = offset
+        self.generation = 0
+        self.values = dict.fromkeys(NAMES, -1)
+        self.values.update({name: 0.0 for name, typecode in FIELDS if typecode == "d"})
+        self.values.update({name: math.nan for name, typecode in FIELDS if typecode == "f"})
+        self.values.update(modem=modem_id.encode()[:32], link_up=False, rebooting=False, ccs=0, cells=0)
+        self.write()
+
+    def write(self):
+        """
+        Publish the values: odd generation, payload, then the next even generation with the payload CRC
+        """
+        values = self.values
+        values["heartbeat"] = time.time()
+        start = self.offset + SLOT_HEADER_SIZE
+        SEQUENCE.pack_into(self.mm, self.offset, self.generation + 1, 0)
+        PAYLOAD.pack_into(self.mm, start, *values.values())
+        self.generation += 2
+        SEQUENCE.pack_into(self.mm, self.offset, self.generation, zlib.crc32(self.mm[start:start + PAYLOAD.size]))
+
+    def age(self, section, now=None):
+        """
+        Seconds since the broker last saw the value of section, inf when never
+        """
+        seen = self.values[f"{section}_time"]
+        return (now or time.time()) - seen if seen else math.inf
+
+    def link(self, up, rebooting):
+        """
+        Publish the link state, the write also serves as the heartbeat
+        """
+        values = self.values
+        if up != values["link_up"]:
+            values["link_changed"] = time.time()
+        values["link_up"], values["rebooting"] = up, rebooting
+        self.write()
+
+    def update(self, record, now=None):
+        """
+        Publish an atparse record of one of the STATUS_QUERIES responses (or of a ^HCSQ URC),
+        other records and None are ignored
+        """
+        setter = getattr(self, f"set_{type(record).__name__}", None)
+        if setter is not None:
+            setter(record, now or time.time())
+            self.write()
+
+    def set_Signal(self, signal, now):
+        self.values.update(signal_time=now, sysmode=SYSMODES.get(signal.sysmode, -1), rsrp=measure(signal.rsrp),
+                           sinr=measure(signal.sinr), rsrq=measure(signal.rsrq), rssi=measure(signal.rssi))
+
+    def set_CarrierInfo(self, info, now):
+        values = self.values
+        values.update(ccinfo_time=now, proa=number(info.proa), cc_sysmode=SYSMODES.get(info.sysmode, -1),
+                      ccs=min(len(info.carriers), 255))
+        for i in range(MAX_CARRIERS):
+            carrier = info.carriers[i] if i < len(info.carriers) else None
+            for name in CARRIER_FIELDS:
+                values[f"cc{i}_{name}"] = number(getattr(carrier, name)) if carrier is not None else -1
+
+    def set_LockStatus(self, lock, now):
+        values = self.values
+        values.update(lockstatus_time=now, locked=int(lock.locked), cells=min(len(lock.cells), 255))
+        for i in range(MAX_CELLS):
+            cell = lock.cells[i] if i < len(lock.cells) else []
+            for j, name in enumerate(CELL_FIELDS):
+                values[f"cell{i}_{name}"] = number(cell[j]) if j < len(cell) else -1
+
+    def set_ChipTemp(self, temp, now):
+        self.values.update(temp_time=now, temp_c=temp.temp_c)
+
+
+class StatusWriter:
+    """
+    Creates the status file with one slot per modem id, the slots are in self.slots
+    The file is built aside and renamed into place, so readers never map a half-written header
+    """
+    def __init__(self, path, modem_ids):
+        self.path = path
+        size = HEADER_SIZE + len(modem_ids) * SLOT_SIZE
+        temp = f"{path}.{os.getpid()}"
+        with open(temp, "w+b") as f:
+            f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), size)
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, len(modem_ids), SLOT_SIZE)
+        self.slots = [StatusSlot(self.mm, HEADER_SIZE + i * SLOT_SIZE, modem_id)
+                      for i, modem_id in enumerate(modem_ids)]
+        os.replace(temp, path)
+        self.inode = os.stat(path).st_ino
+
+    def close(self):
+        """
+        Unmap and remove the file, unless another broker replaced it meanwhile
+        """
+        self.mm.close()
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+
+class StatusReader:
+    """
+    Read-only view of the status file of a running broker, any number of processes may read it at once
+    A read copies one slot out of shared memory, no syscall and no modem command
+    """
+    def __init__(self, path=STATUS_FILE):
+        self.path = path
+        self.mm = None
+        self.open()
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(f.fileno()).st_ino
+        try:
+            magic, version, nslots, slot_size = HEADER.unpack_from(mm, 0)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            mm.close()
+            raise ValueError(f"{self.path} is not a status file of version {VERSION}")
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mm
+        self.offsets = {}  # modem id -> slot offset, in the order of the broker
+        for i in range(nslots):
+            offset = HEADER_SIZE + i * SLOT_SIZE
+            modem_id = self.mm[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + 32].rstrip(b"\0").decode()
+            self.offsets[modem_id] = offset
+
+    def close(self):
+        self.mm.close()
+
+    @property
+    def modems(self):
+        return list(self.offsets)
+
+    def values(self, modem=None):
+        """
+        Consistent copy of the slot of modem (None: the first modem) as {field name: value}
+        Raises KeyError for an unknown modem id
+        """
+        offset = self.offsets[modem] if modem is not None else next(iter(self.offsets.values()))
+        start = offset + SLOT_HEADER_SIZE
+        mm = self.mm
+        for attempt in range(READ_ATTEMPTS):
+            generation, crc = SEQUENCE.unpack_from(mm, offset)
+            if not generation & 1:
+                payload = mm[start:start + PAYLOAD.size]
+                if SEQUENCE.unpack_from(mm, offset) == (generation, crc) and zlib.crc32(payload) == crc:
+                    values = dict(zip(NAMES, PAYLOAD.unpack(payload)))
+                    if time.time() - values["heartbeat"] > STATUS_STALE and self.replaced():
+                        return self.values(modem)
+                    return values
+            if attempt > 8:
+                time.sleep(0)  # The broker was descheduled halfway through a write, let it finish
+        raise TimeoutError(f"{self.path}: no consistent read of modem {modem or self.modems[0]}")
+
+    def replaced(self):
+        """
+        Map the file again if a restarted broker replaced it, True when it did
+        """
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                return False
+            self.open()
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def read(self, modem=None, now=None):
+        """
+        Snapshot of modem as the query results of at.py CellularManager: "signal", "ccinfo", "lockstatus" and
+        "temp" dicts with the decoded fields (no "raw" fields) plus "time" and "age" of the value,
+        {"error": ...} for a value the broker has not seen yet. "link" and "age" of the slot itself tell
+        whether the link is up and whether the broker is alive.
+        """
+        values = self.values(modem)
+        now = now or time.time()
+        sysmodes = {code: name for name, code in SYSMODES.items()}
+        snapshot = {
+            "modem": values["modem"].rstrip(b"\0").decode(),
+            "time": values["heartbeat"],
+            "age": round(now - values["heartbeat"], 3),
+            "link": {"up": values["link_up"], "rebooting": values["rebooting"],
+                     "changed": values["link_changed"] or None},
+        }
+        for section in STATUS_QUERIES:
+            seen = values[f"{section}_time"]
+            if not seen:
+                snapshot[section] = {"error": "no value yet"}
+                continue
+            result = getattr(self, f"read_{section}")(values, sysmodes)
+            result.update(time=seen, age=round(now - seen, 3))
+            snapshot[section] = result
+        return snapshot
+
+    @staticmethod
+    def read_signal(values, sysmodes):
+        result = {"sysmode": sysmodes.get(values["sysmode"])}
+        for name in ("rsrp", "sinr", "rsrq", "rssi"):
+            value = values[name]
+            result[name] = None if value != value else int(value) if name in ("rsrp", "rssi") else round(value, 1)
+        return result
+
+    @staticmethod
+    def read_ccinfo(values, sysmodes):
+        carriers = []
+        for i in range(min(values["ccs"], MAX_CARRIERS)):
+            carrier = {"proa": values["proa"], "sysmode": sysmodes.get(values["cc_sysmode"])}
+            for name in CARRIER_FIELDS:
+                value = values[f"cc{i}_{name}"]
+                carrier[name] = None if value == -1 else str(value) if name == "band_class" else value
+            carriers.append(carrier)
+        return {"proa": values["proa"], "sysmode": sysmodes.get(values["cc_sysmode"]), "carriers": carriers,
+                "ccs": values["ccs"]}
+
+    @staticmethod
+    def read_lockstatus(values, sysmodes):
+        cells = [[str(values[f"cell{i}_{name}"]) for name in CELL_FIELDS]
+                 for i in range(min(values["cells"], MAX_CELLS))]
+        return {"locked": bool(values["locked"] == 1), "cells": cells}
+
+    @staticmethod
+    def read_temp(values, sysmodes):
+        return {"temp_c": round(values["temp_c"], 1)}
+
+
+def show(snapshot, fmt):
+    if fmt == "json":
+        print(json.dumps(snapshot, ensure_ascii=False))
+        return
+    link = snapshot["link"]
+    print(f"[{snapshot['modem']}] link {'up' if link['up'] else 'down'}"
+          + (", rebooting" if link["rebooting"] else "") + f", written {snapshot['age']}s ago")
+    for section in STATUS_QUERIES:
+        result = dict(snapshot[section])
+        age = result.pop("age", None)
+        result.pop("time", None)
+        print(f"{section}: " + ", ".join(f"{key}={value}" for key, value in result.items())
+              + (f" ({age}s old)" if age is not None else ""))
+
+
+def benchmark(reader, modem, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        reader.values(modem)
+    values = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+    for _ in range(count):
+        reader.read(modem)
+    snapshot = (time.perf_counter() - start) / count
+    print(f"{count} reads: {values * 1e6:.1f} us per consistent slot copy, {snapshot * 1e6:.1f} us per decoded snapshot")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the live modem status ats.py publishes in shared memory")
+    parser.add_argument("--file", default=STATUS_FILE, help="status file of ats.py (default: %(default)s)")
+    parser.add_argument("--modem", help="modem id of a fleet broker (default: its first modem), '*' for all")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    parser.add_argument("--watch", type=float, metavar="S", help="print again every S seconds")
+    parser.add_argument("--bench", type=int, metavar="N", help="time N reads instead of printing")
+    args = parser.parse_args()
+
+    try:
+        reader = StatusReader(args.file)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    modems = reader.modems if args.modem == "*" else [args.modem]
+    try:
+        if args.bench:
+            benchmark(reader, modems[0], args.bench)
+            return
+        while True:
+            for modem in modems:
+                show(reader.read(modem), args.format)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyError as e:
+        print(f"Unknown modem: {e}", file=sys.stderr)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+if __name__ == "__main__":
+    main()
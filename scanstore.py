@@ -0,0 +1,253 @@
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+
+from cellscan import CELL_FIELDS, CellScanTable
+from timespec import parse_time
+
+SCAN_DB = "/tmp/at_scans.db"
+COMMIT_EVERY = 16  # Cells appended per transaction while a scan streams in
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,  -- Unix time
+    finished REAL,
+    modem TEXT,
+    state TEXT NOT NULL,  -- running, done, failed, imported
+    cells INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS cells (
+    scan_id INTEGER NOT NULL REFERENCES scans(id),
+    time REAL NOT NULL,  -- Unix time the cell was seen
+    modem TEXT,
+    rat TEXT, plmn TEXT, freq INTEGER, pci INTEGER, band INTEGER, lac INTEGER,
+    scs INTEGER,  -- kHz
+    rsrp REAL, rsrq REAL, sinr REAL, lte_sinr REAL,  -- dBm / dB, NULL when not reported
+    arfcn INTEGER
+);
+CREATE INDEX IF NOT EXISTS cells_time ON cells (time);
+CREATE INDEX IF NOT EXISTS cells_rat_band ON cells (rat, band, time);
+CREATE INDEX IF NOT EXISTS cells_arfcn_pci ON cells (arfcn, pci, time);
+CREATE INDEX IF NOT EXISTS cells_pci ON cells (pci, time);
+"""
+CELL_COLUMNS = list(CELL_FIELDS)  # One column of the cells table per scan field, a new field needs its column above
+INSERT_CELL = (f"INSERT INTO cells (scan_id, time, modem, {', '.join(CELL_COLUMNS)}) "
+               f"VALUES (?, ?, ?, {', '.join('?' * len(CELL_COLUMNS))})")
+
+
+def cell_row(cell):
+    """
+    Column values of a cell dict (see CELL_FIELDS), unknown ARFCNs and SCS become NULL
+    """
+    row = [cell.get(name) for name in CELL_COLUMNS]
+    row[CELL_COLUMNS.index("scs")] = int(cell["scs"]) if cell.get("scs") not in (None, "") else None
+    if not isinstance(cell.get("arfcn"), int):
+        row[CELL_COLUMNS.index("arfcn")] = None
+    return row
+
+
+class ScanStore:
+    """
+    SQLite history of cell scans, cells are appended as the scan lines arrive
+    and indexed by time, (rat, band), (arfcn, pci) and pci
+    """
+    def __init__(self, path=SCAN_DB):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")  # Readers never wait for a scan being written
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def begin(self, modem=None, started=None, state="running"):
+        """
+        Start a scan record, return its id
+        """
+        cursor = self.db.execute("INSERT INTO scans (started, modem, state) VALUES (?, ?, ?)",
+                                 (started or time.time(), modem, state))
+        self.db.commit()
+        return cursor.lastrowid
+
+    def add(self, scan_id, cell, seen=None, modem=None):
+        """
+        Append one cell dict of a scan, committed every COMMIT_EVERY cells
+        """
+        self.db.execute(INSERT_CELL,
+                        [scan_id, seen or time.time(), modem] + cell_row(cell))
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_EVERY:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def recorder(self, scan_id, on_record=None, modem=None):
+        """
+        on_record callback for CellularManager.scan_cells that appends each record, then calls on_record
+        """
+        def record_cell(record):
+            self.add(scan_id, dict(zip(CELL_FIELDS, record)), modem=modem)
+            if on_record is not None:
+                on_record(record)
+        return record_cell
+
+    def finish(self, scan_id, state="done", error=None, finished=None, records=None, modem=None):
+        """
+        Close a scan record, records are all of its cell records: the ones reported
+        before its cells were appended (a scan joined in progress) are stored now
+        """
+        stored = self.db.execute("SELECT COUNT(*) FROM cells WHERE scan_id = ?", (scan_id,)).fetchone()[0]
+        if records and len(records) > stored:
+            seen = self.db.execute("SELECT started FROM scans WHERE id = ?", (scan_id,)).fetchone()[0]
+            self.db.executemany(INSERT_CELL,
+                                [[scan_id, seen, modem] + cell_row(dict(zip(CELL_FIELDS, record)))
+                                 for record in records[:len(records) - stored]])
+        self.db.execute("UPDATE scans SET finished = ?, state = ?, error = ?, "
+                        "cells = (SELECT COUNT(*) FROM cells WHERE scan_id = ?) WHERE id = ?",
+                        (finished or time.time(), state, error, scan_id, scan_id))
+        self.db.commit()
+        self.uncommitted = 0
+
+    def import_text(self, text, seen=None, modem=None):
+        """
+        Store an archived AT^CELLSCAN=3 dump as one scan, return its id
+        """
+        seen = seen or time.time()
+        scan_id = self.begin(modem, seen, "imported")
+        rows = [[scan_id, seen, modem] + cell_row(dict(zip(CELL_FIELDS, record)))
+                for record in CellScanTable.parse(text).records()]
+        self.db.executemany(INSERT_CELL, rows)
+        self.finish(scan_id, "imported", finished=seen)
+        return scan_id
+
+    def best(self, rat=None, band=None, since=0, until=math.inf, modem=None, limit=10, order="rsrp"):
+        """
+        Cells seen in a time range, one row per (arfcn, pci), best average order value first
+        """
+        where, params = ["time >= ?", "time <= ?"], [since, until if until != math.inf else 1e18]
+        for column, value in (("rat", rat), ("band", band), ("modem", modem)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if order not in ("rsrp", "sinr", "rsrq"):
+            raise ValueError(f"cannot order by {order}")
+        query = (f"SELECT rat, plmn, band, arfcn, pci, MAX(scs) AS scs, COUNT(*) AS seen, MAX(time) AS last_seen, "
+                 f"MAX(rsrp) AS max_rsrp, ROUND(AVG(rsrp), 1) AS rsrp, ROUND(AVG(sinr), 1) AS sinr, "
+                 f"ROUND(AVG(rsrq), 1) AS rsrq FROM cells WHERE {' AND '.join(where)} "
+                 f"GROUP BY arfcn, pci ORDER BY AVG({order}) IS NULL, AVG({order}) DESC LIMIT ?")
+        return [dict(row) for row in self.db.execute(query, params + [limit])]
+
+    def trend(self, pci, arfcn=None, since=0, until=math.inf, modem=None, step=None):
+        """
+        RSRP / SINR / RSRQ of one cell over time, averaged per step seconds if given
+        """
+        where, params = ["pci = ?", "time >= ?", "time <= ?"], [pci, since, until if until != math.inf else 1e18]
+        for column, value in (("arfcn", arfcn), ("modem", modem)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if step:
+            query = (f"SELECT CAST(time / ? AS INTEGER) * ? AS time, arfcn, COUNT(*) AS seen, "
+                     f"ROUND(AVG(rsrp), 1) AS rsrp, ROUND(AVG(sinr), 1) AS sinr, ROUND(AVG(rsrq), 1) AS rsrq "
+                     f"FROM cells WHERE {' AND '.join(where)} GROUP BY 1, arfcn ORDER BY 1")
+            params = [step, step] + params
+        else:
+            query = f"SELECT time, arfcn, rsrp, sinr, rsrq FROM cells WHERE {' AND '.join(where)} ORDER BY time"
+        return [dict(row) for row in self.db.execute(query, params)]
+
+    def scans(self, limit=20):
+        return [dict(row) for row in self.db.execute("SELECT * FROM scans ORDER BY id DESC LIMIT ?", (limit,))]
+
+
+def output(rows, fmt):
+    if fmt == "json":
+        print(json.dumps(rows, ensure_ascii=False))
+    elif fmt == "csv":
+        if rows:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        from tabulate import tabulate
+        for row in rows:
+            for key in ("time", "last_seen", "started", "finished"):
+                if row.get(key):
+                    row[key] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[key]))
+        print(tabulate(rows, headers="keys", tablefmt="grid") if rows else "No matching cells")
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", default=SCAN_DB, help="SQLite scan history file (default: %(default)s)")
+    common.add_argument("--format", choices=["text", "csv", "json"], default="text")
+    parser = argparse.ArgumentParser(description="Cell scan history: import dumps and query it without the modem",
+                                     epilog="examples: scanstore.py best --rat NR --band 78 --since 7d | "
+                                            "scanstore.py trend --pci 579 --step 3600")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    best = commands.add_parser("best", parents=[common], help="best cells seen in a time range")
+    best.add_argument("--rat", choices=["NR", "LTE"])
+    best.add_argument("--band", type=int)
+    best.add_argument("--modem", help="modem id of a fleet")
+    best.add_argument("--since", default="7d", help="start: Unix time or ago such as 6h, 7d (default: 7d)")
+    best.add_argument("--until", help="end: Unix time or ago (default: now)")
+    best.add_argument("--order", choices=["rsrp", "sinr", "rsrq"], default="rsrp", help="rank by this average")
+    best.add_argument("--limit", type=int, default=10)
+
+    trend = commands.add_parser("trend", parents=[common], help="signal of one cell over time")
+    trend.add_argument("--pci", type=int, required=True)
+    trend.add_argument("--arfcn", type=int)
+    trend.add_argument("--modem", help="modem id of a fleet")
+    trend.add_argument("--since", default="7d", help="start: Unix time or ago such as 6h, 7d (default: 7d)")
+    trend.add_argument("--until", help="end: Unix time or ago (default: now)")
+    trend.add_argument("--step", type=float, help="average into buckets of this many seconds")
+
+    scans = commands.add_parser("scans", parents=[common], help="latest scans")
+    scans.add_argument("--limit", type=int, default=20)
+
+    importer = commands.add_parser("import", parents=[common], help="store archived AT^CELLSCAN=3 dumps, one scan per file")
+    importer.add_argument("files", nargs="+")
+    importer.add_argument("--modem", help="modem id of a fleet")
+    args = parser.parse_args()
+
+    try:
+        store = ScanStore(args.db)
+        now = time.time()
+        if args.command == "import":
+            for path in args.files:
+                with open(path, errors="ignore") as f:
+                    text = f.read()
+                scan_id = store.import_text(text, seen=os.path.getmtime(path), modem=args.modem)
+                print(f"{path}: scan {scan_id}, {store.scans(1)[0]['cells']} cells")
+        elif args.command == "scans":
+            output(store.scans(args.limit), args.format)
+        else:
+            since = parse_time(args.since, now)
+            until = parse_time(args.until, now) if args.until else math.inf
+            t0 = time.perf_counter()
+            if args.command == "best":
+                rows = store.best(args.rat, args.band, since, until, args.modem, args.limit, args.order)
+            else:
+                rows = store.trend(args.pci, args.arfcn, since, until, args.modem, args.step)
+            elapsed = time.perf_counter() - t0
+            output(rows, args.format)
+            if args.format == "text":
+                print(f"{len(rows)} rows in {elapsed * 1000:.1f} ms")
+        store.close()
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import argparse
+import array
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+from at import CellularManager, SOCKET_FILE
+from timespec import parse_time
+
+RING_FILE = "/tmp/at_telemetry.ring"
+SAMPLE_INTERVAL = 1  # Delay between samples (seconds)
+RING_CAPACITY = 7 * 24 * 3600  # Samples kept, 7 days at 1 Hz is about 26 MB
+
+# File layout: a 64 byte header, then one fixed-size column per field (struct of arrays),
+# so a time range of one field is a contiguous slice of the file
+MAGIC = b"MT57TLM1"
+VERSION = 1
+# magic, version, column count, capacity, samples written, interval,
+# and samples written up to the latest one older than the sample before it (wall clock stepped back), 0 for none
+HEADER = struct.Struct("<8sIIQQdQ")
+HEADER_SIZE = 64
+COLUMNS = (
+    ("time", "d"),  # Unix time of the sample
+    ("rsrp", "f"),  # dBm, NaN when unknown
+    ("sinr", "f"),  # dB
+    ("rsrq", "f"),  # dB
+    ("temp", "f"),  # Chip temperature °C
+    ("arfcn", "i"),  # DL ARFCN of the first carrier, -1 when unknown
+    ("band", "i"),
+    ("bw", "i"),  # DL bandwidth of the first carrier
+    ("ccs", "b"),  # Number of carriers
+    ("sysmode", "b"),  # See SYSMODES
+)
+FLOAT_COLUMNS = [name for name, typecode in COLUMNS if typecode in "fd" and name != "time"]
+SYSMODES = {"NOSERVICE": 0, "GSM": 1, "WCDMA": 2, "TD-SCDMA": 3, "LTE": 6, "NR": 7}
+
+
+class TelemetryRing:
+    """
+    Fixed-size, memory-mapped ring file of decoded signal samples
+    One writer appends, any number of readers map the same file read-only
+    """
+    def __init__(self, path=RING_FILE, capacity=RING_CAPACITY, interval=SAMPLE_INTERVAL, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable and not os.path.exists(path):
+            self.create(path, capacity, interval)
+        with open(path, "r+b" if writable else "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, version, ncolumns, self.capacity, _, self.interval, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION or ncolumns != len(COLUMNS):
+            self.mm.close()
+            raise ValueError(f"{path} is not a telemetry ring file of version {VERSION}")
+        if writable and capacity != self.capacity:
+            print(f"Using the existing capacity of {path}: {self.capacity} samples")
+
+        self.columns = {}
+        offset = HEADER_SIZE
+        for name, typecode in COLUMNS:
+            size = array.array(typecode).itemsize * self.capacity
+            self.columns[name] = memoryview(self.mm)[offset:offset + size].cast(typecode)
+            offset += (size + 7) & ~7
+
+    @staticmethod
+    def create(path, capacity, interval):
+        size = HEADER_SIZE
+        for _, typecode in COLUMNS:
+            size += (array.array(typecode).itemsize * capacity + 7) & ~7
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(COLUMNS), capacity, 0, interval, 0).ljust(HEADER_SIZE, b"\0"))
+            f.truncate(size)
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.mm.close()
+
+    @property
+    def written(self):
+        return HEADER.unpack_from(self.mm, 0)[4]
+
+    def append(self, sample):
+        """
+        Store one sample dict, missing or None values are stored as NaN / -1
+        """
+        written = self.written
+        index = written % self.capacity
+        t = sample.get("time")
+        if written and t is not None and t < self.columns["time"][(written - 1) % self.capacity]:
+            struct.pack_into("<Q", self.mm, 40, written + 1)  # Clock stepped back (NTP, RTC at boot)
+        for name, typecode in COLUMNS:
+            value = sample.get(name)
+            if typecode in "fd":
+                self.columns[name][index] = math.nan if value is None else float(value)
+            else:
+                self.columns[name][index] = -1 if value is None else int(value)
+        # Publish the sample only once all of its columns are written
+        struct.pack_into("<Q", self.mm, 24, written + 1)
+
+    def span(self):
+        """
+        Physical index of the oldest sample and the number of samples readable
+        A full ring leaves out the slot the writer overwrites next
+        """
+        written = self.written
+        if written <= self.capacity - 1:
+            return 0, written
+        return (written + 1) % self.capacity, self.capacity - 1
+
+    def ordered(self):
+        """
+        Whether the readable samples are in time order, i.e. none of them was taken after a clock step back
+        """
+        _, count = self.span()
+        stepped = HEADER.unpack_from(self.mm, 0)[6]
+        return stepped - 1 <= self.written - count
+
+    def locate(self, t):
+        """
+        Logical position (0 = oldest) of the first sample at or after t
+        """
+        start, count = self.span()
+        times = self.columns["time"]
+        capacity = self.capacity
+
+        class Times:
+            def __len__(self):
+                return count
+
+            def __getitem__(self, i):
+                return times[(start + i) % capacity]
+
+        return bisect.bisect_left(Times(), t)
+
+    def segments(self, since, until):
+        """
+        Physical [start, end) slices holding the samples with since <= time < until,
+        at most two while the samples are in time order
+        """
+        start, count = self.span()
+        if not self.ordered():
+            return self.scan(start, count, since, until)
+        first, last = self.locate(since), self.locate(until)
+        if first >= last:
+            return []
+        first, last = start + first, start + last
+        if last <= self.capacity:
+            return [(first, last)]
+        if first >= self.capacity:
+            return [(first - self.capacity, last - self.capacity)]
+        return [(first, self.capacity), (0, last - self.capacity)]
+
+    def scan(self, start, count, since, until):
+        """
+        segments() by a linear scan, for samples out of time order: one slice per run of matching samples
+        """
+        times = self.columns["time"]
+        runs = []
+        for i in range(start, start + count):
+            index = i % self.capacity
+            if since <= times[index] < until:
+                if runs and runs[-1][1] == index:
+                    runs[-1][1] = index + 1
+                else:
+                    runs.append([index, index + 1])
+        return [tuple(run) for run in runs]
+
+    def read(self, since=0, until=math.inf, names=None):
+        """
+        Columns of the samples in [since, until) as {name: array.array}, copied straight from the file
+        """
+        segments = self.segments(since, until)
+        result = {}
+        for name, typecode in COLUMNS:
+            if names and name not in names:
+                continue
+            column = array.array(typecode)
+            for first, last in segments:
+                column.frombytes(self.columns[name][first:last].cast("B"))
+            result[name] = column
+        return result
+
+    def downsample(self, since=0, until=math.inf, step=60):
+        """
+        Aggregate [since, until) into step second buckets
+        Returns a list of {"time", "count", "<field>_mean", "<field>_min", "<field>_max"}, NaN samples ignored
+        """
+        data = self.read(since, until, ["time"] + FLOAT_COLUMNS)
+        if not self.ordered():  # read() keeps the write order, the buckets need time order
+            order = sorted(range(len(data["time"])), key=data["time"].__getitem__)
+            data = {name: array.array(column.typecode, [column[i] for i in order]) for name, column in data.items()}
+        times = data["time"]
+        rows = []
+        i = 0
+        while i < len(times):
+            bucket = times[i] - times[i] % step
+            end = bisect.bisect_left(times, bucket + step, i)
+            row = {"time": bucket, "count": end - i}
+            for name in FLOAT_COLUMNS:
+                values = [value for value in data[name][i:end] if value == value]
+                if values:
+                    row[f"{name}_mean"] = round(sum(values) / len(values), 2)
+                    row[f"{name}_min"] = round(min(values), 2)
+                    row[f"{name}_max"] = round(max(values), 2)
+                else:
+                    row[f"{name}_mean"] = row[f"{name}_min"] = row[f"{name}_max"] = None
+            rows.append(row)
+            i = end
+        return rows
+
+
+def sample_from(results, t):
+    """
+    Flatten CellularManager.query(["signal", "ccinfo", "temp"]) into one ring sample
+    """
+    signal, ccinfo, temp = results["signal"], results["ccinfo"], results["temp"]
+    sample = {"time": t}
+    if "error" not in signal:
+        sample.update(rsrp=signal["rsrp"], sinr=signal["sinr"], rsrq=signal["rsrq"],
+                      sysmode=SYSMODES.get(signal["sysmode"].upper()))
+    if "error" not in ccinfo:
+        carriers = ccinfo["carriers"]
+        sample["ccs"] = len(carriers)
+        if carriers:
+            first = carriers[0]
+            for name, key in (("arfcn", "dl_fcn"), ("band", "band_class"), ("bw", "dl_bw")):
+                try:
+                    sample[name] = int(first[key])
+                except (TypeError, ValueError):
+                    pass
+    if "error" not in temp:
+        sample["temp"] = temp["temp_c"]
+    return sample
+
+
+def record(args):
+    """
+    Sampling daemon: AT^HCSQ?, AT^HFREQINFO? and AT^CHIPTEMP? in one batch every interval
+    """
+    manager = CellularManager(args.socket, priority="telemetry")
+    ring = TelemetryRing(args.file, args.capacity, args.interval, writable=True)
+    print(f"Recording telemetry to {args.file} every {args.interval}s ({ring.capacity} samples kept)")
+    next_sample = time.monotonic()
+    try:
+        while True:
+            ring.append(sample_from(manager.query(["signal", "ccinfo", "temp"]), time.time()))
+            next_sample += args.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.monotonic()  # Modem slower than the interval, do not burst to catch up
+    except KeyboardInterrupt:
+        print("Stop recording.")
+    finally:
+        ring.close()
+
+
+def query(args):
+    ring = TelemetryRing(args.file)
+    now = time.time()
+    since, until = parse_time(args.since, now), parse_time(args.until, now) if args.until else math.inf
+    try:
+        if args.step:
+            rows = ring.downsample(since, until, args.step)
+        else:
+            data = ring.read(since, until)
+            rows = [
+                {name: (None if isinstance(column[i], float) and column[i] != column[i] else column[i])
+                 for name, column in data.items()}
+                for i in range(len(data["time"]))
+            ]
+    finally:
+        ring.close()
+
+    if args.format == "json":
+        print(json.dumps(rows))
+    elif args.format == "ndjson":
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        if rows:
+            print(",".join(rows[0]))
+        for row in rows:
+            print(",".join("" if value is None else str(value) for value in row.values()))
+
+
+def info(args):
+    ring = TelemetryRing(args.file)
+    start, count = ring.span()
+    times = ring.columns["time"]
+    print(f"file: {args.file}")
+    print(f"capacity: {ring.capacity} samples, interval: {ring.interval}s")
+    print(f"samples: {count} readable, {ring.written} written")
+    if count:
+        oldest, newest = times[start], times[(start + count - 1) % ring.capacity]
+        print(f"range: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(oldest))} - "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(newest))}")
+    ring.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signal telemetry sampler and ring file reader for MT5700M")
+    parser.add_argument("--file", default=RING_FILE, help="telemetry ring file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    recorder = commands.add_parser("record", help="sample the modem into the ring file")
+    recorder.add_argument("--interval", type=float, default=SAMPLE_INTERVAL, help="seconds between samples")
+    recorder.add_argument("--capacity", type=int, default=RING_CAPACITY, help="samples kept when creating the file")
+    recorder.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path of ats.py")
+    recorder.set_defaults(func=record)
+
+    reader = commands.add_parser("query", help="read a time range, optionally downsampled")
+    reader.add_argument("--since", default="1h", help="start: Unix time or ago such as 90s, 15m, 6h, 1d (default: 1h)")
+    reader.add_argument("--until", help="end: Unix time or ago (default: now)")
+    reader.add_argument("--step", type=float, help="downsample into buckets of this many seconds")
+    reader.add_argument("--format", choices=["csv", "json", "ndjson"], default="csv")
+    reader.set_defaults(func=query)
+
+    commands.add_parser("info", help="show the ring file header").set_defaults(func=info)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import asyncio
+
+from ats import PRIORITY_LIMITS, Modem, ResponseCache, command_priority, is_query
+
+
+def test_chained_commands_are_not_queries():
+    assert is_query("AT^HCSQ?")
+    assert is_query(" at+cgdcont=? ")
+    for command in ("AT+CFUN=0;^HCSQ?", "AT^NRFREQLOCK=0;^HCSQ?", "AT^HCSQ?;+CFUN=1,1", "AT+CFUN=1,1"):
+        assert not is_query(command)
+        assert command_priority(command) == "control"
+    assert command_priority("AT^HCSQ?") == "telemetry"
+
+
+def test_chained_commands_are_not_cached():
+    cache = ResponseCache()
+    assert cache.ttl("AT^HCSQ?") > 0
+    assert cache.ttl("AT+CFUN=0;^HCSQ?") == 0
+
+
+def test_chain_invalidates_every_entry():
+    cache = ResponseCache()
+    cache.entries["AT^HCSQ?"] = cache.entries["AT^CHIPTEMP?"] = object()
+    cache.invalidate("AT^NRFREQLOCK=0;^HCSQ?")
+    assert not cache.entries
+
+
+class DownLink:
+    """
+    ModemLink that stays down, recording how long each command waited for it
+    """
+    rebooting = False
+
+    def __init__(self):
+        self.waits = []
+
+    async def wait_up(self, wait):
+        self.waits.append(wait)
+        return False
+
+
+def test_link_wait_comes_from_the_modem_limits():
+    limits = {name: dict(limit) for name, limit in PRIORITY_LIMITS.items()}
+    limits["control"]["link_wait"] = 3
+    link = DownLink()
+    modem = Modem("unit1", link, limits=limits)
+
+    async def run():
+        feed = asyncio.create_task(modem.feed())
+        try:
+            await modem.submit("AT^NRFREQLOCK=0", 1, timeout=1)
+        except ConnectionError:
+            pass
+        feed.cancel()
+
+    asyncio.run(run())
+    assert link.waits == [3]
@@ -0,0 +1,40 @@
+import math
+
+from telemetry import TelemetryRing
+
+
+def ring_with_clock_step(path):
+    """
+    A ring of 1 Hz samples where the clock stepped back by 60 s after 150 of them
+    """
+    ring = TelemetryRing(str(path), capacity=300, writable=True)
+    for i in range(150):
+        ring.append({"time": 1000 + i, "rsrp": -90})
+    for i in range(20):
+        ring.append({"time": 1090 + i, "rsrp": -80})
+    return ring
+
+
+def test_read_after_clock_step(tmp_path):
+    ring = ring_with_clock_step(tmp_path / "ring")
+    assert not ring.ordered()
+    times = sorted(ring.read(1095, 1100)["time"])
+    assert times == [1095, 1095, 1096, 1096, 1097, 1097, 1098, 1098, 1099, 1099]
+    ring.close()
+
+
+def test_downsample_after_clock_step(tmp_path):
+    ring = ring_with_clock_step(tmp_path / "ring")
+    rows = ring.downsample(0, math.inf, 60)
+    assert [(row["time"], row["count"]) for row in rows] == [(960, 20), (1020, 60), (1080, 80), (1140, 10)]
+    assert rows[2]["rsrp_min"] == -90 and rows[2]["rsrp_max"] == -80
+    ring.close()
+
+
+def test_ordered_again_once_the_step_is_overwritten(tmp_path):
+    ring = ring_with_clock_step(tmp_path / "ring")
+    for i in range(300):
+        ring.append({"time": 2000 + i})
+    assert ring.ordered()
+    assert list(ring.read(2010, 2013)["time"]) == [2010, 2011, 2012]
+    ring.close()
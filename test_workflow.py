@@ -0,0 +1,52 @@
+from at import CellularManager
+from workflow import Workflow, restart_steps
+
+
+class FakeSession:
+    """
+    BrokerSession answering each command with the next canned reply
+    """
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent = []
+
+    def execute(self, commands, timeout=None, priority=None, parse=False):
+        self.sent.extend(commands)
+        return [dict(self.replies.pop(0), id=index) for index, _ in enumerate(commands, 1)]
+
+
+def manager_with(replies):
+    manager = CellularManager("/nonexistent.sock")
+    manager.session = FakeSession(replies)
+    return manager
+
+
+def test_raw_keeps_the_broker_error():
+    manager = manager_with([{"error": "Modem link closed"}])
+    assert manager.raw("AT+CFUN=1,1") == {"command": "AT+CFUN=1,1", "error": "Modem link closed"}
+
+
+def test_reset_with_lost_reply_is_restarting():
+    manager = manager_with([{"error": "Modem link closed"}])
+    workflow = Workflow(manager, restart_steps(manager), log=lambda message: None)
+    assert workflow.send("AT+CFUN=1,1") == (1, None)
+    assert manager.session.sent == ["AT+CFUN=1,1"]
+
+
+def test_reset_timeout_is_not_retried():
+    manager = manager_with([{"error": "timeout"}, {"response": "\r\nOK\r\n", "result": "OK"}])
+    workflow = Workflow(manager, restart_steps(manager), log=lambda message: None)
+    assert workflow.send("AT+CFUN=1,1") == (1, None)
+    assert manager.session.sent == ["AT+CFUN=1,1"]
+
+
+def test_refused_reset_fails():
+    manager = manager_with([{"response": "\r\n+CME ERROR: 3\r\n", "result": "+CME ERROR: 3"}])
+    workflow = Workflow(manager, restart_steps(manager), log=lambda message: None)
+    assert workflow.send("AT+CFUN=1,1") == (1, "+CME ERROR: 3")
+
+
+def test_other_commands_are_retried():
+    manager = manager_with([{"response": "\r\nERROR\r\n"}, {"response": "\r\nOK\r\n"}])
+    workflow = Workflow(manager, [], log=lambda message: None)
+    assert workflow.send("AT^NRFREQLOCK=0") == (2, None)
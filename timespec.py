@@ -0,0 +1,11 @@
+# Units of a time ago on the command line
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(value, now):
+    """
+    Absolute Unix time, or a time ago such as 90s, 15m, 6h, 1d
+    """
+    if value[-1:] in UNITS:
+        return now - float(value[:-1]) * UNITS[value[-1]]
+    return float(value)
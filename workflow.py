@@ -0,0 +1,206 @@
+import argparse
+import itertools
+import json
+import sys
+import threading
+import time
+
+POLL_MIN = 0.2  # First poll of a wait, and again after every URC (seconds)
+POLL_MAX = 1  # Longest gap between polls while nothing changes (seconds)
+POLL_GROWTH = 1.5  # Poll gap growth factor while nothing changes
+STEP_TIMEOUT = 30  # Max time for the command of one step, retries included (seconds)
+SERVICE_TIMEOUT = 120  # Max time for the module to serve again after a restart (seconds)
+RESET_COMMANDS = ("AT+CFUN=1,1",)  # Sent once, never retried: a second reset would hit the module coming back up
+# Final result codes of a reset the module refused, any other reply than OK means its OK was lost with the link
+RESET_REFUSED = ("ERROR", "+CME ERROR:", "+CMS ERROR:")
+
+
+def serving(manager):
+    """
+    The decoded AT^HCSQ? signal once there is NR/LTE service, None until then
+    """
+    if manager.framed:
+        # Straight through the session: the link is down for a while after a restart, no error line per poll
+        try:
+            reply = manager.session.execute([manager.at_commands["view_signal"]], priority=manager.priority,
+                                            parse=True)[0]
+        except (OSError, ValueError):
+            return None
+        signal = manager.query_result("signal", reply.get("response"), reply.get("error"), reply.get("parsed"))
+    else:
+        signal = manager.signal()
+    if "error" in signal or signal["rsrp"] is None or signal["sysmode"] not in ("NR", "LTE"):
+        return None
+    return signal
+
+# Conditions a step can wait for, each called with the manager and returning None until it holds
+CONDITIONS = {"service": serving}
+
+
+class Waiter:
+    """
+    Polls a condition with a gap growing from POLL_MIN to POLL_MAX, and polls again at once
+    when the modem reports any URC (ats.py subscription on a thread of its own)
+    """
+    def __init__(self, manager):
+        self.session = manager.event_session()
+        self.wake = threading.Event()
+        self.events = 0
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def listen(self):
+        try:
+            for event in self.session.events():
+                self.events += 1
+                self.wake.set()
+        except Exception:
+            pass  # Closed, or a broker without subscriptions: polls keep their own pace
+
+    def close(self):
+        self.session.interrupt()
+        self.thread.join(1)
+
+    def poll(self, condition, timeout):
+        """
+        Call condition() until it returns something else than None, for at most timeout seconds
+        Returns (its value or None on timeout, seconds waited)
+        """
+        start = time.monotonic()
+        delay = POLL_MIN
+        while True:
+            self.wake.clear()  # A URC arriving while condition() runs makes the next wait return at once
+            value = condition()
+            elapsed = time.monotonic() - start
+            if value is not None or elapsed >= timeout:
+                return value, round(elapsed, 2)
+            woke = self.wake.wait(min(delay, timeout - elapsed))
+            delay = POLL_MIN if woke else min(delay * POLL_GROWTH, POLL_MAX)
+
+
+class Workflow:
+    """
+    Run a chain of AT commands as states through a CellularManager: each step sends its command,
+    retried with backoff while it fails, and moves on as soon as its condition holds
+    Steps are (name, command or None, condition name of CONDITIONS or None)
+    """
+    def __init__(self, manager, steps, step_timeout=STEP_TIMEOUT, service_timeout=SERVICE_TIMEOUT, log=print):
+        self.manager = manager
+        self.steps = steps
+        self.step_timeout = step_timeout
+        self.service_timeout = service_timeout
+        self.log = log
+
+    def send(self, command):
+        """
+        Send command until it returns OK, with a gap growing from POLL_MIN to POLL_MAX, until step_timeout
+        A reset (RESET_COMMANDS) is sent once, and counts as sent unless the module refused it (RESET_REFUSED)
+        Returns (attempts, error or None)
+        """
+        if command.strip().upper() in RESET_COMMANDS:
+            result = self.manager.raw(command)
+            if result.get("ok"):
+                return 1, None
+            if result.get("result", "").startswith(RESET_REFUSED):
+                return 1, result["result"]
+            self.log(f"Command '{command}' got no OK ({result.get('error') or result.get('result')}), "
+                     "the module is restarting")
+            return 1, None
+        end = time.monotonic() + self.step_timeout
+        delay = POLL_MIN
+        for attempt in itertools.count(1):
+            result = self.manager.raw(command)
+            if result.get("ok"):
+                return attempt, None
+            error = result.get("result") or result.get("error")
+            if time.monotonic() + delay > end:
+                return attempt, error
+            self.log(f"Command '{command}' failed ({error}). Retrying...")
+            time.sleep(delay)
+            delay = min(delay * POLL_GROWTH, POLL_MAX)
+
+    def run(self):
+        """
+        Returns {"state": "done" or "failed", "steps": [{"name", "command", "attempts", "waited", "elapsed"}, ...],
+        "elapsed", "service_s": seconds from the last step waiting for service until it served, "error"}
+        """
+        report = {"state": "failed", "steps": [], "elapsed": None, "service_s": None, "error": None}
+        start = time.monotonic()
+        waiter = Waiter(self.manager) if any(until for _, _, until in self.steps) else None
+        try:
+            for name, command, until in self.steps:
+                step = {"name": name, "command": command}
+                report["steps"].append(step)
+                t0 = time.monotonic()
+                if command is not None:
+                    step["attempts"], error = self.send(command)
+                    if error:
+                        step["error"] = report["error"] = f"{command} failed: {error}"
+                        return report
+                if until is not None:
+                    value, step["waited"] = waiter.poll(lambda: CONDITIONS[until](self.manager),
+                                                        self.service_timeout)
+                    if value is None:
+                        step["error"] = report["error"] = f"no {until} within {self.service_timeout}s"
+                        return report
+                step["elapsed"] = round(time.monotonic() - t0, 2)
+                if until == "service":
+                    report["service_s"] = step["elapsed"]
+                    self.log(f"{name}: service restored after {step['elapsed']}s")
+                elif command is not None:
+                    self.log(f"Command '{command}' executed successfully.")
+            report["state"] = "done"
+            return report
+        finally:
+            report["elapsed"] = round(time.monotonic() - start, 2)
+            if waiter is not None:
+                waiter.close()
+
+
+def restart_steps(manager, command=None):
+    """
+    Steps to send command (a lock or unlock, None for none), restart the module and wait for service
+    """
+    steps = [("set", command, None)] if command else []
+    return steps + [("restart", manager.at_commands["restart_cellular"], "service")]
+
+
+def main():
+    from at import CellularManager, SOCKET_FILE
+    parser = argparse.ArgumentParser(description="Lock, unlock or restart the module and wait until it serves again")
+    parser.add_argument("action", choices=["lock", "unlock", "restart", "wait"],
+                        help="wait only waits for service, e.g. after a scan")
+    parser.add_argument("--pci", help="lock: physical cell id")
+    parser.add_argument("--arfcn", help="lock: NR ARFCN")
+    parser.add_argument("--band", default="78", help="lock: NR band (default: 78)")
+    parser.add_argument("--scs", default="1", help="lock: subcarrier spacing, 0=15 1=30 kHz (default: 1)")
+    parser.add_argument("--timeout", type=float, default=SERVICE_TIMEOUT,
+                        help="max time for service to come back (default: %(default)s)")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Unix Domain Socket file path of ats.py")
+    parser.add_argument("--modem", help="modem id of a fleet broker (default: its first modem)")
+    args = parser.parse_args()
+
+    manager = CellularManager(args.socket, modem=args.modem)
+    if args.action == "lock":
+        if args.pci is None or args.arfcn is None:
+            parser.error("lock needs --pci and --arfcn")
+        steps = restart_steps(manager, manager.lock_command([(args.band, args.arfcn, args.scs, args.pci)]))
+    elif args.action == "unlock":
+        steps = restart_steps(manager, manager.at_commands["unlock_cell"])
+    elif args.action == "restart":
+        steps = restart_steps(manager)
+    else:
+        steps = [("wait", None, "service")]
+    log = print if args.format == "text" else (lambda message: None)
+    report = Workflow(manager, steps, service_timeout=args.timeout, log=log).run()
+    if args.format == "json":
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print(f"Workflow {report['state']} in {report['elapsed']}s"
+              + (f", service restored after {report['service_s']}s" if report["service_s"] is not None else "")
+              + (f": {report['error']}" if report["error"] else ""))
+    sys.exit(0 if report["state"] == "done" else 1)
+
+if __name__ == "__main__":
+    main()